@@ -0,0 +1,382 @@
+# -*- coding:utf-8 -*-
+
+'''
+The WebAPI as an ASGI application, for servers holding many (long-lived) connections in an event loop, e.g. `uvicorn asgi_app:app`.
+It serves the same resources as `flask_app` (see there), over the same `App`; so the two can't serve the same directory at once.
+The event loop never waits for the database: reading and changing the collection (which take the lock of `App`) run in a thread pool, the flushes in the flusher thread of the write-behind mode, and the conflict detection (the graph-heavy work) in a process pool.
+'''
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import multiprocessing
+import re
+import urllib.parse
+import uuid
+
+import networkx as nx
+
+from typing import Dict, List, Optional, Tuple
+
+from exception import ConflictError, IllegalStateError
+from ordering import ConflictReport
+from storage import DEFAULT_FEED_SIZE, App
+from webapi import (
+        API_BASE_URL,
+        DB_DIRECTORY,
+        Listing,
+        build_event,
+        build_transaction_operation,
+        conflict_status,
+        etag,
+        parse_max_cycles,
+        poll_timeout,
+        search_results,
+        timeline_ids,
+        )
+
+import sede
+
+
+MAX_BODY_SIZE = 1 << 20
+
+ROUTES = [
+        (re.compile('^{}/event$'.format(API_BASE_URL)), 'event_list'),
+        (re.compile('^{}/event/([^/]+)$'.format(API_BASE_URL)), 'event'),
+        (re.compile('^{}/event/([^/]+)/referrers$'.format(API_BASE_URL)), 'referrers'),
+        (re.compile('^{}/transaction$'.format(API_BASE_URL)), 'transaction'),
+        (re.compile('^{}/timeline$'.format(API_BASE_URL)), 'timeline'),
+        (re.compile('^{}/search$'.format(API_BASE_URL)), 'search'),
+        (re.compile('^{}/changes$'.format(API_BASE_URL)), 'changes'),
+        (re.compile('^{}/collection$'.format(API_BASE_URL)), 'collection'),
+        ]
+
+NOT_MODIFIED = 304
+
+Response = Tuple[int, object, Optional[str]]  # Status, body (as JSON), ETag
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str, **extra):
+        super().__init__(message)
+        self.status = status
+        self.body = dict(extra, message=message)
+
+
+def graph_conflict_status(edges: List[Tuple[uuid.UUID, uuid.UUID]], max_cycles: int) -> dict:
+    '''
+    The conflict status (see `webapi.conflict_status()`) of the ordering graph with these edges. Run in the process pool.
+    '''
+    return conflict_status(ConflictReport(nx.DiGraph(edges)), max_cycles)
+
+
+def _etag_matches(header: Optional[str], tag: str) -> bool:
+    if header is None:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate.strip('"') == tag:
+            return True
+    return False
+
+
+class AsgiApp:
+    '''
+    The ASGI application, opening the database (in `db_dir`) at the startup of the server, or at the first request.
+    `threads` and `processes` are the sizes of the pools (by default, depending on the CPUs).
+    '''
+
+    def __init__(self, db_dir=DB_DIRECTORY, threads: Optional[int]=None, processes: Optional[int]=None):
+        self._db_dir = db_dir
+        self._threads = threads
+        self._processes = processes
+        self.iapp = None  # type: Optional[App]
+        self._thread_pool = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        self._process_pool = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+        self._starting = None  # type: Optional[asyncio.Lock]
+        self._statuses = {}  # type: Dict[Tuple[str, int], asyncio.Future]  # The conflict statuses computed or being computed, of the latest version only
+        self._feed_changed = None  # type: Optional[asyncio.Event]  # Set (and replaced) at each change
+
+    async def startup(self) -> None:
+        if self._starting is None:
+            self._starting = asyncio.Lock()
+        async with self._starting:
+            if self.iapp is not None:
+                return
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(self._threads, thread_name_prefix='inforec-asgi')
+            # Spawned, as forking the threads (and locks) of this process is unsafe
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(self._processes, mp_context=multiprocessing.get_context('spawn'))
+            iapp = await self._run(App, self._db_dir, journal=True, write_behind=True, feed_size=DEFAULT_FEED_SIZE, search=True)
+            loop = asyncio.get_running_loop()
+            self._feed_changed = asyncio.Event()
+            assert iapp.feed is not None
+            iapp.feed.subscribe(lambda seq: loop.call_soon_threadsafe(self._notify_change))
+            self.iapp = iapp
+
+    def _notify_change(self) -> None:
+        assert self._feed_changed is not None
+        self._feed_changed.set()
+        self._feed_changed = asyncio.Event()
+
+    async def shutdown(self) -> None:
+        if self.iapp is not None:
+            await self._run(self.iapp.close)
+            self.iapp = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown()
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._thread_pool, functools.partial(func, *args, **kwargs))
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'websocket':
+            await self._refuse_websocket(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unknown ASGI scope {}'.format(scope['type']))  # As the ASGI specification asks
+        await self.startup()
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        try:
+            status, body, tag = await self._dispatch(scope, receive, headers)
+        except HTTPError as e:
+            status, body, tag = e.status, e.body, None
+        await self._respond(send, status, body, tag)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _refuse_websocket(receive, send) -> None:
+        '''
+        Refuse a WebSocket connection (the API is only served over HTTP): closed before being accepted, the server answers it with 403.
+        '''
+        message = await receive()
+        if message['type'] == 'websocket.connect':
+            await send({'type': 'websocket.close', 'code': 1003})
+
+    @staticmethod
+    async def _respond(send, status: int, body, tag: Optional[str]) -> None:
+        payload = b'' if status == NOT_MODIFIED else json.dumps(body).encode('utf-8') + b'\n'
+        headers = [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+        if tag is not None:
+            headers.append((b'etag', '"{}"'.format(tag).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    @staticmethod
+    async def _body(receive, headers: Dict[str, str]) -> dict:
+        '''
+        The arguments in the request body, as JSON or as a form.
+        '''
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_SIZE:
+                raise HTTPError(413, 'Request body too large')
+            if not message.get('more_body'):
+                break
+        try:
+            if headers.get('content-type', '').startswith('application/json'):
+                args = json.loads(body or b'{}')
+                if not isinstance(args, dict):
+                    raise ValueError('Not an object')
+                return args
+            return dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        except ValueError as e:
+            raise HTTPError(400, 'Invalid request body: {!r}'.format(e))
+
+    async def _dispatch(self, scope, receive, headers: Dict[str, str]) -> Response:
+        path = scope['path']
+        method = scope['method']
+        for pattern, name in ROUTES:
+            match = pattern.match(path)
+            if match is not None:
+                break
+        else:
+            raise HTTPError(404, 'Not found: {}'.format(path))
+        query = dict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        handler = getattr(self, '_{}_{}'.format(method.lower(), name), None)
+        if handler is None:
+            raise HTTPError(405, 'Method not allowed')
+        if method == 'POST':
+            return await handler(await self._body(receive, headers), *match.groups())
+        return await handler(query, headers.get('if-none-match'), *match.groups())
+
+    async def _read(self, if_none_match: Optional[str], build) -> Response:
+        '''
+        `build(collection)` in the thread pool, holding the lock for reading, unless the client has the current version (see `flask_app.versioned()`).
+        '''
+        def read():
+            with self.iapp.reading() as collection:
+                tag = etag(collection)
+                if _etag_matches(if_none_match, tag):
+                    return NOT_MODIFIED, None, tag
+                return 200, build(collection), tag
+        return await self._run(read)
+
+    async def _change(self, change) -> None:
+        '''
+        `change(collection)` in the thread pool, holding the lock for changing, raising the errors as HTTP ones.
+        '''
+        def run():
+            with self.iapp.transaction() as collection:
+                change(collection)
+        try:
+            await self._run(run)
+        except ConflictError as e:
+            raise HTTPError(409, str(e), cycle=[str(node) for node in e.cycle])
+        except (IllegalStateError, KeyError) as e:
+            raise HTTPError(400, 'Not applied: {!r}'.format(e))
+
+    async def _get_event_list(self, query, if_none_match) -> Response:
+        try:
+            listing = Listing(query)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        return await self._read(if_none_match, listing.result)
+
+    async def _post_event_list(self, args) -> Response:
+        id = str(uuid.uuid4())
+        event = self._build_event(args, id)
+        await self._change(lambda collection: collection.add_item(event, reject_conflict=True))
+        return 200, id, None
+
+    async def _get_event(self, query, if_none_match, id) -> Response:
+        def build(collection):
+            try:
+                return sede.serialise_event(collection.get_event(id))
+            except (KeyError, RuntimeError):  # Not in the collection, or not an event
+                raise HTTPError(404, 'No event {}'.format(id))
+            except ValueError as e:
+                raise HTTPError(400, 'Invalid id {}: {}'.format(id, e))
+        return await self._read(if_none_match, build)
+
+    async def _post_event(self, args, id) -> Response:
+        event = self._build_event(args, id)
+        await self._change(lambda collection: collection.update_item(id, event, reject_conflict=True))
+        return 200, id, None
+
+    @staticmethod
+    def _build_event(args, id):
+        try:
+            return build_event(args, id)
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPError(400, 'Invalid event: {!r}'.format(e))
+
+    async def _get_referrers(self, query, if_none_match, id) -> Response:
+        def build(collection):
+            try:
+                return {kind: [str(item) for item in ids] for kind, ids in collection.referrers(id).items()}
+            except KeyError as e:
+                raise HTTPError(404, 'No item {}'.format(e))
+            except ValueError as e:
+                raise HTTPError(400, 'Invalid id {}: {}'.format(id, e))
+        return await self._read(if_none_match, build)
+
+    async def _post_transaction(self, args) -> Response:
+        try:
+            operations = [build_transaction_operation(operation) for operation in args['operations']]
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPError(400, 'Invalid operation: {!r}'.format(e))
+        await self._change(lambda collection: collection.apply(operations, reject_conflict=True))
+        return 200, [str(event.id) for _, event in operations], None
+
+    async def _get_timeline(self, query, if_none_match) -> Response:
+        def build(collection):
+            try:
+                return timeline_ids(collection, query)
+            except KeyError as e:
+                raise HTTPError(404, 'No item {}'.format(e))
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+        return await self._read(if_none_match, build)
+
+    async def _get_search(self, query, if_none_match) -> Response:
+        def build(collection):
+            try:
+                return search_results(self.iapp.search_index, collection, query)
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+        return await self._read(if_none_match, build)
+
+    async def _get_changes(self, query, if_none_match) -> Response:
+        '''
+        Like `flask_app.Changes`, but waiting for a change without holding a thread.
+        '''
+        try:
+            timeout = poll_timeout(query)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        iapp, changed = self.iapp, self._feed_changed  # The event is taken before reading, so that a change made meanwhile is not missed
+        assert iapp is not None and changed is not None
+        result = await self._run(iapp.changes, query.get('since'))
+        if timeout and result.get('changes') == []:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                result = await self._run(iapp.changes, query.get('since'))
+        return 200, result, None
+
+    async def _get_collection(self, query, if_none_match) -> Response:
+        '''
+        The status of the collection. If there are conflicts (i.e. the incrementally maintained order is broken), they are found in the process pool, once per version.
+        '''
+        try:
+            max_cycles = parse_max_cycles(query)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+        def read():
+            with self.iapp.reading() as collection:
+                tag = etag(collection)
+                if _etag_matches(if_none_match, tag):
+                    return tag, None, True, None
+                acyclic = collection.has_no_conflict()
+                edges = None
+                if not acyclic and (tag, max_cycles) not in self._statuses:
+                    edges = list(collection.ordering().g.edges())
+                return tag, collection.is_self_contained(), acyclic, edges
+
+        while True:
+            tag, self_contained, acyclic, edges = await self._run(read)
+            if self_contained is None:
+                return NOT_MODIFIED, None, tag
+            key = (tag, max_cycles)
+            future = self._statuses.get(key)
+            if future is not None or acyclic or edges is not None:
+                break
+            # Else the status was dropped meanwhile, for a newer version: read again
+        if future is None:
+            if acyclic:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(conflict_status(ConflictReport(nx.DiGraph(), []), max_cycles))
+            else:
+                future = asyncio.get_running_loop().run_in_executor(self._process_pool, graph_conflict_status, edges, max_cycles)
+            if any(old_tag != tag for old_tag, _ in self._statuses):
+                self._statuses = {}
+            self._statuses[key] = future
+        status = {'is_self_contained': self_contained}
+        status.update(await asyncio.shield(future))
+        return 200, status, tag
+
+app = AsgiApp()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Benchmarks for the performance-sensitive parts of InfoRec.
+Run `python benchmark.py <name> --help` for the options of each benchmark.
+'''
+
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import networkx as nx
+
+import sede
+import timeparse
+
+from model import (
+        AbsoluteDateTime,
+        Date,
+        Event,
+        EventBuilder,
+        RelTimeSpec,
+        TimeRelativity,
+        compact_marker,
+        )
+from ordering import ImplicitIndex, implicit_ordering_edges, np
+from storage import BINARY_DATABASE_FILE, DATABASE_FILE, M_T_DES, M_T_SER, App, Collection, InfoRecDB
+from uuid import UUID, uuid4 as genid
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - start, ret
+
+
+def random_anchors(n, seed=0, days=365):
+    rnd = random.Random(seed)
+    base = datetime.datetime(2021, 1, 1)
+    anchors = []
+    for _ in range(n):
+        dt = base + datetime.timedelta(days=rnd.randrange(days), hours=rnd.randrange(24))
+        if rnd.random() < 0.2:
+            anchors.append(Date(genid(), dt.date()))
+        else:
+            anchors.append(AbsoluteDateTime(genid(), dt))
+    return anchors
+
+
+def all_pairs_edges(implicits):
+    '''
+    The previous way of ordering implicit markers, kept as the reference.
+    '''
+    edges = []
+    for marker in implicits:
+        for m2 in implicits:
+            if marker is not m2 and marker.compare(m2) == TimeRelativity.BEFORE:
+                edges.append((marker.id, m2.id))
+    return edges
+
+
+def bench_ordering(args):
+    for n in args.sizes:
+        anchors = random_anchors(n, args.seed)
+        t_sort, edges = timed(lambda: list(implicit_ordering_edges(anchors)))
+        line = f"n={n:>7} sort-based: {t_sort:8.4f}s {len(edges):>8} edges"
+        if n <= args.max_pairwise:
+            t_pair, ref_edges = timed(all_pairs_edges, anchors)
+            line += f" | all-pairs: {t_pair:8.4f}s {len(ref_edges):>9} edges"
+            if args.check:
+                g = nx.DiGraph(edges)
+                g.add_nodes_from(m.id for m in anchors)
+                closure = set(nx.transitive_closure_dag(g).edges())
+                assert closure == set(ref_edges), "Sort-based ordering differs from the all-pairs ordering"
+        print(line)
+
+
+def bench_implicit(args):
+    anchors = random_anchors(args.anchors, args.seed + 1)
+    for n in args.sizes:
+        markers = random_anchors(n, args.seed)
+        line = f"n={n:>7} anchors={len(anchors)}"
+        if n * len(anchors) <= args.max_pairwise:
+            t_pair, _ = timed(lambda: [[m.compare(anchor) for m in markers] for anchor in anchors])
+            line += f" | pairwise: {t_pair:8.4f}s"
+        modes = [False, True] if np is not None else [False]
+        for vectorized in modes:
+            t_build, index = timed(ImplicitIndex, markers, vectorized=vectorized)
+            t_codes, _ = timed(lambda: [index.codes(anchor) for anchor in anchors])
+            t_range, _ = timed(lambda: [index.between(a1, a2) for a1, a2 in zip(anchors, anchors[1:])])
+            line += f" | {'numpy' if vectorized else 'python'}: build {t_build:7.4f}s compare {t_codes:8.4f}s between {t_range:8.4f}s"
+        print(line)
+
+
+def random_collection(n, seed=0, anchor_ratio=0.2, rels=3):
+    '''
+    Markers with random relations to the previous ones.
+    '''
+    rnd = random.Random(seed)
+    anchors = random_anchors(int(n * anchor_ratio), seed)
+    markers = list(anchors)
+    for i in range(n - len(anchors)):
+        builder = EventBuilder(f"Event {i}").desc("Description of event {}".format(i))
+        for _ in range(rnd.randrange(rels + 1)):
+            target = rnd.choice(markers).id
+            if rnd.random() < 0.5:
+                builder.before(target)
+            else:
+                builder.after(target)
+        markers.append(builder.build())
+    return markers
+
+
+def legacy_deserialize(t, dic):
+    '''
+    The previous codec: `strptime()` for the times, and `UUID(str)` for every id.
+    '''
+    def uuidfy(items):
+        return [UUID(item) for item in items] if items is not None else None
+    if t == 'event':
+        ts = dic.get(sede.K_TIMESPEC) or {}
+        timespec = RelTimeSpec(uuidfy(ts.get(sede.K_BEFORE)), uuidfy(ts.get(sede.K_AFTER)), uuidfy(ts.get(sede.K_SAME)))
+        return Event(UUID(dic[sede.K_ID]), dic[sede.K_TITLE], timespec, dic.get(sede.K_DESC))
+    elif t == 'absolute_date_time':
+        return AbsoluteDateTime(UUID(dic[sede.K_ID]), datetime.datetime.strptime(dic[sede.K_DATETIME], '%Y-%m-%dT%H:%M:%S'))
+    else:
+        return Date(UUID(dic[sede.K_ID]), datetime.datetime.strptime(dic[sede.K_DATE], '%Y-%m-%d').date())
+
+
+def bench_codec(args):
+    markers = random_collection(args.size, args.seed)
+    for compact in (False, True):
+        t_ser, entries = timed(lambda: [(M_T_SER[type(m)][1], M_T_SER[type(m)][0](m, compact)) for m in markers])
+        text = json.dumps(entries)
+        t_load, loaded = timed(json.loads, text)
+        print(f"compact ids={compact!s:5} size: {len(text) / 1e6:7.2f}MB serialize: {t_ser:.3f}s json.loads: {t_load:.3f}s")
+        if not compact:
+            t_legacy, _ = timed(lambda: [legacy_deserialize(t, d) for t, d in loaded])
+            print(f"    legacy deserialize: {t_legacy:.3f}s")
+        t_single, _ = timed(lambda: [M_T_DES[t](d) for t, d in loaded])
+        t_batch, result = timed(sede.deserialize_batch, loaded, M_T_DES)
+        print(f"    per-entry deserialize: {t_single:.3f}s batch deserialize: {t_batch:.3f}s")
+        assert [m.id for m in result] == [m.id for m in markers]
+
+
+def bench_snapshot(args):
+    markers = random_collection(args.size, args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for binary, filename in ((False, DATABASE_FILE), (True, BINARY_DATABASE_FILE)):
+            directory = os.path.join(tmp_dir, filename)
+            os.mkdir(directory)
+            db = InfoRecDB(directory, Collection(markers), binary=binary)
+            t_write, _ = timed(db.write)
+            size = os.path.getsize(os.path.join(directory, filename))
+            t_open, _ = timed(InfoRecDB.open, directory, read_only=True)
+            t_lazy, lazy_db = timed(InfoRecDB.open, directory, lazy=True, read_only=True)
+            t_get, _ = timed(lazy_db.collection.get_item, markers[-1].id)
+            print(f"{filename:8} size: {size / 1e6:7.2f}MB write: {t_write:.3f}s open: {t_open:.3f}s lazy open: {t_lazy:.3f}s lazy get: {t_get * 1e3:.3f}ms")
+
+
+def traced_size(func, *args, **kwargs):
+    '''
+    The memory allocated (and still held) by `func`, with its return value.
+    '''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        ret = func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[0] - before, ret
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args):
+    markers = random_collection(args.size, args.seed)
+    entries = [(M_T_SER[type(m)][1], M_T_SER[type(m)][0](m)) for m in markers]
+    del markers
+
+    def compacted():
+        interned = {}  # type: dict
+        return [compact_marker(m, lambda id: interned.setdefault(id, id)) for m in sede.deserialize_batch(entries, M_T_DES)]
+
+    for name, load in (
+            ('per-entry', lambda: [M_T_DES[t](d) for t, d in entries]),
+            ('interned ids', lambda: sede.deserialize_batch(entries, M_T_DES)),
+            ('compact model', compacted),
+            ):
+        size, loaded = traced_size(load)
+        print(f"{name:14} {size / 1e6:8.1f}MB {size / len(loaded):6.0f}B/marker")
+        del loaded
+
+
+def random_time_strings(n, seed=0, distinct=500):
+    '''
+    Dates and times in various formats, drawn from `distinct` ones, as in a bulk import.
+    '''
+    rnd = random.Random(seed)
+    base = datetime.datetime(2021, 1, 1)
+    formats = ['%Y-%m-%d', '%Y%m%d', '%Y-%m-%d %H:%M', '%B %d %Y', '%d %b %Y %H:%M']
+    pool = [(base + datetime.timedelta(minutes=rnd.randrange(525600))).strftime(rnd.choice(formats)) for _ in range(distinct)]
+    return [rnd.choice(pool) for _ in range(n)]
+
+
+def bench_timeparse(args):
+    strings = random_time_strings(args.size, args.seed, args.distinct)
+    parser = timeparse.TimeParser()
+    t_parser, parsed = timed(lambda: [parser.parse(s) for s in strings])
+    print(f"TimeParser: {t_parser:.3f}s {parser.stats()}")
+    if not args.no_dateparser:
+        t_ref, ref = timed(lambda: [timeparse.dateparser.parse(s) for s in strings])
+        print(f"dateparser: {t_ref:.3f}s")
+        assert all(r is None or p == r for p, r in zip(parsed, ref)), "TimeParser differs from dateparser"
+
+
+def run_load(base_url, ids, workers, duration, write_ratio, seed=0):
+    '''
+    Send requests from `workers` threads for `duration` seconds: reads of random events, and a `write_ratio` of event creations.
+    Return the number of requests completed, and the errors.
+    '''
+    counts = [0] * workers
+    errors = []  # type: list
+    deadline = time.perf_counter() + duration
+
+    def work(w):
+        rnd = random.Random(seed * 1000 + w)
+        while time.perf_counter() < deadline:
+            try:
+                if rnd.random() < write_ratio:
+                    data = json.dumps({'title': 'load', 'after': str(rnd.choice(ids))}).encode()
+                    urllib.request.urlopen(urllib.request.Request(f"{base_url}/api/event", data, {'Content-Type': 'application/json'})).read()
+                else:
+                    urllib.request.urlopen(f"{base_url}/api/event/{rnd.choice(ids)}").read()
+            except Exception as e:
+                errors.append(e)
+            counts[w] += 1
+
+    threads = [threading.Thread(target=work, args=(w,)) for w in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts), errors
+
+
+def bench_load(args):
+    from werkzeug.serving import make_server
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)  # `flask_app` opens its database in the working directory when imported
+        import flask_app
+        with flask_app.iapp.transaction() as collection:
+            markers = random_collection(args.size, args.seed)
+            collection.add_item(*markers)
+        flask_app.iapp.flush()
+        ids = [m.id for m in markers if isinstance(m, Event)]
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # Not a line per request
+        server = make_server('127.0.0.1', 0, flask_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        try:
+            for workers in args.workers:
+                count, errors = run_load(base_url, ids, workers, args.duration, args.writes, args.seed)
+                print(f"workers: {workers:3} requests: {count:7} throughput: {count / args.duration:8.1f}/s errors: {len(errors)}")
+                if errors:
+                    print(f"    e.g. {errors[0]!r}")
+        finally:
+            server.shutdown()
+            flask_app.iapp.close()
+
+
+SERVERS = {
+        'flask': [sys.executable, '-c', 'import sys, flask_app, werkzeug.serving; werkzeug.serving.run_simple("127.0.0.1", int(sys.argv[1]), flask_app.app, threaded=True)', '{port}'],
+        'asgi': [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--port', '{port}', '--log-level', 'warning'],
+        }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(name, directory, port, timeout=30.0):
+    '''
+    Run the server `name` (of `SERVERS`) in a subprocess, serving the database in `directory/data`, and wait until it accepts connections.
+    '''
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    command = [arg.format(port=port) for arg in SERVERS[name]]
+    process = subprocess.Popen(command, cwd=directory, env=env, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server {name} did not start")
+
+
+async def http_load(port, paths, connections, duration, idle=0, seed=0):
+    '''
+    Send GET requests for random `paths` from `connections` concurrent clients (a connection per request) for `duration` seconds, while `idle` other connections are held open.
+    Return the latencies, and the number of errors.
+    '''
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(i):
+        nonlocal errors
+        rnd = random.Random(seed * 1000 + i)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(f"GET {rnd.choice(paths)} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+                response = await reader.read()
+                writer.close()
+                if response.split(b' ', 2)[1:2] != [b'200']:
+                    errors += 1
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    held = [await asyncio.open_connection('127.0.0.1', port) for _ in range(idle)]
+    await asyncio.gather(*(client(i) for i in range(connections)))
+    for _, writer in held:
+        writer.close()
+    return latencies, errors
+
+
+def bench_server(args):
+    servers = [name for name in args.servers if name != 'asgi' or importlib.util.find_spec('uvicorn') is not None]
+    if 'asgi' in args.servers and 'asgi' not in servers:
+        print("Skipping asgi: uvicorn is not installed")
+    markers = random_collection(args.size, args.seed)
+    ids = [m.id for m in markers if isinstance(m, Event)]
+    paths = [f"/api/event/{id}" for id in ids[:1000]] + ['/api/collection']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in servers:
+            directory = os.path.join(tmp_dir, name)
+            os.mkdir(directory)
+            app = App(os.path.join(directory, 'data'))
+            app.collection().add_item(*markers)
+            app.flush()
+            app.close()
+            port = free_port()
+            process = start_server(name, directory, port)
+            try:
+                for connections in args.connections:
+                    latencies, errors = asyncio.run(http_load(port, paths, connections, args.duration, args.idle, args.seed))
+                    latencies.sort()
+                    p50 = latencies[len(latencies) // 2] if latencies else 0
+                    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+                    print(f"{name:5} connections: {connections:4} throughput: {len(latencies) / args.duration:8.1f}/s p50: {p50 * 1e3:7.2f}ms p99: {p99 * 1e3:7.2f}ms errors: {errors}")
+            finally:
+                process.terminate()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(title='benchmark',
+            dest='benchmark',
+            help='The benchmark to run')
+
+    subparser = subparsers.add_parser('ordering', help='Implicit (absolute time) ordering of markers')
+    subparser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 2000, 4000, 10000, 100000])
+    subparser.add_argument('--max-pairwise', type=int, default=2000, help='Largest size to run the all-pairs reference on')
+    subparser.add_argument('--check', action='store_true', help='Check the transitive closure equals the all-pairs result')
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_ordering)
+
+    subparser = subparsers.add_parser('implicit', help='Comparing implicit markers to many anchors: pairwise, and batched by `ImplicitIndex` (with and without NumPy)')
+    subparser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    subparser.add_argument('--anchors', type=int, default=100)
+    subparser.add_argument('--max-pairwise', type=int, default=10 ** 6, help='Largest number of pairs to run the pairwise reference on')
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_implicit)
+
+    subparser = subparsers.add_parser('codec', help='Serialization and deserialization of a collection')
+    subparser.add_argument('--size', type=int, default=200000)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_codec)
+
+    subparser = subparsers.add_parser('snapshot', help='Writing and opening the snapshot, in JSON and in the binary format')
+    subparser.add_argument('--size', type=int, default=200000)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_snapshot)
+
+    subparser = subparsers.add_parser('memory', help='Memory held by the markers of a collection, in the plain and the compact representations')
+    subparser.add_argument('--size', type=int, default=1000000)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_memory)
+
+    subparser = subparsers.add_parser('timeparse', help='Parsing of date and time strings, with and without the fast paths and the memo')
+    subparser.add_argument('--size', type=int, default=2000)
+    subparser.add_argument('--distinct', type=int, default=200, help='Number of distinct strings')
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.add_argument('--no-dateparser', action='store_true', help="Don't run plain `dateparser` as the reference")
+    subparser.set_defaults(func=bench_timeparse)
+
+    subparser = subparsers.add_parser('load', help='Throughput of the web API under concurrent requests, by number of client threads')
+    subparser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    subparser.add_argument('--duration', type=float, default=5.0, help='Seconds per worker count')
+    subparser.add_argument('--writes', type=float, default=0.1, help='Ratio of the requests creating an event')
+    subparser.add_argument('--size', type=int, default=10000)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_load)
+
+    subparser = subparsers.add_parser('server', help='Throughput and latency of the web API servers (Flask and ASGI), each in a subprocess, under a local load')
+    subparser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=sorted(SERVERS, reverse=True))
+    subparser.add_argument('--connections', type=int, nargs='+', default=[1, 8, 32, 128], help='Numbers of concurrent clients')
+    subparser.add_argument('--idle', type=int, default=0, help='Idle connections held open meanwhile (as by dashboards)')
+    subparser.add_argument('--duration', type=float, default=5.0, help='Seconds per number of clients')
+    subparser.add_argument('--size', type=int, default=10000)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(func=bench_server)
+
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+
+'''
+Locks for sharing the database: between the threads of a process (`RWLock`), and between processes (`FileLock`).
+'''
+
+import contextlib
+import sys
+import threading
+
+from typing import IO, Iterator, Optional
+
+from exception import (
+        IllegalStateError,
+        )
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+
+class RWLock:
+    '''
+    A readers-writer lock: many readers at once, or one writer.
+    Waiting writers go first, so that they are not starved by a stream of readers (thus a reader must not take the lock again).
+    The writer may take the lock again, for reading or writing.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # type: Optional[int]  # The thread holding the write lock
+        self._writes = 0  # How many times it holds it
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self) -> Iterator[None]:
+        if self._writer == threading.get_ident():
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self) -> Iterator[None]:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = me
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class FileLock:
+    '''
+    An exclusive (advisory) lock on a file, held by one process at a time, and released when the process exits.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._f = None  # type: Optional[IO]
+
+    def acquire(self) -> None:
+        '''
+        Take the lock, or raise `IllegalStateError` if another process holds it.
+        '''
+        f = open(self._path, 'a+')
+        try:
+            if sys.platform == 'win32':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise IllegalStateError('`{}` is locked by another process'.format(self._path))
+        self._f = f
+
+    def release(self) -> None:
+        if self._f is None:
+            return
+        if sys.platform == 'win32':
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+    @property
+    def locked(self) -> bool:
+        return self._f is not None
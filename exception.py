@@ -12,3 +12,12 @@ Shared exceptions
 
 class IllegalStateError(RuntimeError):
     pass
+
+class ConflictError(IllegalStateError):
+    '''
+    Raised when an ordering relation contradicts the existing ones, i.e. it would form a cycle.
+    '''
+    def __init__(self, edge, cycle):
+        super().__init__('The ordering {} -> {} contradicts the existing ones'.format(*edge))
+        self.edge = edge
+        self.cycle = cycle
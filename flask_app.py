@@ -13,19 +13,32 @@ It may be split into multiple modules when necessary.
 '''
 
 from flask import Flask, redirect, request
-from flask_restful import Api, Resource, fields, marshal_with, reqparse
+from flask_restful import Api, Resource, abort, fields, marshal_with, reqparse
+import atexit
 import uuid
 
-from storage import App
+from exception import ConflictError, IllegalStateError
+from storage import DEFAULT_FEED_SIZE, App
+from webapi import (
+        API_BASE_URL,
+        DB_DIRECTORY,
+        Listing,
+        build_event,
+        build_transaction_operation,
+        collection_status,
+        etag,
+        parse_max_cycles,
+        poll_timeout,
+        search_results,
+        timeline_ids,
+        )
 
-import model
 import sede
 import utils
 
-DB_DIRECTORY = 'data'
-API_BASE_URL='/api'
-
-iapp = App(DB_DIRECTORY)
+# Opened once per process: the database takes a writer lock, so only one process can serve a directory (hence no reloader below)
+iapp = App(DB_DIRECTORY, journal=True, write_behind=True, feed_size=DEFAULT_FEED_SIZE, search=True)
+atexit.register(iapp.close)
 
 app = Flask(__name__)
 
@@ -41,28 +54,53 @@ def pre_handle_event_post_request(id):
     parser.add_argument('after', type=utils.comma_separated_list, default=[], help='Any other entries that are after this item. Represented as a comma-separated list of the entry IDs.')
     parser.add_argument('same', type=utils.comma_separated_list, default=[], help='Any other entries that are at the same time as this item. Represented as a comma-separated list of the entry IDs.')
     args = parser.parse_args(strict=True)
-    builder = model.EventBuilder(args.title).desc(args.desc).id(id)
-    for before in args.before:
-        builder.before(before)
-    for after in args.after:
-        builder.after(after)
-    for same in args.same:
-        builder.same(same)
-    event = builder.build()
-    return event
+    return build_event(args, id)
+
+def versioned(collection, build):
+    '''
+    Respond with `build()`, tagged with the version of the collection, unless the client already has this version (`If-None-Match`): then with 304, without building it.
+    '''
+    tag = etag(collection)
+    headers = {'ETag': '"{}"'.format(tag)}
+    if request.if_none_match.contains(tag):
+        return None, 304, headers
+    return build(), 200, headers
+
+def abort_on_conflict(e: ConflictError):
+    abort(409, message=str(e), cycle=[str(node) for node in e.cycle])
 
 class EventList(Resource):
+    '''
+    Without arguments, list the ids of all the items.
+    With `ids` (comma-separated), get these events in one request, as `{"events": [...], "missing": [ids]}`.
+    Otherwise, list the events by pages, as `{"events": [...], "next": cursor}` (`next` is null after the last page), with the arguments:
+    - `cursor`: the `next` of the previous page;
+    - `limit`: the maximum number of events in the page;
+    - `fields`: the (comma-separated) fields of the events to return, among `id`, `title`, `desc` and `timespec` (default: all);
+    - `title`: only the events whose title contains it, ignoring the case;
+    - `dangling`: only the events referring to ids not in the collection;
+    - `conflict`: only the events in a conflict.
+    '''
     def __init__(self, app):
         self.app = app
 
     def get(self):
-        return [str(item) for item in self.app.collection().list()]
+        try:
+            listing = Listing(request.args)
+        except ValueError as e:
+            abort(400, message=str(e))
+        with self.app.reading() as collection:
+            return versioned(collection, lambda: listing.result(collection))
 
     def post(self):
         id = uuid.uuid4()
         # return redirect(api.url_for(Event, id=str(id)), code=307)
         event = pre_handle_event_post_request(str(id))
-        self.app.collection().add_item(event)
+        try:
+            with self.app.transaction() as collection:
+                collection.add_item(event, reject_conflict=True)
+        except ConflictError as e:
+            abort_on_conflict(e)
         return str(id)
 
 class Event(Resource):
@@ -70,29 +108,123 @@ class Event(Resource):
         self.app = app
 
     def get(self, id):
-        event = self.app.collection().get_event(id)
-        return sede.serialise_event(event)
+        with self.app.reading() as collection:
+            return versioned(collection, lambda: sede.serialise_event(collection.get_event(id)))
 
     def post(self, id):
         event = pre_handle_event_post_request(id)
-        self.app.collection().update_item(id, event)
+        try:
+            with self.app.transaction() as collection:
+                collection.update_item(id, event, reject_conflict=True)
+        except ConflictError as e:
+            abort_on_conflict(e)
         return id
 
+class Transaction(Resource):
+    '''
+    Apply many event creations and updates atomically: either all of them are applied (and committed together), or none.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def post(self):
+        body = request.get_json(force=True)
+        try:
+            operations = [build_transaction_operation(operation) for operation in body['operations']]
+        except (KeyError, TypeError, ValueError) as e:
+            abort(400, message='Invalid operation: {!r}'.format(e))
+        try:
+            with self.app.transaction() as collection:
+                collection.apply(operations, reject_conflict=True)
+        except ConflictError as e:
+            abort_on_conflict(e)
+        except (IllegalStateError, KeyError) as e:
+            abort(400, message='Transaction not applied: {!r}'.format(e))
+        return [str(event.id) for _, event in operations]
+
+class Referrers(Resource):
+    def __init__(self, app):
+        self.app = app
+
+    def get(self, id):
+        with self.app.reading() as collection:
+            return versioned(collection, lambda: {kind: [str(item) for item in ids] for kind, ids in collection.referrers(id).items()})
+
+class Timeline(Resource):
+    '''
+    The ids of the items in time order, with the arguments `after` and `before` to only list the ones between these items.
+    With the times `from` and `to`, the ids of the items within this period instead, as estimated from the times before and after them (with `possibly`, including the ones which may be in it).
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get(self):
+        with self.app.reading() as collection:
+            try:
+                return versioned(collection, lambda: timeline_ids(collection, request.args))
+            except KeyError as e:
+                abort(404, message='No item {}'.format(e))
+            except ValueError as e:
+                abort(400, message=str(e))
+
+class Search(Resource):
+    '''
+    The events matching the query `q` (all its terms; a term ending with `*` is a prefix), best first, as `[{"id", "title", "score"}]`: at most `limit` of them.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get(self):
+        with self.app.reading() as collection:
+            try:
+                return versioned(collection, lambda: search_results(self.app.search_index, collection, request.args))
+            except ValueError as e:
+                abort(400, message=str(e))
+
+class Changes(Resource):
+    '''
+    The changes after the cursor `since` (the `next` of the previous response), as `{"changes": [...], "next": cursor}`; waiting for one at most `timeout` seconds (long polling).
+    Without `since`, or if the changes after it are not kept any more, the whole collection instead, as `{"resync": true, "items": [...], "next": cursor}`.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get(self):
+        try:
+            timeout = poll_timeout(request.args)
+        except ValueError as e:
+            abort(400, message=str(e))
+        return self.app.changes(request.args.get('since'), timeout)
+
 class Collection(Resource):
+    '''
+    The status of the collection, computed once per version, and answered with 304 to clients polling with the ETag of the current version.
+    '''
     def __init__(self, app):
         self.app = app
 
     def get(self):
-        return {
-                'is_self_contained': self.app.collection().is_self_contained(),
-                'has_no_conflict': self.app.collection().has_no_conflict(),
-                'conflicts': self.app.collection().conflicts(),
-                }
+        try:
+            max_cycles = parse_max_cycles(request.args)
+        except ValueError as e:
+            abort(400, message=str(e))
+        with self.app.reading() as collection:
+            return versioned(collection, lambda: collection.memoized(('status', max_cycles), lambda: collection_status(collection, max_cycles)))
 
 api.add_resource(EventList, f'{API_BASE_URL}/event',
         resource_class_args=[iapp])
 api.add_resource(Event, f'{API_BASE_URL}/event/<string:id>',
         resource_class_args=[iapp])
+api.add_resource(Transaction, f'{API_BASE_URL}/transaction',
+        resource_class_args=[iapp])
+api.add_resource(Referrers, f'{API_BASE_URL}/event/<string:id>/referrers',
+        resource_class_args=[iapp])
+api.add_resource(Timeline, f'{API_BASE_URL}/timeline',
+        resource_class_args=[iapp])
+api.add_resource(Search, f'{API_BASE_URL}/search',
+        resource_class_args=[iapp])
+api.add_resource(Changes, f'{API_BASE_URL}/changes',
+        resource_class_args=[iapp])
 api.add_resource(Collection, f'{API_BASE_URL}/collection',
         resource_class_args=[iapp])
 
@@ -100,4 +232,4 @@ api.add_resource(Collection, f'{API_BASE_URL}/collection',
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, use_reloader=False)  # The reloader would import this module again in a child process, which couldn't take the lock held by this one
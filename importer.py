@@ -0,0 +1,205 @@
+# -*- coding:utf-8 -*-
+
+'''
+Bulk import of markers from CSV or JSON Lines files.
+The rows are streamed through generators and added by chunks, each committed once, so that only one chunk of the input is held at a time.
+(The collection itself is held in memory, except with the SQLite storage.)
+
+A row has the keys (or CSV columns):
+- `type` (optional): `event`, `absolute_date_time` or `date`; guessed from the other keys if missing;
+- `id` (optional): generated if missing;
+- for events: `title`, `desc`, and `before`, `after` and `same`, as lists or comma-separated strings of ids;
+- for anchors: `datetime`, or `date` and optionally `time`, in any format `TimeParser` understands.
+'''
+
+import csv
+import itertools
+import json
+import time
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+from uuid import UUID
+
+import sede
+
+from exception import (
+        IllegalStateError,
+        )
+from model import (
+        AbsoluteBuilder,
+        AbsoluteDateTime,
+        Date,
+        EventBuilder,
+        RelTimeMarker,
+        )
+from storage import (
+        App,
+        InfoRecDB,
+        K_TYPE,
+        T_ABSOLUTEDATETIME,
+        T_DATE,
+        T_EVENT,
+        )
+from timeparse import DEFAULT_PARSER, TimeParser
+from utils import comma_separated_list
+
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMATS = (FORMAT_CSV, FORMAT_JSONL)
+DEFAULT_CHUNK_SIZE = 10000
+
+K_TIME = 'time'
+
+
+def guess_format(path) -> str:
+    return FORMAT_CSV if str(path).lower().endswith('.csv') else FORMAT_JSONL
+
+
+def read_rows(f: TextIO, fmt: str) -> Iterator[Dict[str, object]]:
+    '''
+    Generate the rows of the file, without the empty values.
+    '''
+    if fmt == FORMAT_CSV:
+        for row in csv.DictReader(f):
+            yield {key: value for key, value in row.items() if value}
+    elif fmt == FORMAT_JSONL:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise ValueError("Invalid JSON on line {}: {}".format(number, e)) from e
+                if not isinstance(row, dict):
+                    raise ValueError("Line {} is not a JSON object".format(number))
+                yield {key: value for key, value in row.items() if value is not None}
+    else:
+        raise ValueError("Unknown format {}".format(fmt))
+
+
+def _id(value) -> str:
+    if not isinstance(value, str):
+        raise ValueError("An id must be a string, not {!r}".format(value))
+    return value
+
+
+def _ids(value) -> List[str]:
+    if isinstance(value, str):
+        return comma_separated_list(value)
+    if not isinstance(value, list):
+        raise ValueError("The ids must be a list or a comma-separated string, not {!r}".format(value))
+    return [_id(id) for id in value]
+
+
+def row_marker(row: Dict[str, object], parser: TimeParser=DEFAULT_PARSER) -> RelTimeMarker:
+    t = row.get(K_TYPE)
+    if t is None:
+        if sede.K_TITLE in row:
+            t = T_EVENT
+        elif sede.K_DATETIME in row or K_TIME in row:
+            t = T_ABSOLUTEDATETIME
+        else:
+            t = T_DATE
+    id = row.get(sede.K_ID)
+    if id is not None:
+        id = _id(id)
+    if t == T_EVENT:
+        builder = EventBuilder(row[sede.K_TITLE]).desc(row.get(sede.K_DESC))
+        if id is not None:
+            builder.id(id)
+        for key, add in ((sede.K_BEFORE, builder.before), (sede.K_AFTER, builder.after), (sede.K_SAME, builder.same)):
+            for target in _ids(row.get(key, [])):
+                add(target)
+        return builder.build()
+    elif t == T_ABSOLUTEDATETIME or t == T_DATE:
+        abs_builder = AbsoluteBuilder(parser)
+        if id is not None:
+            abs_builder.id(UUID(id))
+        if sede.K_DATETIME in row:
+            abs_builder.datetime(row[sede.K_DATETIME])
+        else:
+            abs_builder.date(row[sede.K_DATE])
+            if K_TIME in row:
+                abs_builder.time(row[K_TIME])
+        marker = abs_builder.build()
+        if not isinstance(marker, AbsoluteDateTime if t == T_ABSOLUTEDATETIME else Date):
+            raise ValueError("A {} is given a {}".format(t, type(marker).__name__))
+        return marker
+    raise ValueError("Unknown type {}".format(t))
+
+
+def row_markers(rows: Iterable[Dict[str, object]], parser: TimeParser=DEFAULT_PARSER) -> Iterator[RelTimeMarker]:
+    for line, row in enumerate(rows, 1):
+        try:
+            yield row_marker(row, parser)
+        except (KeyError, ValueError) as e:
+            raise ValueError("Invalid row {}: {!r}".format(line, e)) from e
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _duplicated(collection, chunk: List[RelTimeMarker]) -> Optional[int]:
+    '''
+    The index in the chunk of the first marker whose id is already in the collection or earlier in the chunk, if any.
+    '''
+    ids = set()  # type: Set[UUID]
+    for i, marker in enumerate(chunk):
+        if marker.id in ids:
+            return i
+        try:
+            collection.get_item(marker.id)
+            return i
+        except KeyError:
+            ids.add(marker.id)
+    return None
+
+
+def import_markers(app: App, markers: Iterable[RelTimeMarker], chunk_size: int=DEFAULT_CHUNK_SIZE, progress: Optional[Callable[[int, float], None]]=None) -> Tuple[int, Set[UUID]]:
+    '''
+    Add the markers to the collection of `app` by chunks, committing (`flush()`) after each, and compact the database at the end.
+    Open `app` with `journal` so that a chunk only appends to the journal, instead of rewriting the whole database.
+    The references are only checked at the end, as they may be to markers later in the input.
+    If a chunk can't be added (e.g. with an id already in the collection), an `IllegalStateError` is raised, telling the row; the chunks before it stay committed (none of the failing chunk is added).
+    `progress` is called after each chunk with the number of markers imported so far and the time elapsed.
+    Return the number of markers imported, and the dangling references.
+    '''
+    db = app.db
+    threshold = None
+    if isinstance(db, InfoRecDB):
+        threshold, db.compact_threshold = db.compact_threshold, None  # Compacting once, at the end
+    start = time.perf_counter()
+    count = 0
+    try:
+        for chunk in chunked(markers, chunk_size):
+            with app.transaction() as collection:
+                try:
+                    collection.add_item(*chunk)
+                except IllegalStateError as e:
+                    duplicated = _duplicated(collection, chunk)
+                    cause = 'row {}: {}'.format(count + duplicated + 1, e) if duplicated is not None else e
+                    raise IllegalStateError("Rows {}-{} not imported ({} rows before them are imported already), because of {}".format(count + 1, count + len(chunk), count, cause)) from e
+            app.flush()
+            count += len(chunk)
+            if progress is not None:
+                progress(count, time.perf_counter() - start)
+    finally:
+        if isinstance(db, InfoRecDB):
+            db.compact_threshold = threshold
+    app.compact()
+    return count, app.collection().dangling_refs()
+
+
+def import_file(app: App, path, fmt: Optional[str]=None, chunk_size: int=DEFAULT_CHUNK_SIZE, progress: Optional[Callable[[int, float], None]]=None, parser: TimeParser=DEFAULT_PARSER) -> Tuple[int, Set[UUID]]:
+    '''
+    Import the rows of the file at `path` (see `import_markers()`). The format is guessed from the extension if not given.
+    '''
+    with open(path, 'r', newline='') as f:
+        rows = read_rows(f, fmt or guess_format(path))
+        return import_markers(app, row_markers(rows, parser), chunk_size, progress)
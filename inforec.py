@@ -14,9 +14,16 @@
 import argparse
 import sys
 
-from model import EventBuilder
+import importer
+import search
+
+from exception import IllegalStateError
+from model import Event, EventBuilder
+from sharded_storage import DEFAULT_PREFIX_LENGTH, SCHEMES, ShardedInfoRecDB
+from sqlite_storage import SqliteInfoRecDB
 from storage import App, InfoRecDB
-from utils import tabularize_events
+from timeparse import DEFAULT_PARSER
+from utils import iter_events
 
 
 DEFAULT_DIR = '.'
@@ -27,6 +34,15 @@ def error(msg: str) -> None:
     sys.exit(2)
 
 
+def open_read_only(base_dir, **kwargs) -> App:
+    '''
+    Open the database for reading only (so while another process writes it), initializing it first if there is none, as `App` does otherwise.
+    '''
+    if InfoRecDB.not_exists_or_empty_dir(base_dir):
+        InfoRecDB.init(base_dir)
+    return App(base_dir, lazy=True, read_only=True, **kwargs)
+
+
 def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title='action',
@@ -34,10 +50,29 @@ def main():
             help='The action to perform')
 
     parser.add_argument('-d', '--directory', nargs='?', default=DEFAULT_DIR)
+    parser.add_argument('-j', '--journal', action='store_true', help='Append the changes to the journal instead of rewriting the whole database')
 
     subparser = subparsers.add_parser('init')
+    subparser.add_argument('--sqlite', action='store_true', help='Store the database in SQLite instead of JSON')
+    subparser.add_argument('--binary', action='store_true', help='Store the snapshot in the (memory-mapped) binary format instead of JSON')
+    subparser.add_argument('--shard-by', choices=SCHEMES, default=None, help='Split the database into shards, by id prefix or by namespace (see `add --namespace`)')
+    subparser.add_argument('--prefix-length', type=int, default=DEFAULT_PREFIX_LENGTH, help='Number of hex digits of the id prefixes of the shards')
 
     subparser = subparsers.add_parser('list')
+    subparser.add_argument('--ordered', action='store_true', help='List the events in time order instead of the order they were added in')
+
+    subparser = subparsers.add_parser('search', help='Search the events by the words in their title and description')
+    subparser.add_argument('query', nargs='+', help='The words (all of them must match); a word ending with * is a prefix')
+    subparser.add_argument('--limit', type=int, default=search.DEFAULT_LIMIT)
+
+    subparser = subparsers.add_parser('compact')
+    subparser.add_argument('--format', choices=['json', 'binary'], default=None, help='Convert the snapshot to this format (default: keep the current one)')
+    subparser.add_argument('--search', action='store_true', help='Also write the search index, so that it is not rebuilt when opening the database')
+
+    subparser = subparsers.add_parser('import', help='Import markers in bulk from a CSV or JSON Lines file; each chunk is committed, so the ones before a failing row stay imported')
+    subparser.add_argument('file')
+    subparser.add_argument('--format', choices=importer.FORMATS, default=None, help='The format of the file (default: guessed from its extension)')
+    subparser.add_argument('--chunk-size', type=int, default=importer.DEFAULT_CHUNK_SIZE, help='Number of markers added and committed at once')
 
     subparser = subparsers.add_parser('add')
     subparser.add_argument('title')
@@ -45,28 +80,78 @@ def main():
     subparser.add_argument('--before', nargs='?', default=None)
     subparser.add_argument('--after', nargs='?', default=None)
     subparser.add_argument('--same', nargs='?', default=None)
+    subparser.add_argument('--namespace', default=None, help='The shard of the event, in a database sharded by namespace')
 
     args = parser.parse_args()
 
     base_dir = args.directory
     if args.action == 'init':
-        InfoRecDB.init(base_dir)
+        if args.sqlite:
+            SqliteInfoRecDB.init(base_dir)
+        elif args.shard_by:
+            try:
+                ShardedInfoRecDB.init(base_dir, args.shard_by, args.prefix_length, binary=args.binary)
+            except ValueError as e:
+                error(str(e))
+        else:
+            InfoRecDB.init(base_dir, binary=args.binary)
     elif args.action == 'list':
-        app = App(base_dir)
-        for einfo in tabularize_events(app.collection()):
-            print(f"{einfo[0]} {einfo[1]}")
+        app = open_read_only(base_dir)
+        if args.ordered:
+            collection = app.collection()
+            for id in collection.timeline().ids():
+                item = collection.get_item(id)
+                if isinstance(item, Event):
+                    print(f"{id} {item.title}")
+        else:
+            for einfo in iter_events(app.collection()):
+                print(f"{einfo[0]} {einfo[1]}")
+    elif args.action == 'search':
+        app = open_read_only(base_dir, search=True)
+        collection = app.collection()
+        for id, score in app.search(' '.join(args.query), args.limit):
+            print(f"{id} {score:.2f} {collection.get_event(id).title}")
     elif args.action == 'add':
         title = args.title
         desc = args.desc
         before = args.before
         after = args.after
         same = args.same
-        app = App(base_dir)
+        app = App(base_dir, journal=args.journal)
         collection = app.collection()
         event = EventBuilder(title).desc(desc).before(before).after(after).same(same).build()
-        collection.add_item(event)
+        if args.namespace is not None:
+            if not isinstance(app.db, ShardedInfoRecDB):
+                error('--namespace is only for a database sharded by namespace')
+            try:
+                collection.add_item(event, namespace=args.namespace)
+            except ValueError as e:
+                error(str(e))
+        else:
+            collection.add_item(event)
         assert collection.is_self_contained()
         app.flush()
+    elif args.action == 'import':
+        def progress(count, elapsed):
+            print(f"Imported {count} markers in {elapsed:.1f}s ({count / elapsed:.0f}/s)", file=sys.stderr)
+        app = App(base_dir, journal=True)
+        try:
+            count, dangling = importer.import_file(app, args.file, args.format, args.chunk_size, progress)
+        except (ValueError, IllegalStateError) as e:
+            error(str(e))
+        stats = DEFAULT_PARSER.stats()
+        print(f"Imported {count} markers; times parsed without dateparser: {stats['hit_rate']:.0%}")
+        if dangling:
+            print(f"Warning: {len(dangling)} referred ids are not in the collection, e.g. {', '.join(str(id) for id in list(dangling)[:5])}", file=sys.stderr)
+        if not app.collection().has_no_conflict():
+            print("Warning: the collection has conflicting orderings", file=sys.stderr)
+    elif args.action == 'compact':
+        binary = None if args.format is None else args.format == 'binary'
+        app = App(base_dir, binary=binary, search=args.search)
+        if isinstance(app.db, ShardedInfoRecDB):  # Only the opened shards are compacted
+            for name in app.db.names():
+                app.db.shard(name)
+        app.compact()
     else:
         parser.print_help()
 
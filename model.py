@@ -10,14 +10,17 @@
 This file contains the data model.
 '''
 
-import dateparser
 import datetime
 
 from enum import Enum
 from exception import (
         IllegalStateError,
         )
-from typing import Iterable, List, Mapping, Optional, Union
+from timeparse import (
+        DEFAULT_PARSER,
+        TimeParser,
+        )
+from typing import Callable, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 from uuid import (
         uuid4 as genid,
         UUID,
@@ -38,11 +41,14 @@ class RelTimeMarker:
     A class representing a relative time, which may be relative to another event or absolute to clock.
     Maybe using subclasses is neater.
     '''
+    __slots__ = ('id',)
+
     def __init__(self, id):
         self.id = id
 
 
 class RelTimeSpecImplicit:
+    __slots__ = ()
 
     def compare(self, o: 'RelTimeSpecImplicit') -> TimeRelativity:
         return NotImplemented
@@ -51,9 +57,11 @@ class RelTimeSpecImplicit:
 class RelTimeSpec:
     '''
     A class representing a specification of relative time, which should be before, after, or is at the same time as some `RelTimeMarker`.
+    The relations are lists, or tuples in the compact representation (see `compact_marker()`).
     '''
+    __slots__ = ('befores', 'afters', 'sames')
 
-    def __init__(self, befores: Optional[List[UUID]]=None, afters: Optional[List[UUID]]=None, sames: Optional[List[UUID]]=None):
+    def __init__(self, befores: Optional[Sequence[UUID]]=None, afters: Optional[Sequence[UUID]]=None, sames: Optional[Sequence[UUID]]=None):
         '''
         None means this field is unknown, while an empty list means this field is known to be empty
         '''
@@ -62,23 +70,39 @@ class RelTimeSpec:
         self.afters = afters
         self.sames = sames
 
+    def _relations(self, rels: Optional[Sequence[UUID]]) -> List[UUID]:
+        if self is EMPTY_TIMESPEC:
+            raise IllegalStateError('The shared empty RelTimeSpec can not be changed')
+        return rels if isinstance(rels, list) else list(rels or [])
+
     def before(self, other: RelTimeMarker):
-        if self.befores is None:
-            self.befores = []
-        self.befores.append(other.id)
+        self.befores = befores = self._relations(self.befores)
+        befores.append(other.id)
 
     def after(self, other: RelTimeMarker):
-        if self.afters is None:
-            self.afters = []
-        self.afters.append(other.id)
+        self.afters = afters = self._relations(self.afters)
+        afters.append(other.id)
 
     def same(self, other: RelTimeMarker):
-        if self.sames is None:
-            self.sames = []
-        self.sames.append(other.id)
+        self.sames = sames = self._relations(self.sames)
+        sames.append(other.id)
+
+
+EMPTY_TIMESPEC = RelTimeSpec()  # Shared by the compacted events without any relation
+
+
+def utc_time(t: datetime.datetime) -> datetime.datetime:
+    '''
+    The naive UTC time of `t`; a naive time is taken as UTC already.
+    This is what times are compared by, and the day of a time (against a `Date`) is its UTC day, so that the order of times and days agree whatever the offsets.
+    '''
+    if t.tzinfo is None:
+        return t
+    return t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
 
 class AbsoluteDateTime(RelTimeMarker, RelTimeSpecImplicit):
+    __slots__ = ('abstime',)
 
     def __init__(self, id, abstime: datetime.datetime):
         super().__init__(id)
@@ -89,16 +113,17 @@ class AbsoluteDateTime(RelTimeMarker, RelTimeSpecImplicit):
 
     def compare(self, o: RelTimeSpecImplicit) -> TimeRelativity:
         if isinstance(o, AbsoluteDateTime):
-            if self.abstime < o.abstime:
+            time, o_time = utc_time(self.abstime), utc_time(o.abstime)
+            if time < o_time:
                 return TimeRelativity.BEFORE
-            elif self.abstime == o.abstime:
+            elif time == o_time:
                 return TimeRelativity.PARALLEL
-            elif self.abstime > o.abstime:
+            elif time > o_time:
                 return TimeRelativity.AFTER
             else:
                 raise IllegalStateError('AbsoluteDateTime comparison exausted but not found')
         elif isinstance(o, Date):
-            date = self.abstime.date()
+            date = utc_time(self.abstime).date()
             if date < o.date:
                 return TimeRelativity.BEFORE
             elif date == o.date:
@@ -111,6 +136,7 @@ class AbsoluteDateTime(RelTimeMarker, RelTimeSpecImplicit):
 
 
 class Date(RelTimeMarker, RelTimeSpecImplicit):
+    __slots__ = ('date',)
 
     def __init__(self, id, date: datetime.date):
         super().__init__(id)
@@ -121,7 +147,7 @@ class Date(RelTimeMarker, RelTimeSpecImplicit):
 
     def compare(self, o: RelTimeSpecImplicit) -> TimeRelativity:
         if isinstance(o, AbsoluteDateTime):
-            o_date = o.abstime.date()
+            o_date = utc_time(o.abstime).date()
             if self.date < o_date:
                 return TimeRelativity.BEFORE
             elif self.date == o_date:
@@ -143,6 +169,7 @@ class Date(RelTimeMarker, RelTimeSpecImplicit):
 
 
 class Event(RelTimeMarker):
+    __slots__ = ('title', 'desc', 'timespec')
 
     def __init__(self, id, title, timespec, desc=None):
         super().__init__(id)
@@ -154,15 +181,43 @@ class Event(RelTimeMarker):
         return self.title
 
 
+def _interned(ids: Optional[Sequence[UUID]], intern: Callable[[UUID], UUID]) -> Optional[Tuple[UUID, ...]]:
+    if ids is None:
+        return None
+    return tuple(intern(id) for id in ids)
+
+
+def compact_marker(marker: RelTimeMarker, intern: Callable[[UUID], UUID]) -> RelTimeMarker:
+    '''
+    A copy of the marker in the compact representation: ids interned with `intern` (returning one shared object per id), relations as tuples, and the shared `EMPTY_TIMESPEC` for events without any relation.
+    The compacted markers are meant to be replaced (as in `Collection.update_item()`) rather than changed.
+    '''
+    id = intern(marker.id)
+    if isinstance(marker, Event):
+        timespec = marker.timespec
+        if timespec is None or (timespec.befores is None and timespec.afters is None and timespec.sames is None):
+            timespec = EMPTY_TIMESPEC
+        else:
+            timespec = RelTimeSpec(_interned(timespec.befores, intern), _interned(timespec.afters, intern), _interned(timespec.sames, intern))
+        return Event(id, marker.title, timespec, marker.desc)
+    elif isinstance(marker, AbsoluteDateTime):
+        return AbsoluteDateTime(id, marker.abstime)
+    elif isinstance(marker, Date):
+        return Date(id, marker.date)
+    raise IllegalStateError("Unknown type of marker {}".format(type(marker)))
+
+
 class AbsoluteBuilder:
     '''
     Common builder class for AbsoluteDateTime and Date
+    Strings are parsed by `parser` (the shared `DEFAULT_PARSER` by default).
     '''
 
-    def __init__(self):
+    def __init__(self, parser: TimeParser=DEFAULT_PARSER):
         self._id = None
         self._date = None
         self._time = None
+        self._parser = parser
 
     def id(self, id):
         self._id = id
@@ -172,7 +227,7 @@ class AbsoluteBuilder:
         if isinstance(date, datetime.date):
             self._date = date
         else:
-            dt = dateparser.parse(date) or datetime.datetime.strptime(date, '%Y%m%d')
+            dt = self._parser.parse(date)
             if not dt:
                 raise ValueError("Unparsed date {}".format(date))
             self._date = dt.date()
@@ -182,7 +237,7 @@ class AbsoluteBuilder:
         if isinstance(time, datetime.time):
             self._time = time
         else:
-            dt = dateparser.parse(time)
+            dt = self._parser.parse(time)
             if not dt:
                 raise ValueError("Unparsed time {}".format(time))
             self._time = dt.time()
@@ -193,7 +248,7 @@ class AbsoluteBuilder:
             self._date = date_time.date()
             self._time = date_time.time()
         else:
-            dt = dateparser.parse(date_time)
+            dt = self._parser.parse(date_time)
             if not dt:
                 raise ValueError("Unparsed datetime {}".format(date_time))
             self._date = dt.date()
@@ -0,0 +1,847 @@
+# -*- coding:utf-8 -*-
+
+'''
+Algorithms on the ordering of `RelTimeMarker`s, used to build the ordering graph.
+'''
+
+import bisect
+import datetime
+import heapq
+import itertools
+import networkx as nx
+
+try:
+    import numpy as np
+except ImportError:  # Optional: `ImplicitIndex` falls back to plain Python
+    np = None  # type: ignore
+
+from typing import Any, Callable, Dict, Generic, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
+from uuid import UUID
+
+from exception import (
+        IllegalStateError,
+        )
+from model import (
+        AbsoluteDateTime,
+        Date,
+        RelTimeSpecImplicit,
+        TimeRelativity,
+        utc_time,
+        )
+
+
+def implicit_day(marker: RelTimeSpecImplicit) -> datetime.date:
+    '''
+    The day an implicit marker falls in, which is the key used to bucket the markers; the UTC day for a time (see `utc_time()`).
+    '''
+    if isinstance(marker, AbsoluteDateTime):
+        return utc_time(marker.abstime).date()
+    elif isinstance(marker, Date):
+        day = marker.date
+        if isinstance(day, datetime.datetime):  # Older deserializers store a datetime in `Date`
+            return day.date()
+        return day
+    raise TypeError("Unsupported implicit marker {}".format(type(marker)))
+
+
+DayGroup = Tuple[List[UUID], Dict[datetime.datetime, List[UUID]]]  # The `Date`s and the `AbsoluteDateTime`s (by UTC time) of a day
+
+
+def _chain_edges(groups: Iterable[DayGroup]) -> Iterator[Tuple[UUID, UUID]]:
+    '''
+    Generate the transitive reduction of the order between the implicit markers of consecutive days:
+    - `AbsoluteDateTime`s of the same day are chained bucket by bucket (equal datetimes are PARALLEL, thus in the same bucket);
+    - A `Date` generalizes the `AbsoluteDateTime`s of its day, so it is not ordered with them, but with the last (first) markers of the previous (next) day.
+    '''
+    prev_sinks = []  # type: List[UUID]
+    for dates, times in groups:
+        buckets = [times[t] for t in sorted(times)]
+        sources = dates + buckets[0] if buckets else dates
+        for u in prev_sinks:
+            for v in sources:
+                yield u, v
+        for b1, b2 in zip(buckets, buckets[1:]):
+            for u in b1:
+                for v in b2:
+                    yield u, v
+        prev_sinks = dates + buckets[-1] if buckets else dates
+
+
+class ImplicitChain:
+    '''
+    The implicit markers (`AbsoluteDateTime` and `Date`) sorted by their day and time.
+    Only the transitive reduction of the order given by `compare()` is kept as edges, which has the same reachability as comparing every pair, but takes O(n log n) to build.
+    Adding or removing a marker only changes the edges around its day, which are returned as a delta.
+    '''
+
+    def __init__(self):
+        self._days = []  # type: List[datetime.date]  # Sorted
+        self._groups = {}  # type: Dict[datetime.date, DayGroup]
+
+    def __bool__(self):
+        return bool(self._days)
+
+    def edges(self) -> Iterator[Tuple[UUID, UUID]]:
+        return _chain_edges(self._groups[day] for day in self._days)
+
+    def _put(self, marker: RelTimeSpecImplicit) -> datetime.date:
+        day = implicit_day(marker)
+        if day not in self._groups:
+            self._groups[day] = ([], {})
+        dates, times = self._groups[day]
+        if isinstance(marker, AbsoluteDateTime):
+            time = utc_time(marker.abstime)
+            if time not in times:
+                times[time] = []
+            times[time].append(marker.id)
+        elif isinstance(marker, Date):
+            dates.append(marker.id)
+        return day
+
+    def extend(self, markers: Iterable[RelTimeSpecImplicit]) -> Iterator[Tuple[UUID, UUID]]:
+        '''
+        Add markers in bulk to an empty chain, and return all the edges.
+        '''
+        if self._days:
+            raise IllegalStateError('Bulk extending is only possible on an empty chain')
+        for marker in markers:
+            self._put(marker)
+        self._days = sorted(self._groups)
+        return self.edges()
+
+    def _window(self, day: datetime.date) -> Set[Tuple[UUID, UUID]]:
+        '''
+        The edges incident to the markers of `day`, i.e. the ones from the previous day to the next day.
+        '''
+        i = bisect.bisect_left(self._days, day)
+        window = self._days[max(i - 1, 0):i + 2] if i < len(self._days) and self._days[i] == day else self._days[max(i - 1, 0):i + 1]
+        return set(_chain_edges(self._groups[d] for d in window))
+
+    def _windows(self, days: Iterable[datetime.date]) -> Set[Tuple[UUID, UUID]]:
+        edges = set()  # type: Set[Tuple[UUID, UUID]]
+        for day in days:
+            edges |= self._window(day)
+        return edges
+
+    def add(self, *markers: RelTimeSpecImplicit) -> Tuple[Set[Tuple[UUID, UUID]], Set[Tuple[UUID, UUID]]]:
+        '''
+        Add markers to the chain, and return the edges removed and added because of them.
+        The edges around each day are only computed once, however many markers fall in it.
+        '''
+        days = {implicit_day(marker) for marker in markers}
+        old = self._windows(days)
+        for day in days:
+            if day not in self._groups:
+                bisect.insort(self._days, day)
+        for marker in markers:
+            self._put(marker)
+        new = self._windows(days)
+        return old - new, new - old
+
+    def remove(self, marker: RelTimeSpecImplicit) -> Tuple[Set[Tuple[UUID, UUID]], Set[Tuple[UUID, UUID]]]:
+        '''
+        Remove a marker from the chain, and return the edges removed and added because of it.
+        '''
+        day = implicit_day(marker)
+        old = self._window(day)
+        dates, times = self._groups[day]
+        if isinstance(marker, AbsoluteDateTime):
+            time = utc_time(marker.abstime)
+            times[time].remove(marker.id)
+            if not times[time]:
+                del times[time]
+        elif isinstance(marker, Date):
+            dates.remove(marker.id)
+        if not dates and not times:
+            del self._groups[day]
+            del self._days[bisect.bisect_left(self._days, day)]
+        new = self._window(day)
+        return old - new, new - old
+
+
+def implicit_ordering_edges(markers: Iterable[RelTimeSpecImplicit]) -> Iterator[Tuple[UUID, UUID]]:
+    '''
+    Generate the ordering edges between implicit markers (`AbsoluteDateTime` and `Date`), as the transitive reduction of the order given by `compare()`.
+    '''
+    return ImplicitChain().extend(markers)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_UTC = EPOCH.replace(tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+DAY = datetime.timedelta(days=1) // MICROSECOND
+DATE_TIME = -2 ** 63  # The time of a `Date`, so that it goes first in its day
+
+# The codes of `ImplicitIndex.codes()`
+C_BEFORE, C_PARALLEL, C_AFTER, C_GENERALIZED, C_SPECIALIZED = range(5)
+RELATIVITIES = (TimeRelativity.BEFORE, TimeRelativity.PARALLEL, TimeRelativity.AFTER, TimeRelativity.GENERALIZED, TimeRelativity.SPECIALIZED)
+
+
+def microseconds(t: datetime.datetime) -> int:
+    '''
+    The time in microseconds since the epoch, naive times being taken as UTC.
+    '''
+    return (t - (EPOCH if t.tzinfo is None else EPOCH_UTC)) // MICROSECOND
+
+
+def from_microseconds(us: int) -> datetime.datetime:
+    '''
+    The (naive, UTC) time of `microseconds()`.
+    '''
+    return EPOCH + datetime.timedelta(microseconds=us)
+
+
+def implicit_key(marker: RelTimeSpecImplicit) -> Tuple[int, int]:
+    '''
+    The day (ordinal) of an implicit marker, and its time (see `microseconds()`), or `DATE_TIME` for a `Date`.
+    '''
+    day = implicit_day(marker).toordinal()
+    if isinstance(marker, AbsoluteDateTime):
+        return day, microseconds(marker.abstime)
+    return day, DATE_TIME
+
+
+def implicit_period(marker: RelTimeSpecImplicit) -> Tuple[int, int]:
+    '''
+    The first and last microseconds (see `microseconds()`) of the period of an implicit marker: the instant of an `AbsoluteDateTime`, or the whole day of a `Date`.
+    '''
+    if isinstance(marker, AbsoluteDateTime):
+        time = microseconds(marker.abstime)
+        return time, time
+    start = microseconds(datetime.datetime.combine(implicit_day(marker), datetime.time()))
+    return start, start + DAY - 1
+
+
+class ImplicitIndex:
+    '''
+    Implicit markers packed into arrays of their keys (see `implicit_key()`), sorted by day then time, for comparing all of them to an anchor at once.
+    The comparisons give the same results as `RelTimeMarker.compare()`, without a call per pair. They are vectorized with NumPy when it is available (or unless `vectorized` is False), and otherwise run in plain Python over the same keys.
+    NumPy is an optional dependency: asking for `vectorized` without it raises a `ValueError`.
+    '''
+
+    def __init__(self, markers: Iterable[Union[AbsoluteDateTime, Date]], vectorized: Optional[bool]=None):
+        markers = list(markers)
+        keys = [implicit_key(marker) for marker in markers]
+        if vectorized and np is None:
+            raise ValueError('NumPy is not installed, so ImplicitIndex can not be vectorized')
+        self.vectorized = np is not None if vectorized is None else vectorized
+        self._days = None  # type: Any  # Arrays, or lists without NumPy
+        self._times = None  # type: Any
+        if self.vectorized:
+            days = np.fromiter((day for day, _ in keys), dtype=np.int64, count=len(keys))
+            times = np.fromiter((time for _, time in keys), dtype=np.int64, count=len(keys))
+            order = np.lexsort((times, days))  # Stable, thus the ties in the given order
+            self._days = days[order]
+            self._times = times[order]
+            self._ids = [markers[i].id for i in order]
+        else:
+            ranks = sorted(range(len(keys)), key=keys.__getitem__)
+            self._days = [keys[i][0] for i in ranks]
+            self._times = [keys[i][1] for i in ranks]
+            self._ids = [markers[i].id for i in ranks]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ids(self) -> List[UUID]:
+        '''
+        The ids of the markers, in time order.
+        '''
+        return list(self._ids)
+
+    def codes(self, anchor: RelTimeSpecImplicit):
+        '''
+        The relativity of each marker (in the order of `ids()`) to `anchor`, as the codes `C_*` (indices of `RELATIVITIES`).
+        '''
+        day, time = implicit_key(anchor)
+        anchor_is_date = time == DATE_TIME
+        if not self.vectorized:
+            return [_code(d, t, day, time, anchor_is_date) for d, t in zip(self._days, self._times)]
+        days, times = self._days, self._times
+        is_date = times == DATE_TIME
+        if anchor_is_date:
+            same_day = np.where(is_date, C_PARALLEL, C_SPECIALIZED)
+            same = np.where(days == day, same_day, C_AFTER)
+            return np.where(days < day, C_BEFORE, same)
+        by_day = np.where(days < day, C_BEFORE, np.where(days > day, C_AFTER, C_GENERALIZED))
+        by_time = np.where(times < time, C_BEFORE, np.where(times > time, C_AFTER, C_PARALLEL))
+        return np.where(is_date, by_day, by_time)
+
+    def compare(self, anchor: RelTimeSpecImplicit) -> List[TimeRelativity]:
+        return [RELATIVITIES[code] for code in self.codes(anchor)]
+
+    def _select(self, mask) -> List[UUID]:
+        if self.vectorized:
+            return [self._ids[i] for i in np.flatnonzero(mask)]
+        return [id for id, selected in zip(self._ids, mask) if selected]
+
+    def select(self, anchor: RelTimeSpecImplicit, relativity: TimeRelativity) -> List[UUID]:
+        '''
+        The ids of the markers with `relativity` to `anchor`, in time order.
+        '''
+        if relativity not in RELATIVITIES:  # `SAME` is only asserted between events
+            return []
+        code = RELATIVITIES.index(relativity)
+        codes = self.codes(anchor)
+        if self.vectorized:
+            return self._select(codes == code)
+        return self._select([c == code for c in codes])
+
+    def between(self, after: Optional[RelTimeSpecImplicit]=None, before: Optional[RelTimeSpecImplicit]=None) -> List[UUID]:
+        '''
+        The ids of the markers after `after` and before `before` (either may be omitted), in time order.
+        '''
+        mask = None
+        for anchor, code in ((after, C_AFTER), (before, C_BEFORE)):
+            if anchor is None:
+                continue
+            codes = self.codes(anchor)
+            if self.vectorized:
+                selected = codes == code
+                mask = selected if mask is None else mask & selected
+            else:
+                selected = [c == code for c in codes]
+                mask = selected if mask is None else [m and s for m, s in zip(mask, selected)]
+        if mask is None:
+            return self.ids()
+        return self._select(mask)
+
+
+def _code(day: int, time: int, anchor_day: int, anchor_time: int, anchor_is_date: bool) -> int:
+    if time != DATE_TIME and not anchor_is_date:
+        return C_BEFORE if time < anchor_time else C_AFTER if time > anchor_time else C_PARALLEL
+    if day != anchor_day:
+        return C_BEFORE if day < anchor_day else C_AFTER
+    if time == DATE_TIME:
+        return C_PARALLEL if anchor_is_date else C_GENERALIZED
+    return C_SPECIALIZED
+
+
+T = TypeVar('T', bound=Hashable)
+
+
+class UnionFind(Generic[T]):
+    '''
+    Disjoint sets (並查集) of ids, with iterative find, path compression and union by rank.
+    An id never seen is in its own singleton set. The members of each non-singleton set are kept as well, merging the smaller into the larger.
+    '''
+
+    def __init__(self):
+        self._parent = {}  # type: Dict[T, T]
+        self._rank = {}  # type: Dict[T, int]
+        self._members = {}  # type: Dict[T, List[T]]  # Only for the roots of non-singleton sets
+
+    def clear(self) -> None:
+        self._parent.clear()
+        self._rank.clear()
+        self._members.clear()
+
+    def find(self, x: T) -> T:
+        '''
+        The representative of the set of `x`.
+        '''
+        root = x
+        parent = self._parent.get(root, root)
+        while parent != root:
+            root = parent
+            parent = self._parent.get(root, root)
+        while x != root:  # Path compression
+            self._parent[x], x = root, self._parent[x]
+        return root
+
+    def union(self, x: T, y: T) -> T:
+        '''
+        Merge the sets of `x` and `y`, and return the representative of the merged set.
+        '''
+        rx = self.find(x)
+        ry = self.find(y)
+        if rx == ry:
+            return rx
+        if self._rank.get(rx, 0) < self._rank.get(ry, 0):
+            rx, ry = ry, rx
+        elif self._rank.get(rx, 0) == self._rank.get(ry, 0):
+            self._rank[rx] = self._rank.get(rx, 0) + 1
+        self._parent[ry] = rx
+        self._rank.pop(ry, None)
+        members_x = self._members.pop(rx, None) or [rx]
+        members_y = self._members.pop(ry, None) or [ry]
+        if len(members_x) < len(members_y):
+            members_x, members_y = members_y, members_x
+        members_x.extend(members_y)
+        self._members[rx] = members_x
+        return rx
+
+    def group(self, x: T) -> Set[T]:
+        '''
+        The members of the set of `x`.
+        '''
+        root = self.find(x)
+        return set(self._members.get(root, [root]))
+
+    def groups(self) -> Iterator[Set[T]]:
+        '''
+        Generate all the non-singleton sets.
+        '''
+        for members in self._members.values():
+            yield set(members)
+
+
+class DynamicTopologicalOrder:
+    '''
+    A topological order of a DAG, maintained when edges are inserted (Pearce & Kelly, "A dynamic topological sort algorithm for directed acyclic graphs", 2006).
+    An insertion only visits the nodes between the two ends of the edge in the current order, which is sub-linear in amortized time; a cycle is found at the same time.
+    Removing an edge keeps the order valid, so nothing is needed then.
+    '''
+
+    def __init__(self, g: nx.DiGraph):
+        self._g = g
+        self._ord = {node: i for i, node in enumerate(nx.topological_sort(g))}  # type: Dict[Hashable, int]
+        self._next = len(self._ord)
+        self._first = 0
+
+    def _position(self, node: Hashable) -> int:
+        if node not in self._ord:
+            self._ord[node] = self._next
+            self._next += 1
+        return self._ord[node]
+
+    def _forward(self, start: Hashable, target: Hashable) -> Tuple[Optional[List[Hashable]], List[Hashable]]:
+        '''
+        Search forward from `start`, among the nodes before `target` in the order.
+        Return the path to `target` if it is reached, and the nodes visited.
+        '''
+        upper = self._ord[target]
+        parents = {start: start}  # type: Dict[Hashable, Hashable]
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for succ in self._g.successors(node):
+                if succ == target:
+                    path = [target, node]
+                    while path[-1] != start:
+                        path.append(parents[path[-1]])
+                    return path[::-1], list(parents)
+                if succ not in parents and self._ord[succ] < upper:
+                    parents[succ] = node
+                    stack.append(succ)
+        return None, list(parents)
+
+    def find_path(self, u: Hashable, v: Hashable) -> Optional[List[Hashable]]:
+        '''
+        Find a path from `u` to `v`, only searching the nodes between them in the order.
+        '''
+        if u == v:
+            return [u]
+        if u not in self._ord or v not in self._ord or self._ord[u] > self._ord[v]:  # A node without position has no edge
+            return None
+        return self._forward(u, v)[0]
+
+    def insert(self, u: Hashable, v: Hashable) -> Optional[List[Hashable]]:
+        '''
+        Update the order for the edge `u -> v`, which is going to be added to the graph.
+        If the edge would form a cycle, the order is left untouched and the cycle is returned (as a list of nodes, starting with `u`).
+        '''
+        if u == v:
+            return [u]
+        if u not in self._ord:  # A new node can go first
+            self._first -= 1
+            self._ord[u] = self._first
+        lower = self._position(v)
+        if lower > self._ord[u]:
+            return None
+        # Forward search from `v`, among the nodes not after `u`
+        path, forward = self._forward(v, u)
+        if path:
+            return [u] + path[:-1]
+        # Backward search from `u`, among the nodes not before `v`
+        visited = {u}
+        stack = [u]
+        while stack:
+            node = stack.pop()
+            for pred in self._g.predecessors(node):
+                if pred not in visited and self._ord[pred] > lower:
+                    visited.add(pred)
+                    stack.append(pred)
+        backward = list(visited)
+        # Reassign the positions of the affected nodes: the backward ones go before the forward ones
+        forward.sort(key=self._ord.__getitem__)
+        backward.sort(key=self._ord.__getitem__)
+        positions = sorted(self._ord[node] for node in itertools.chain(forward, backward))
+        for node, position in zip(itertools.chain(backward, forward), positions):
+            self._ord[node] = position
+        return None
+
+    def discard(self, node: Hashable) -> None:
+        '''
+        Forget a node removed from the graph.
+        '''
+        self._ord.pop(node, None)
+
+    def key(self, node: Hashable) -> int:
+        '''
+        The position of the node in the order.
+        '''
+        return self._position(node)
+
+
+def conflict_groups(g: nx.DiGraph) -> Iterator[Set[Hashable]]:
+    '''
+    Generate the groups of conflicting nodes, i.e. the strongly connected components which contain a cycle.
+    '''
+    for component in nx.strongly_connected_components(g):
+        if len(component) > 1:
+            yield component
+        else:
+            node = next(iter(component))
+            if g.has_edge(node, node):
+                yield component
+
+
+class ConflictReport:
+    '''
+    The conflicts in an ordering graph, reported as conflict groups (strongly connected components), which takes linear time.
+    The (possibly exponentially many) cycles inside the groups are only enumerated lazily, as witnesses, and up to a limit.
+    The report is only valid until the graph is changed.
+    '''
+
+    def __init__(self, g: nx.DiGraph, groups: Optional[List[Set[Hashable]]]=None):
+        self._g = g
+        self.groups = list(conflict_groups(g)) if groups is None else groups
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def cycles(self, limit: Optional[int]=None, per_group: Optional[int]=None) -> Iterator[List[Hashable]]:
+        '''
+        Generate witness cycles of the conflict groups: at most `per_group` cycles for each group, and `limit` cycles in total.
+        '''
+        def witnesses():
+            for group in self.groups:
+                yield from itertools.islice(nx.simple_cycles(self._g.subgraph(group)), per_group)
+        return itertools.islice(witnesses(), limit)
+
+
+def _contract(g: nx.DiGraph, node_key: Callable[[Hashable], Any], groups: Optional[List[Set[Hashable]]]=None) -> Tuple[Dict[Hashable, int], List[List[Hashable]], List[List[int]], List[List[int]]]:
+    '''
+    Contract the conflict groups of the graph (computed if not given), which gives a DAG of components, numbered.
+    Return the component of each node, the nodes of each component (sorted by `node_key`), and the successors and predecessors of each component.
+    '''
+    if groups is None:
+        groups = list(conflict_groups(g))
+    component = {}  # type: Dict[Hashable, int]
+    members = []  # type: List[List[Hashable]]
+    for group in groups:
+        for node in group:
+            component[node] = len(members)
+        members.append(sorted(group, key=node_key))
+    for node in g:
+        if node not in component:
+            component[node] = len(members)
+            members.append([node])
+    succs = [[] for _ in members]  # type: List[List[int]]
+    preds = [[] for _ in members]  # type: List[List[int]]
+    for u, neighbours in g.adj.items():
+        cu = component[u]
+        for v in neighbours:
+            cv = component[v]
+            if cu != cv:
+                succs[cu].append(cv)
+                preds[cv].append(cu)
+    return component, members, succs, preds
+
+
+def _linearize(members: List[List[Hashable]], succs: List[List[int]], preds: List[List[int]], node_key: Callable[[Hashable], Any]) -> List[int]:
+    '''
+    Linearize the components (Kahn's algorithm), taking the one with the lowest key among the ready ones.
+    '''
+    degree = [len(p) for p in preds]
+    ready = [(node_key(members[c][0]), c) for c in range(len(members)) if not degree[c]]
+    heapq.heapify(ready)
+    order = []  # type: List[int]
+    while ready:
+        _, c = heapq.heappop(ready)
+        order.append(c)
+        for succ in succs[c]:
+            degree[succ] -= 1
+            if not degree[succ]:
+                heapq.heappush(ready, (node_key(members[succ][0]), succ))
+    return order
+
+
+def _interval_labels(succs: List[List[int]], roots: Iterable[int], n: int) -> Tuple[List[int], List[int], List[int]]:
+    '''
+    Label the nodes of a DAG by a depth-first traversal (Yildirim et al., "GRAIL: scalable reachability index for large graphs", 2010): `post` is the post-order rank of a node, `start` the lowest rank in its subtree of the traversal, and `low` the lowest rank among the nodes it reaches.
+    If `u` reaches `v`, then `low[u] <= low[v]` and `post[v] <= post[u]`; if `start[u] <= post[v] <= post[u]`, then `u` reaches `v` (through the traversal tree).
+    '''
+    post = [-1] * n
+    start = [0] * n
+    low = [0] * n
+    rank = 0
+    for root in roots:
+        if post[root] >= 0:
+            continue
+        start[root] = low[root] = rank
+        post[root] = -2  # Visiting
+        stack = [(root, iter(succs[root]))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if post[child] == -1:
+                    start[child] = low[child] = rank
+                    post[child] = -2
+                    stack.append((child, iter(succs[child])))
+                    break
+                low[node] = min(low[node], low[child])  # Already finished, as there is no cycle
+            else:
+                stack.pop()
+                post[node] = rank
+                rank += 1
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+    return post, start, low
+
+
+class Timeline:
+    '''
+    Queries on the order given by an ordering graph, answered from labels computed once in O((n + m) log n):
+    - a linearization (topological order), whose ties are broken by `key` (then by the order of the nodes in the graph), so that it is stable;
+    - pairwise comparisons, answered in O(1) by the topological positions and two interval labelings of the graph for most pairs, and otherwise by a search pruned by them;
+    - the nodes between two anchors.
+    The nodes of a conflict group (strongly connected component) are contracted into one position, thus they are not ordered between themselves.
+    The timeline is only valid until the graph is changed.
+    '''
+
+    def __init__(self, g: nx.DiGraph, key: Optional[Callable[[Hashable], Any]]=None, groups: Optional[List[Set[Hashable]]]=None):
+        '''
+        `groups` are the conflict groups of the graph, if already known (see `ConflictReport`).
+        '''
+        index = {node: i for i, node in enumerate(g)}  # type: Dict[Hashable, int]
+        if key is None:
+            node_key = index.__getitem__  # type: Callable[[Hashable], Any]
+        else:
+            node_key = lambda node: (key(node), index[node])  # noqa: E731
+        self._component, members, succs, preds = _contract(g, node_key, groups)
+        n = len(members)
+        order = _linearize(members, succs, preds, node_key)
+        self._pos = [0] * n
+        for i, c in enumerate(order):
+            self._pos[c] = i
+        self._order = order
+        self._members = members
+        self._succs = succs
+        self._preds = preds
+        roots = [c for c in order if not preds[c]]
+        self._labels = [
+                _interval_labels(succs, roots, n),
+                _interval_labels([children[::-1] for children in succs], roots[::-1], n),
+                ]
+
+    def nodes(self) -> List[Hashable]:
+        '''
+        The nodes in the linear order.
+        '''
+        return [node for c in self._order for node in self._members[c]]
+
+    def position(self, node: Hashable) -> int:
+        '''
+        The position of the node in the linear order of the components: a node is only before the nodes at higher positions (but not necessarily all of them).
+        '''
+        return self._pos[self._component[node]]
+
+    def _reaches(self, cu: int, cv: int) -> bool:
+        '''
+        Test if the component `cu` reaches the component `cv`.
+        '''
+        if cu == cv:
+            return True
+        pos = self._pos
+        if pos[cu] > pos[cv]:
+            return False
+        for post, start, low in self._labels:
+            if post[cv] > post[cu] or low[cv] < low[cu]:
+                return False
+        for post, start, low in self._labels:
+            if start[cu] <= post[cv] <= post[cu]:
+                return True
+        # Undecided by the labels: search from `cu`, skipping the nodes which can't reach `cv`
+        visited = {cu}
+        stack = [cu]
+        while stack:
+            c = stack.pop()
+            for succ in self._succs[c]:
+                if succ == cv:
+                    return True
+                if succ in visited or pos[succ] > pos[cv]:
+                    continue
+                visited.add(succ)
+                if all(post[cv] <= post[succ] and low[cv] >= low[succ] for post, _, low in self._labels):
+                    stack.append(succ)
+        return False
+
+    def is_before(self, u: Hashable, v: Hashable) -> bool:
+        '''
+        Test if the node `u` is (transitively) before the node `v`, and not in a conflict with it.
+        '''
+        cu = self._component[u]
+        cv = self._component[v]
+        return cu != cv and self._reaches(cu, cv)
+
+    def compare(self, u: Hashable, v: Hashable) -> TimeRelativity:
+        '''
+        The relativity of the node `u` to the node `v`: `SAME` for the same node, `BEFORE` or `AFTER` if they are ordered, and `PARALLEL` otherwise (including when they are in a conflict).
+        '''
+        if u == v:
+            return TimeRelativity.SAME
+        if self.is_before(u, v):
+            return TimeRelativity.BEFORE
+        if self.is_before(v, u):
+            return TimeRelativity.AFTER
+        return TimeRelativity.PARALLEL
+
+    def _window(self, start: int, neighbours: List[List[int]], lower: int, upper: int) -> Set[int]:
+        '''
+        The components reached from `start` through `neighbours`, among the ones at positions strictly between `lower` and `upper`.
+        '''
+        pos = self._pos
+        found = set()  # type: Set[int]
+        stack = [start]
+        while stack:
+            c = stack.pop()
+            for neighbour in neighbours[c]:
+                if neighbour not in found and lower < pos[neighbour] < upper:
+                    found.add(neighbour)
+                    stack.append(neighbour)
+        return found
+
+    def between(self, after: Optional[Hashable]=None, before: Optional[Hashable]=None) -> List[Hashable]:
+        '''
+        The nodes after the node `after` and before the node `before` (either may be omitted), in the linear order.
+        Only the part of the graph between the two anchors in the linear order is visited.
+        '''
+        lower, upper = -1, len(self._order)
+        cu = cv = None  # type: Optional[int]
+        if after is not None:
+            cu = self._component[after]
+            lower = self._pos[cu]
+        if before is not None:
+            cv = self._component[before]
+            upper = self._pos[cv]
+        if cu is not None and cv is not None:
+            if not self._reaches(cu, cv):
+                return []
+            found = self._window(cu, self._succs, lower, upper) & self._window(cv, self._preds, lower, upper)
+        elif cu is not None:
+            found = self._window(cu, self._succs, lower, upper)
+        elif cv is not None:
+            found = self._window(cv, self._preds, lower, upper)
+        else:
+            found = set(self._order)
+        return [node for c in sorted(found, key=self._pos.__getitem__) for node in self._members[c]]
+
+
+INF = float('inf')
+Period = Tuple[float, float]  # The first and last microseconds of a period, infinite if unknown
+UNKNOWN = (-INF, INF)
+
+
+class Bounds:
+    '''
+    The earliest and latest times of the nodes of an ordering graph (`lower` and `upper`, as in `Period`), inferred from the periods known for some of them (`own`, e.g. for the implicit markers): a node is after the lower bounds of its predecessors, and before the upper bounds of its successors.
+    They are computed by a forward and a backward sweep in topological order. Then, once the nodes whose edges or periods changed are `touch()`ed, `update()` only visits the nodes whose bounds change.
+    The nodes of a conflict group share their bounds; while there is a conflict, all the bounds are computed again at each update.
+    '''
+
+    def __init__(self, g: nx.DiGraph, own: Callable[[Any], Period]):
+        self._g = g
+        self._own = own
+        self.lower = {}  # type: Dict[Hashable, float]
+        self.upper = {}  # type: Dict[Hashable, float]
+        self._dirty = set()  # type: Set[Hashable]
+        self._stale = True  # If all of them are to be computed
+
+    def touch(self, node: Hashable) -> None:
+        '''
+        Mark the node as changed (its edges or period), or removed from the graph.
+        '''
+        if not self._stale:
+            self._dirty.add(node)
+
+    def reset(self) -> None:
+        '''
+        Mark all the nodes as changed.
+        '''
+        self._stale = True
+        self._dirty.clear()
+
+    def period(self, node: Hashable) -> Period:
+        return self.lower.get(node, -INF), self.upper.get(node, INF)
+
+    def update(self, key: Optional[Callable[[Hashable], int]]=None, groups: Optional[List[Set[Hashable]]]=None) -> None:
+        '''
+        Bring the bounds up to date with the graph.
+        `key` gives the positions of the nodes in a topological order, if the graph is acyclic; otherwise, its conflict `groups` are contracted (they are computed if not given).
+        '''
+        if key is None:
+            if self._stale or self._dirty:
+                self._sweep(groups)
+        elif self._stale:
+            self._sweep([])
+        elif self._dirty:
+            self._propagate(key)
+        self._dirty.clear()
+        self._stale = False
+
+    def _sweep(self, groups: Optional[List[Set[Hashable]]]) -> None:
+        g = self._g
+        index = {node: i for i, node in enumerate(g)}  # type: Dict[Hashable, int]
+        component, members, succs, preds = _contract(g, index.__getitem__, groups)
+        order = _linearize(members, succs, preds, index.__getitem__)
+        lower = [-INF] * len(members)
+        upper = [INF] * len(members)
+        for c, nodes in enumerate(members):
+            for node in nodes:
+                first, last = self._own(node)
+                lower[c] = max(lower[c], first)
+                upper[c] = min(upper[c], last)
+        for c in order:
+            for pred in preds[c]:
+                lower[c] = max(lower[c], lower[pred])
+        for c in reversed(order):
+            for succ in succs[c]:
+                upper[c] = min(upper[c], upper[succ])
+        self.lower = {node: lower[c] for node, c in component.items()}
+        self.upper = {node: upper[c] for node, c in component.items()}
+
+    def _propagate(self, key: Callable[[Hashable], int]) -> None:
+        '''
+        Compute the bounds of the changed nodes again, and go on with their successors (predecessors) while the lower (upper) bounds change, in topological order.
+        '''
+        g = self._g
+        dirty = []
+        for node in self._dirty:
+            if node in g:
+                dirty.append(node)
+            else:
+                self.lower.pop(node, None)
+                self.upper.pop(node, None)
+        for bounds, neighbours, sources, better, sign in (
+                (self.lower, g.successors, g.predecessors, max, 1),
+                (self.upper, g.predecessors, g.successors, min, -1),
+                ):
+            queue = [(sign * key(node), node) for node in dirty]
+            heapq.heapify(queue)
+            queued = set(dirty)
+            while queue:
+                _, node = heapq.heappop(queue)
+                queued.discard(node)
+                value = self._own(node)[0 if sign > 0 else 1]
+                for source in sources(node):
+                    value = better(value, bounds.get(source, value))
+                if bounds.get(node) == value:
+                    continue
+                bounds[node] = value
+                for neighbour in neighbours(node):
+                    if neighbour not in queued:
+                        queued.add(neighbour)
+                        heapq.heappush(queue, (sign * key(neighbour), neighbour))
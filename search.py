@@ -0,0 +1,240 @@
+# -*- coding:utf-8 -*-
+
+'''
+Full-text search over the titles and descriptions of the events, with an inverted index maintained along the collection.
+'''
+
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from uuid import UUID
+
+from model import (
+        Event,
+        RelTimeMarker,
+        )
+
+
+FORMAT = 1
+TITLE_WEIGHT = 3  # A term in the title counts as many times in the description
+PREFIX_FACTOR = 0.5  # Relative score of a term only matched as the prefix of another
+MAX_EXPANSIONS = 64  # Terms a prefix is expanded to, at most
+DEFAULT_LIMIT = 20
+
+K_FORMAT = 'format'
+K_STAMP = 'stamp'
+K_SEQ = 'seq'
+K_IDS = 'ids'
+K_TERMS = 'terms'
+
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'  # Kana, CJK ideographs and Hangul
+TOKEN = re.compile('[{0}]|[^\\W_{0}]+'.format(CJK))  # A CJK character (as they are not separated by spaces), or a word
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    '''
+    The (case-folded) terms of the text.
+    '''
+    return TOKEN.findall(text.casefold()) if text else []
+
+
+class SearchIndex:
+    '''
+    An inverted index of the terms of the events: each term maps to the events it is in (by number), with its weight (see `TITLE_WEIGHT`).
+    It is kept up to date as an observer of the collection (`record()`), and can be dumped to and loaded from a file, tagged by the caller (e.g. with the snapshot it goes with).
+    A query matches the events having all its terms; a term ending with `*` is a prefix, matching the terms starting with it.
+    The events are ranked by the sum over the query terms of their weight (logarithmically) times their inverse document frequency.
+    '''
+
+    def __init__(self):
+        self._ids = []  # type: List[Optional[str]]  # The ids of the events by number; None once removed
+        self._numbers = {}  # type: Dict[str, int]
+        self._terms = []  # type: List[Tuple[str, ...]]  # The terms of the events by number, to remove them
+        self._postings = {}  # type: Dict[str, Dict[int, int]]
+        self._sorted = None  # type: Optional[List[str]]  # The terms sorted, for the prefixes; built on the first use
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @classmethod
+    def of(cls, items: Iterable[RelTimeMarker]) -> 'SearchIndex':
+        index = cls()
+        for item in items:
+            if isinstance(item, Event):
+                index.put(item.id, item.title, item.desc)
+        return index
+
+    def record(self, op: str, item: RelTimeMarker) -> None:
+        '''
+        Index the item added or updated (see `Collection.add_observer()`).
+        '''
+        if isinstance(item, Event):
+            self.put(item.id, item.title, item.desc)
+
+    def put(self, id: UUID, title: Optional[str], desc: Optional[str]) -> None:
+        '''
+        Index (again) the event `id`.
+        '''
+        key = str(id)
+        weights = {}  # type: Dict[str, int]
+        for term in tokenize(title):
+            weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+        for term in tokenize(desc):
+            weights[term] = weights.get(term, 0) + 1
+        number = self._numbers.get(key)
+        if number is None:
+            number = self._numbers[key] = len(self._ids)
+            self._ids.append(key)
+            self._terms.append(())
+            self._count += 1
+        else:
+            self._unindex(number)
+        for term, weight in weights.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = {}
+                if self._sorted is not None:
+                    bisect.insort(self._sorted, term)
+            posting[number] = weight
+        self._terms[number] = tuple(weights)
+
+    def remove(self, id: UUID) -> None:
+        number = self._numbers.pop(str(id), None)
+        if number is None:
+            return
+        self._unindex(number)
+        self._ids[number] = None
+        self._terms[number] = ()
+        self._count -= 1
+
+    def _unindex(self, number: int) -> None:
+        for term in self._terms[number]:
+            posting = self._postings[term]
+            del posting[number]
+            if not posting:
+                del self._postings[term]
+                if self._sorted is not None:
+                    del self._sorted[bisect.bisect_left(self._sorted, term)]
+
+    def _expand(self, prefix: str) -> List[str]:
+        if self._sorted is None:
+            self._sorted = sorted(self._postings)
+        i = bisect.bisect_left(self._sorted, prefix)
+        terms = []  # type: List[str]
+        while i < len(self._sorted) and len(terms) < MAX_EXPANSIONS and self._sorted[i].startswith(prefix):
+            terms.append(self._sorted[i])
+            i += 1
+        return terms
+
+    def _postings_of(self, token: str, prefix: bool) -> List[Tuple[Dict[int, int], float]]:
+        '''
+        The postings of the terms matching the query term, with their inverse document frequency.
+        '''
+        terms = [token] if token in self._postings else []
+        if prefix:
+            terms += [term for term in self._expand(token) if term != token]
+        ret = []
+        for term in terms:
+            posting = self._postings[term]
+            idf = math.log(1 + self._count / len(posting))
+            ret.append((posting, idf if term == token else idf * PREFIX_FACTOR))
+        return ret
+
+    def search(self, query: str, limit: Optional[int]=DEFAULT_LIMIT) -> List[Tuple[UUID, float]]:
+        '''
+        The ids of the events matching the query, with their scores, best first: at most `limit` of them.
+        Only the events of the rarest query term are visited, and looked up in the postings of the others.
+        '''
+        tokens = set()  # type: Set[Tuple[str, bool]]
+        for word in query.split():
+            prefix = word.endswith('*')
+            terms = tokenize(word)
+            for i, term in enumerate(terms):
+                tokens.add((term, prefix and i == len(terms) - 1))
+        if not tokens:
+            return []
+        matches = sorted((self._postings_of(token, prefix) for token, prefix in tokens), key=lambda postings: sum(len(posting) for posting, _ in postings))
+        scores = {}  # type: Dict[int, float]
+        for posting, idf in matches[0]:
+            for number, weight in posting.items():
+                score = idf * (1 + math.log(weight))
+                if score > scores.get(number, 0):
+                    scores[number] = score
+        for postings in matches[1:]:
+            narrowed = {}  # type: Dict[int, float]
+            for number, total in scores.items():
+                found = 0.0
+                for posting, idf in postings:
+                    other = posting.get(number)
+                    if other is not None:
+                        found = max(found, idf * (1 + math.log(other)))
+                if found:
+                    narrowed[number] = total + found
+            scores = narrowed
+        if limit is None:
+            best = sorted(scores.items(), key=lambda match: (-match[1], match[0]))
+        else:
+            best = heapq.nsmallest(limit, scores.items(), key=lambda match: (-match[1], match[0]))
+        ret = []
+        for number, score in best:
+            id = self._ids[number]
+            assert id is not None
+            ret.append((UUID(id), score))
+        return ret
+
+    def dump(self, path, stamp, seq: int) -> None:
+        '''
+        Write the index (atomically, through a temporary file), tagged with `stamp` and `seq`.
+        The numbers of the removed events are reclaimed.
+        '''
+        numbers = {}  # type: Dict[int, int]
+        ids = []  # type: List[str]
+        for number, id in enumerate(self._ids):
+            if id is not None:
+                numbers[number] = len(ids)
+                ids.append(id)
+        terms = {}  # type: Dict[str, List[int]]
+        for term, posting in self._postings.items():
+            flat = []  # type: List[int]
+            for number, weight in posting.items():
+                flat.append(numbers[number])
+                flat.append(weight)
+            terms[term] = flat
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({K_FORMAT: FORMAT, K_STAMP: stamp, K_SEQ: seq, K_IDS: ids, K_TERMS: terms}, ensure_ascii=False))  # Not `json.dump()`, which doesn't use the C encoder
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, stamp) -> Optional[Tuple['SearchIndex', int]]:
+        '''
+        Read the index written by `dump()`, with its `seq`, or None if it is missing, unreadable or not tagged with `stamp`.
+        '''
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                dic = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if dic.get(K_FORMAT) != FORMAT or dic.get(K_STAMP) != stamp:
+            return None
+        index = cls()
+        ids = dic[K_IDS]
+        index._ids = ids
+        index._numbers = {id: number for number, id in enumerate(ids)}
+        index._count = len(index._ids)
+        terms = [[] for _ in index._ids]  # type: List[List[str]]
+        for term, flat in dic[K_TERMS].items():
+            numbers = flat[::2]
+            index._postings[term] = dict(zip(numbers, flat[1::2]))
+            for number in numbers:
+                terms[number].append(term)
+        index._terms = [tuple(t) for t in terms]
+        return index, dic[K_SEQ]
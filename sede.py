@@ -10,8 +10,10 @@
 SErialize and DEserialize
 '''
 
+import base64
 import datetime
 
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
 from uuid import UUID
 
 from model import (
@@ -34,25 +36,70 @@ K_DATETIME = 'datetime'
 K_DATE = 'date'
 
 
-DATETIME_REPR = r'%Y-%m-%dT%H:%M:%S[%Z]'
-DATE_REPR = r'%Y-%m-%d[%Z]'
+DATETIME_REPR = r'%Y-%m-%dT%H:%M:%S[%Z]'  # Legacy, only read
+DATE_REPR = r'%Y-%m-%d[%Z]'  # Legacy, only read
 
 
-def serialise_reltimespec(obj) -> dict:
+def encode_id(id: UUID, compact: bool=False) -> str:
+    '''
+    Encode an id as its canonical string, or (if `compact`) as the URL-safe base64 of its 16 bytes (22 characters).
+    '''
+    if compact:
+        return base64.urlsafe_b64encode(id.bytes)[:22].decode('ascii')
+    return str(id)
+
+def decode_id(s: str) -> UUID:
+    if len(s) == 22:
+        return UUID(bytes=base64.urlsafe_b64decode(s + '=='))
+    return UUID(s)
+
+
+class IdTable:
+    '''
+    Decode ids, returning the same `UUID` object for the same string.
+    Sharing one table when deserializing many entries avoids decoding the ids referred to many times again, and keeps one copy of each in memory.
+    '''
+
+    def __init__(self):
+        self._ids = {}  # type: Dict[str, UUID]
+
+    def __call__(self, s: str) -> UUID:
+        id = self._ids.get(s)
+        if id is None:
+            id = self._ids[s] = decode_id(s)
+        return id
+
+
+def _strip_legacy_zone(s: str) -> str:
+    '''
+    Remove the `[%Z]` suffix of the legacy representations. The zone is dropped, as `strptime()` did.
+    '''
+    i = s.find('[')
+    return s[:i] if i >= 0 else s
+
+def parse_datetime(s: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(_strip_legacy_zone(s))
+
+def parse_date(s: str) -> datetime.date:
+    return datetime.date.fromisoformat(_strip_legacy_zone(s))
+
+
+def serialise_reltimespec(obj, compact: bool=False) -> dict:
     ret = {}
     if obj.befores:
-        ret[K_BEFORE] = [str(item) for item in obj.befores]
+        ret[K_BEFORE] = [encode_id(item, compact) for item in obj.befores]
     if obj.afters:
-        ret[K_AFTER] = [str(item) for item in obj.afters]
+        ret[K_AFTER] = [encode_id(item, compact) for item in obj.afters]
     if obj.sames:
-        ret[K_SAME] = [str(item) for item in obj.sames]
+        ret[K_SAME] = [encode_id(item, compact) for item in obj.sames]
     return ret
 
-def deserialise_reltimespec(dic) -> RelTimeSpec:
+def deserialise_reltimespec(dic, ids: Optional[Callable[[str], UUID]]=None) -> RelTimeSpec:
     if dic is None:  # Compatibility. Will be removed
         return RelTimeSpec()
+    decode = ids or decode_id
     def uuidfy(items):
-        return [UUID(item) for item in items] if items is not None else None
+        return [decode(item) for item in items] if items is not None else None
     befores = uuidfy(dic.get(K_BEFORE, None))
     afters = uuidfy(dic.get(K_AFTER, None))
     sames = uuidfy(dic.get(K_SAME, None))
@@ -64,47 +111,56 @@ def deserialise_reltimespec(dic) -> RelTimeSpec:
     #     return RelTimeSpec(same=same)
 
 
-def deserialise_event(dic) -> Event:
-    id = UUID(dic[K_ID])
+def deserialise_event(dic, ids: Optional[Callable[[str], UUID]]=None) -> Event:
+    id = (ids or decode_id)(dic[K_ID])
     title = dic[K_TITLE]
     desc = dic.get(K_DESC, None)
     timespec_se = dic.get(K_TIMESPEC, None)
-    timespec = deserialise_reltimespec(timespec_se)
+    timespec = deserialise_reltimespec(timespec_se, ids)
     return Event(id=id, title=title, desc=desc, timespec=timespec)
 
-def serialise_event(obj) -> dict:
+def serialise_event(obj, compact: bool=False) -> dict:
     ret = {
-            K_ID: str(obj.id),
+            K_ID: encode_id(obj.id, compact),
             K_TITLE: obj.title,
             }
     if obj.desc:
         ret[K_DESC] = obj.desc
     if obj.timespec:
-        ret[K_TIMESPEC] = serialise_reltimespec(obj.timespec)
+        ret[K_TIMESPEC] = serialise_reltimespec(obj.timespec, compact)
     return ret
 
 
-def deserialize_absolutedatetime(dic) -> AbsoluteDateTime:
-    id = UUID(dic[K_ID])
-    time = datetime.datetime.strptime(dic[K_DATETIME], DATETIME_REPR)
+def deserialize_absolutedatetime(dic, ids: Optional[Callable[[str], UUID]]=None) -> AbsoluteDateTime:
+    id = (ids or decode_id)(dic[K_ID])
+    time = parse_datetime(dic[K_DATETIME])
     return AbsoluteDateTime(id, time)
 
-def serialize_absolutedatetime(obj: AbsoluteDateTime) -> dict:
+def serialize_absolutedatetime(obj: AbsoluteDateTime, compact: bool=False) -> dict:
     ret = {
-            K_ID: str(obj.id),
-            K_DATETIME: obj.abstime.strftime(DATETIME_REPR),
+            K_ID: encode_id(obj.id, compact),
+            K_DATETIME: obj.abstime.isoformat(),
             }
     return ret
 
 
-def deserialize_date(dic) -> Date:
-    id = UUID(dic[K_ID])
-    date = datetime.datetime.strptime(dic[K_DATE], DATE_REPR)
+def deserialize_date(dic, ids: Optional[Callable[[str], UUID]]=None) -> Date:
+    id = (ids or decode_id)(dic[K_ID])
+    date = parse_date(dic[K_DATE])
     return Date(id, date)
 
-def serialize_date(obj: Date) -> dict:
+def serialize_date(obj: Date, compact: bool=False) -> dict:
+    date = obj.date.date() if isinstance(obj.date, datetime.datetime) else obj.date
     ret = {
-            K_ID: str(obj.id),
-            K_DATE: obj.date.strftime(DATE_REPR),
+            K_ID: encode_id(obj.id, compact),
+            K_DATE: date.isoformat(),
             }
     return ret
+
+
+def deserialize_batch(entries: Iterable[Tuple[str, dict]], deserializers: Mapping[str, Callable]) -> List:
+    '''
+    Deserialize many (type, data) entries at once, with the deserializer of each type, sharing one `IdTable`.
+    '''
+    ids = IdTable()
+    return [deserializers[t](data, ids) for t, data in entries]
@@ -0,0 +1,773 @@
+# -*- coding:utf-8 -*-
+
+'''
+Sharded storage, for collections too large to be loaded and written as one file.
+The markers are split into shards (each an `InfoRecDB`), by id prefix or by namespace, which are opened and written independently.
+A `ReferenceIndex` shared by the shards keeps what is needed about the others, so that checking the self-containment and the conflicts spanning several shards does not load them all.
+'''
+
+import bisect
+import json
+import networkx as nx
+import os
+import pathlib
+import re
+
+from typing import Callable, Dict, FrozenSet, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
+from uuid import UUID
+
+from concurrency import FileLock
+from exception import (
+        ConflictError,
+        IllegalStateError,
+        )
+from model import (
+        Event,
+        RelTimeMarker,
+        )
+from ordering import (
+        INF,
+        ConflictReport,
+        UnionFind,
+        conflict_groups,
+        )
+from storage import (
+        K_SEQ,
+        LOCK_FILE,
+        OP_ADD,
+        OP_UPDATE,
+        Collection,
+        InfoRecDB,
+        MarkerTimeline,
+        Memo,
+        OrderedMarkers,
+        _fsync_dir,
+        )
+
+
+SHARDS_FILE = 'shards.json'
+SHARDS_DIR = 'shards'
+REFS_FILE = 'refs.json'
+REFS_JOURNAL_FILE = 'refs.jsonl'
+REFS_COMPACT_THRESHOLD = 1000  # Number of lines of the index journal triggering a compaction
+
+BY_PREFIX = 'prefix'
+BY_NAMESPACE = 'namespace'
+SCHEMES = (BY_PREFIX, BY_NAMESPACE)
+DEFAULT_PREFIX_LENGTH = 1
+MAX_PREFIX_LENGTH = 3
+DEFAULT_NAMESPACE = 'default'
+NAMESPACE = re.compile('^[A-Za-z0-9_-]+$')
+
+FORMAT = 1
+K_FORMAT = 'format'
+K_SCHEME = 'scheme'
+K_PREFIX_LENGTH = 'prefix_length'
+K_BINARY = 'binary'
+K_SHARDS = 'shards'
+K_SHARD = 'shard'
+K_SUMMARY = 'summary'
+K_IDS = 'ids'
+K_RESET = 'reset'
+K_EXTERNAL = 'external'
+K_PORTS = 'ports'
+K_ACYCLIC = 'acyclic'
+K_NODES = 'nodes'
+K_EDGES = 'edges'
+K_ADDED = 'added'
+K_REMOVED = 'removed'
+K_LOWER = 'lower'
+K_UPPER = 'upper'
+
+T = TypeVar('T')
+
+References = Dict[UUID, Dict[str, Set[UUID]]]  # Referred id -> relation -> ids of the events referring to it
+
+
+def _reachable(neighbors: Callable[[T], Iterable[T]], nodes: Iterable[T]) -> Set[T]:
+    '''
+    The nodes reachable from `nodes` (included), following `neighbors`.
+    '''
+    seen = set(nodes)
+    stack = list(seen)
+    while stack:
+        for neighbor in neighbors(stack.pop()):
+            if neighbor not in seen:
+                seen.add(neighbor)
+                stack.append(neighbor)
+    return seen
+
+
+def _triples(external: References) -> Set[Tuple[UUID, str, UUID]]:
+    return {(target, kind, id) for target, by_kind in external.items() for kind, ids in by_kind.items() for id in ids}
+
+
+class ShardSummary:
+    '''
+    What the other shards need to know about a shard, kept in the `ReferenceIndex` so that they don't have to open it:
+    - `external`: its references to the ids it doesn't have (as in `Collection.referrers()`);
+    - `ports`: the ids it shares with the other shards, i.e. the ones it refers to without having them, and the ones it has which the others refer to;
+    - if its ordering is `acyclic`, the part of it between the ports: the ports merged by `same` (`nodes`, to the port standing for them), the edges between the nodes reachable from a port and reaching one (`edges`, the other nodes being keyed by an id of theirs), and the earliest and latest times of the ports inferred from its implicit markers (`lower` and `upper`, see `Bounds`), which is how the implicit markers of different shards are ordered.
+    `seq` is the sequence number of the last change of the shard it was computed at.
+    It is written to the index as the changes from the previous one (see `diff()`), so that a change of a shard only writes what it changed in the summary.
+    '''
+
+    def __init__(self, seq: int=0, external: Optional[References]=None, ports: Optional[Set[UUID]]=None):
+        self.seq = seq
+        self.external = external or {}  # type: References
+        self.ports = ports or set()  # type: Set[UUID]
+        self.acyclic = True
+        self.nodes = {}  # type: Dict[UUID, UUID]
+        self.edges = set()  # type: Set[Tuple[UUID, UUID]]
+        self.lower = {}  # type: Dict[UUID, float]
+        self.upper = {}  # type: Dict[UUID, float]
+
+    @classmethod
+    def of(cls, collection: Collection, seq: int, incoming: Iterable[UUID]) -> 'ShardSummary':
+        '''
+        Summarize the collection of a shard, given the ids the other shards refer to.
+        '''
+        external = {target: collection.referrers(target) for target in collection.dangling_refs()}
+        ports = set(external)
+        ports.update(id for id in incoming if id in collection.collection)
+        summary = cls(seq, external, ports)
+        ordering = collection.ordering()
+        summary.acyclic = ordering.is_acyclic()
+        if not summary.acyclic or not ports:
+            return summary
+        g = ordering.g
+        names = {}  # type: Dict[UUID, UUID]  # The port standing for each node of the ports
+        for port in sorted(ports):
+            node = ordering.node(port)
+            if node in names:
+                summary.nodes[port] = names[node]
+            else:
+                names[node] = port
+        bounds = ordering.bounds()
+        for node, name in names.items():
+            lower, upper = bounds.period(node)
+            if lower > -INF:
+                summary.lower[name] = lower
+            if upper < INF:
+                summary.upper[name] = upper
+        starts = [node for node in names if node in g]
+        between = _reachable(g.successors, starts) & _reachable(g.predecessors, starts)
+        summary.edges = {(names.get(u, u), names.get(v, v)) for u in between for v in g.successors(u) if v in between}
+        return summary
+
+    def diff(self, old: Optional['ShardSummary']=None) -> dict:
+        '''
+        The changes from the `old` summary (or from an empty one) to this one, to be applied by `patch()`.
+        '''
+        if old is None:
+            old = ShardSummary()
+        external, old_external = _triples(self.external), _triples(old.external)
+        return {
+                K_SEQ: self.seq,
+                K_ACYCLIC: self.acyclic,
+                K_ADDED: {
+                    K_EXTERNAL: [[str(target), kind, str(id)] for target, kind, id in external - old_external],
+                    K_PORTS: [str(id) for id in self.ports - old.ports],
+                    K_NODES: {str(id): str(name) for id, name in self.nodes.items() if old.nodes.get(id) != name},
+                    K_EDGES: [[str(u), str(v)] for u, v in self.edges - old.edges],
+                    K_LOWER: {str(id): t for id, t in self.lower.items() if old.lower.get(id) != t},
+                    K_UPPER: {str(id): t for id, t in self.upper.items() if old.upper.get(id) != t},
+                    },
+                K_REMOVED: {
+                    K_EXTERNAL: [[str(target), kind, str(id)] for target, kind, id in old_external - external],
+                    K_PORTS: [str(id) for id in old.ports - self.ports],
+                    K_NODES: [str(id) for id in old.nodes if id not in self.nodes],
+                    K_EDGES: [[str(u), str(v)] for u, v in old.edges - self.edges],
+                    K_LOWER: [str(id) for id in old.lower if id not in self.lower],
+                    K_UPPER: [str(id) for id in old.upper if id not in self.upper],
+                    },
+                }
+
+    def patch(self, diff: dict) -> None:
+        '''
+        Apply the changes given by `diff()`.
+        '''
+        self.seq = diff[K_SEQ]
+        self.acyclic = diff[K_ACYCLIC]
+        added, removed = diff[K_ADDED], diff[K_REMOVED]
+        for target, kind, id in removed[K_EXTERNAL]:
+            by_kind = self.external[UUID(target)]
+            by_kind[kind].discard(UUID(id))
+            if not by_kind[kind]:
+                del by_kind[kind]
+                if not by_kind:
+                    del self.external[UUID(target)]
+        for target, kind, id in added[K_EXTERNAL]:
+            self.external.setdefault(UUID(target), {}).setdefault(kind, set()).add(UUID(id))
+        self.ports.difference_update(UUID(id) for id in removed[K_PORTS])
+        self.ports.update(UUID(id) for id in added[K_PORTS])
+        self.edges.difference_update((UUID(u), UUID(v)) for u, v in removed[K_EDGES])
+        self.edges.update((UUID(u), UUID(v)) for u, v in added[K_EDGES])
+        for id in removed[K_NODES]:
+            del self.nodes[UUID(id)]
+        self.nodes.update((UUID(id), UUID(name)) for id, name in added[K_NODES].items())
+        for key, times in ((K_LOWER, self.lower), (K_UPPER, self.upper)):
+            for id in removed[key]:
+                del times[UUID(id)]
+            times.update((UUID(id), t) for id, t in added[key].items())
+
+
+def _summary_graph(summaries: Iterable[ShardSummary]) -> nx.DiGraph:
+    '''
+    The union of the parts of the (acyclic) shards between their ports, merged by `same`, which has a cycle if and only if the whole collection has one through several shards.
+    The implicit markers are ordered across the shards by a chain of time points (ints): a port whose latest time is `u` reaches the first point after `u`, and the point of `l` reaches the ports whose earliest time is `l`; so a port reaches another when `u < l`, i.e. when an implicit marker after the first is before an implicit marker before the second.
+    '''
+    summaries = list(summaries)
+    sames = UnionFind()  # type: UnionFind[UUID]
+    for summary in summaries:
+        for id, name in summary.nodes.items():
+            sames.union(name, id)
+    g = nx.DiGraph()
+    lower = {}  # type: Dict[UUID, float]
+    upper = {}  # type: Dict[UUID, float]
+    for summary in summaries:
+        g.add_edges_from((sames.find(u), sames.find(v)) for u, v in summary.edges)
+        for id, t in summary.lower.items():
+            node = sames.find(id)
+            lower[node] = max(t, lower.get(node, -INF))
+        for id, t in summary.upper.items():
+            node = sames.find(id)
+            upper[node] = min(t, upper.get(node, INF))
+    times = sorted(set(lower.values()) | set(upper.values()))
+    for i in range(len(times) - 1):
+        g.add_edge(i, i + 1)
+    for node, t in lower.items():
+        g.add_edge(bisect.bisect_left(times, t), node)
+    for node, t in upper.items():
+        i = bisect.bisect_right(times, t)
+        if i < len(times):
+            g.add_edge(node, i)
+    return g
+
+
+class ReferenceIndex:
+    '''
+    The index shared by the shards (`refs.json`, and the journal `refs.jsonl` of the changes after it): the shard of every id (`owners`), and the `ShardSummary` of every shard.
+    Each line of the journal changes the summary of a shard (see `ShardSummary.diff()`), and adds ids to it; with `reset`, both are replaced instead. A torn last line (from a crash while appending) is discarded.
+    '''
+
+    def __init__(self):
+        self.owners = {}  # type: Dict[UUID, str]
+        self.summaries = {}  # type: Dict[str, ShardSummary]
+        self.lines = 0  # The lines in the journal
+
+    @classmethod
+    def read(cls, directory, repair: bool=True) -> 'ReferenceIndex':
+        '''
+        Read the index and replay its journal; with `repair`, a torn last line is truncated.
+        '''
+        index = cls()
+        path = pathlib.Path(directory)
+        if (path / REFS_FILE).exists():
+            with open(path / REFS_FILE, 'r') as f:
+                dic = json.load(f)
+            for name, entry in dic[K_SHARDS].items():
+                summary = index.summaries[name] = ShardSummary()
+                summary.patch(entry)
+                for id in entry[K_IDS]:
+                    index.owners[UUID(id)] = name
+        journal_path = path / REFS_JOURNAL_FILE
+        if not journal_path.exists():
+            return index
+        valid = 0
+        with open(journal_path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    line = json.loads(raw)
+                except ValueError:
+                    break
+                name, reset = line[K_SHARD], line.get(K_RESET, False)
+                summary = ShardSummary() if reset else index.summaries.get(name, ShardSummary())
+                summary.patch(line[K_SUMMARY])
+                index.put(name, summary, (UUID(id) for id in line[K_IDS]), reset)
+                index.lines += 1
+                valid += len(raw)
+        if repair and valid < journal_path.stat().st_size:
+            with open(journal_path, 'r+b') as f:
+                f.truncate(valid)
+        return index
+
+    def put(self, name: str, summary: ShardSummary, ids: Iterable[UUID], reset: bool=False) -> None:
+        '''
+        Replace the summary of the shard, and add the ids to it; with `reset`, they replace the ones it had.
+        '''
+        if reset:
+            for id in [id for id, owner in self.owners.items() if owner == name]:
+                del self.owners[id]
+        for id in ids:
+            self.owners[id] = name
+        self.summaries[name] = summary
+
+    def append(self, directory, lines: List[dict]) -> None:
+        '''
+        Append the lines to the journal, durably.
+        '''
+        if not lines:
+            return
+        with open(pathlib.Path(directory) / REFS_JOURNAL_FILE, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.lines += len(lines)
+
+    def dump(self, directory) -> None:
+        '''
+        Write the whole index (atomically, through a temporary file), and truncate the journal.
+        '''
+        ids = {}  # type: Dict[str, List[str]]
+        for id, name in self.owners.items():
+            if name not in ids:
+                ids[name] = []
+            ids[name].append(str(id))
+        shards = {}
+        for name in set(self.summaries) | set(ids):
+            entry = self.summaries.get(name, ShardSummary()).diff()
+            entry[K_IDS] = ids.get(name, [])
+            shards[name] = entry
+        path = pathlib.Path(directory) / REFS_FILE
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({K_FORMAT: FORMAT, K_SHARDS: shards}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(directory)
+        journal_path = pathlib.Path(directory) / REFS_JOURNAL_FILE
+        if journal_path.exists():
+            journal_path.unlink()
+        self.lines = 0
+
+
+class ShardedCollection:
+    '''
+    The collection of a `ShardedInfoRecDB`, with the interface of `Collection`, where each operation only opens the shards of the items it reads or changes.
+    New items go to the shard of their id prefix, or of the `namespace` given to `add_item()` and `apply()` (`DEFAULT_NAMESPACE` if none).
+    The self-containment and the conflicts are found from the summaries of the shards (see `ShardedInfoRecDB.find_conflict()`); and with `reject_conflict`, a change making a cycle through several shards is rejected too.
+    Anything about the ordering of the whole collection (`ordering()`, `timeline()`, `conflict_report()`...) loads all the shards, into a `Collection` built once per version.
+    `version` only counts the changes made through this object.
+    '''
+
+    def __init__(self, db: 'ShardedInfoRecDB'):
+        self._db = db
+        self._memo = Memo()
+        self.version = 0
+        self._observers = []  # type: List[Callable[[str, RelTimeMarker], None]]
+
+    def add_observer(self, observer: Callable[[str, RelTimeMarker], None]) -> None:
+        '''
+        Register a callback, called after each change (see `Collection.add_observer()`).
+        '''
+        self._observers.append(observer)
+
+    def apply(self, operations: Iterable[Tuple[str, RelTimeMarker]], reject_conflict: bool=False, namespace: Optional[str]=None) -> None:
+        '''
+        Apply the operations atomically, like `Collection.apply()`, even when they span several shards.
+        '''
+        owners = self._db.index.owners
+        placed = {}  # type: Dict[UUID, str]  # The shards of the items added
+        by_shard = {}  # type: Dict[str, List[Tuple[str, RelTimeMarker]]]
+        for op, item in operations:
+            if op == OP_ADD:
+                if item.id in owners or item.id in placed:
+                    raise IllegalStateError('The item you are trying to add has duplicated id with an existing entry.')
+                name = placed[item.id] = self._db.shard_of(item.id, namespace)
+            elif op == OP_UPDATE:
+                owner = placed.get(item.id) or owners.get(item.id)
+                if owner is None:
+                    raise KeyError(item.id)
+                name = owner
+            else:
+                raise ValueError("Unknown operation {}".format(op))
+            if name not in by_shard:
+                by_shard[name] = []
+            by_shard[name].append((op, item))
+        check = reject_conflict and self.has_no_conflict()  # Only a new conflict is rejected
+        applied = []  # type: List[Tuple[Collection, List[Tuple[str, RelTimeMarker, Optional[RelTimeMarker]]]]]
+        try:
+            for name, shard_operations in by_shard.items():
+                collection = self._db.shard(name).collection
+                applied.append((collection, collection._apply(shard_operations, reject_conflict)))
+            for id, name in placed.items():
+                owners[id] = name
+            if check:
+                cycle = self._db.find_conflict()
+                if cycle is not None:
+                    raise ConflictError((cycle[0], cycle[1 % len(cycle)]), cycle)
+        except Exception:
+            for id in placed:
+                owners.pop(id, None)
+            for collection, done in reversed(applied):
+                collection._undo(done)
+            raise
+        self._db._added(placed)
+        self.version += 1
+        for collection, done in applied:
+            for op, item, _ in done:
+                collection._notify(op, item)
+        for collection, done in applied:
+            for op, item, _ in done:
+                for observer in self._observers:
+                    observer(op, item)
+
+    def add_item(self, *item: RelTimeMarker, reject_conflict: bool=False, namespace: Optional[str]=None) -> None:
+        self.apply([(OP_ADD, s_item) for s_item in item], reject_conflict, namespace)
+
+    def update_item(self, item_id: Union[UUID, str], new_item: RelTimeMarker, reject_conflict: bool=False) -> None:
+        if not isinstance(item_id, UUID):
+            item_id = UUID(item_id)
+        assert new_item.id == item_id
+        self.apply([(OP_UPDATE, new_item)], reject_conflict)
+
+    def get_item(self, id: Union[UUID, str]) -> RelTimeMarker:
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        name = self._db.index.owners.get(id)
+        if name is None:
+            raise KeyError(id)
+        return self._db.shard(name).collection.get_item(id)
+
+    def get_event(self, id: Union[UUID, str]) -> Event:
+        item = self.get_item(id)
+        if not isinstance(item, Event):
+            raise RuntimeError("The requested item {} is not an Event, but a {}".format(id, type(item)))
+        return item
+
+    def list(self) -> Iterable[UUID]:
+        return list(self._db.index.owners)
+
+    def page(self, start: int=0, limit: Optional[int]=None, where: Optional[Callable[[RelTimeMarker], bool]]=None) -> Tuple[List[RelTimeMarker], Optional[int]]:
+        '''
+        Like `Collection.page()`, in the order of the index (ids are only appended to it), opening the shards of the items listed.
+        '''
+        ids = self.memoized('ids', lambda: list(self._db.index.owners))
+        items = []  # type: List[RelTimeMarker]
+        i = start
+        while i < len(ids):
+            if limit is not None and len(items) >= limit:
+                return items, i
+            item = self.get_item(ids[i])
+            i += 1
+            if where is None or where(item):
+                items.append(item)
+        return items, None
+
+    def markers(self) -> Iterator[RelTimeMarker]:
+        '''
+        Generate all the markers, shard by shard (opening all of them).
+        '''
+        for name in self._db.names():
+            yield from self._db.shard(name).collection.collection.values()
+
+    def titles(self) -> Iterator[Tuple[str, str]]:
+        for name in self._db.names():
+            yield from self._db.shard(name).collection.titles()
+
+    def is_self_contained(self) -> bool:
+        '''
+        Test if the collection is self-contained, which means every event points to a valid event in the collection (in any shard).
+        '''
+        return not self.dangling_refs()
+
+    def dangling_refs(self) -> Set[UUID]:
+        owners = self._db.index.owners
+        return {target for name in self._db.names() for target in self._db.external(name) if target not in owners}
+
+    def referrers(self, id: Union[UUID, str]) -> Dict[str, Set[UUID]]:
+        '''
+        Like `Collection.referrers()`: from the shard of `id` (opening it), and from the index for the other shards.
+        '''
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        owner = self._db.index.owners.get(id)
+        ret = self._db.shard(owner).collection.referrers(id) if owner is not None else {}
+        for name in self._db.names():
+            if name == owner:
+                continue
+            for kind, ids in self._db.external(name).get(id, {}).items():
+                ret[kind] = ret.get(kind, set()) | ids
+        return ret
+
+    def has_no_conflict(self) -> bool:
+        return self.memoized('conflict', self._db.find_conflict) is None
+
+    def _whole(self) -> Collection:
+        return self.memoized('whole', lambda: Collection(self.markers()))
+
+    def ordering(self) -> OrderedMarkers:
+        return self._whole().ordering()
+
+    def conflict_report(self) -> ConflictReport:
+        return self._whole().conflict_report()
+
+    def conflicts(self, limit: Optional[int]=None) -> List[List[str]]:
+        return self._whole().conflicts(limit)
+
+    def same_group(self, id: Union[UUID, str]) -> Set[UUID]:
+        return self._whole().same_group(id)
+
+    def same_groups(self) -> Iterable[Set[UUID]]:
+        return self._whole().same_groups()
+
+    def memoized(self, key: Hashable, compute: Callable[[], T]) -> T:
+        return self._memo.get(self.version, key, compute)
+
+    def timeline(self) -> MarkerTimeline:
+        return self._whole().timeline()
+
+
+class ShardedInfoRecDB:
+    '''
+    The database split into shards, each stored as an `InfoRecDB` with a journal (in `shards/<name>`): by id prefix (`BY_PREFIX`, the first `prefix_length` hex digits of the id) or by namespace (`BY_NAMESPACE`, see `ShardedCollection`).
+    A shard is only opened when one of its items is read or changed, and only the shards changed are written, along with the `ReferenceIndex` shared by them.
+    The index is written before the shards, so that it is never behind them; if it is ahead (after a crash), the entry of the shard is corrected when the shard is opened.
+    The summary of a shard in the index covers the ids the other shards referred to when it was written: if they refer to more, it is computed again, which opens the shard.
+    The writer lock is `db.lock` in the directory, like for `InfoRecDB` (and each shard takes its own).
+    '''
+
+    @staticmethod
+    def exists(base_dir) -> bool:
+        return (pathlib.Path(base_dir) / SHARDS_FILE).exists()
+
+    @classmethod
+    def init(cls, base_dir, scheme=BY_PREFIX, prefix_length=DEFAULT_PREFIX_LENGTH, binary=False):
+        if not InfoRecDB.not_exists_or_empty_dir(base_dir):
+            raise RuntimeError(f'Path `{base_dir}` is not an empty directory or is a file')
+        if scheme not in SCHEMES:
+            raise ValueError('Unknown sharding scheme {!r}'.format(scheme))
+        if not 0 < prefix_length <= MAX_PREFIX_LENGTH:
+            raise ValueError('The prefix length must be between 1 and {}'.format(MAX_PREFIX_LENGTH))
+        path = pathlib.Path(base_dir)
+        (path / SHARDS_DIR).mkdir(parents=True)
+        manifest = {K_FORMAT: FORMAT, K_SCHEME: scheme, K_BINARY: binary}  # type: Dict[str, object]
+        if scheme == BY_PREFIX:
+            manifest[K_PREFIX_LENGTH] = prefix_length
+        with open(path / SHARDS_FILE, 'w') as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def open(cls, base_dir, read_only=False):
+        '''
+        Open the database in `base_dir`, only reading the index. With `read_only`, the writer lock is not taken, and the database can't be written.
+        '''
+        if not cls.exists(base_dir):
+            raise RuntimeError(f'No sharded database in `{base_dir}`')
+        with open(pathlib.Path(base_dir) / SHARDS_FILE, 'r') as f:
+            manifest = json.load(f)
+        lock = None
+        if not read_only:
+            lock = FileLock(pathlib.Path(base_dir) / LOCK_FILE)
+            lock.acquire()
+        try:
+            index = ReferenceIndex.read(base_dir, not read_only)
+        except BaseException:
+            if lock is not None:
+                lock.release()
+            raise
+        db = cls(base_dir, manifest, index, read_only)
+        db._lock = lock
+        return db
+
+    def __init__(self, directory, manifest: dict, index: ReferenceIndex, read_only=False):
+        self._dir = pathlib.Path(directory)
+        self.scheme = manifest[K_SCHEME]
+        self.prefix_length = manifest.get(K_PREFIX_LENGTH, DEFAULT_PREFIX_LENGTH)
+        self._binary = manifest.get(K_BINARY, False)
+        self.index = index
+        self.read_only = read_only
+        self._lock = None  # type: Optional[FileLock]
+        self._shards = {}  # type: Dict[str, InfoRecDB]  # The shards opened
+        self._new_ids = {}  # type: Dict[str, List[UUID]]  # The ids added to each shard, not in the index journal yet
+        self._reset = set()  # type: Set[str]  # The shards whose ids in the index are to be replaced
+        self._live = {}  # type: Dict[str, Tuple[int, FrozenSet[UUID], ShardSummary]]  # The summaries computed from the opened shards, with the version and the incoming ids they were computed for
+        self.collection = ShardedCollection(self)
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise IllegalStateError('Database `{}` is opened read-only'.format(self._dir))
+
+    @property
+    def journal(self) -> bool:
+        return True
+
+    def shard_of(self, id: UUID, namespace: Optional[str]=None) -> str:
+        '''
+        The shard a new item goes to.
+        '''
+        if self.scheme == BY_PREFIX:
+            if namespace is not None:
+                raise ValueError('The shards are by id prefix, not by namespace')
+            return id.hex[:self.prefix_length]
+        if namespace is None:
+            namespace = DEFAULT_NAMESPACE
+        if not NAMESPACE.match(namespace):
+            raise ValueError('Invalid namespace {!r}'.format(namespace))
+        return namespace
+
+    def names(self) -> List[str]:
+        '''
+        The names of the shards (opened or not).
+        '''
+        return sorted(set(self.index.summaries) | set(self._shards))
+
+    def shard(self, name: str) -> InfoRecDB:
+        '''
+        The shard `name`, opened on first use (and created, unless read-only).
+        '''
+        db = self._shards.get(name)
+        if db is not None:
+            return db
+        path = self._dir / SHARDS_DIR / name
+        if self.read_only and not path.exists():
+            db = InfoRecDB(path, Collection(), journal=True, read_only=True)
+        else:
+            db = InfoRecDB.open(path, auto_init=True, journal=True, binary=self._binary, read_only=self.read_only)
+        summary = self.index.summaries.get(name)
+        if summary.seq != db.seq if summary is not None else bool(db.collection.collection):  # Out of date after a crash
+            self.index.put(name, ShardSummary(), db.collection.list(), reset=True)
+            self._reset.add(name)
+        self._shards[name] = db
+        return db
+
+    def _added(self, placed: Dict[UUID, str]) -> None:
+        for id, name in placed.items():
+            if name not in self._new_ids:
+                self._new_ids[name] = []
+            self._new_ids[name].append(id)
+
+    def external(self, name: str) -> Dict[UUID, Dict[str, Set[UUID]]]:
+        '''
+        The references of the shard to the ids it doesn't have (see `ShardSummary`), without opening it.
+        '''
+        db = self._shards.get(name)
+        if db is None:
+            summary = self.index.summaries.get(name)
+            return summary.external if summary is not None else {}
+        collection = db.collection
+        return collection.memoized('external', lambda: {target: collection.referrers(target) for target in collection.dangling_refs()})
+
+    def _incoming(self) -> Dict[str, FrozenSet[UUID]]:
+        '''
+        The ids of each shard referred to by the other shards.
+        '''
+        owners = self.index.owners
+        incoming = {}  # type: Dict[str, Set[UUID]]
+        for name in self.names():
+            for target in self.external(name):
+                owner = owners.get(target)
+                if owner is not None and owner != name:
+                    if owner not in incoming:
+                        incoming[owner] = set()
+                    incoming[owner].add(target)
+        return {name: frozenset(ids) for name, ids in incoming.items()}
+
+    def _covers(self, name: str, incoming: FrozenSet[UUID]) -> bool:
+        '''
+        If the summary of the shard in the index covers the ids the other shards refer to.
+        '''
+        summary = self.index.summaries.get(name)
+        return summary is not None and incoming <= summary.ports and name not in self._reset
+
+    def summary(self, name: str, incoming: FrozenSet[UUID]=frozenset()) -> ShardSummary:
+        '''
+        The summary of the shard, given the ids the other shards refer to: the one in the index if the shard isn't opened and it covers them, otherwise computed from the shard (opening it), once per version.
+        '''
+        if name not in self._shards and self._covers(name, incoming):
+            return self.index.summaries[name]
+        db = self.shard(name)
+        version = db.collection.version
+        live = self._live.get(name)
+        if live is None or live[0] != version or not incoming <= live[1]:
+            live = version, incoming, ShardSummary.of(db.collection, db.seq, incoming)
+            self._live[name] = live
+        return live[2]
+
+    def find_conflict(self) -> Optional[List[Hashable]]:
+        '''
+        A cycle in the ordering of the whole collection, or None: the conflicting ids of a shard, or the ids shared by the shards a cycle goes through (see `_summary_graph()`).
+        '''
+        incoming = self._incoming()
+        summaries = []
+        for name in self.names():
+            summary = self.summary(name, incoming.get(name, frozenset()))
+            if not summary.acyclic:
+                return next(self.shard(name).collection.conflict_report().cycles(1))
+            summaries.append(summary)
+        g = _summary_graph(summaries)
+        group = next(conflict_groups(g), None)
+        if group is None:
+            return None
+        cycle = next(nx.simple_cycles(g.subgraph(group)))
+        return [node for node in cycle if isinstance(node, UUID)]
+
+    def take_pending(self) -> List[Tuple[str, dict, List[dict]]]:
+        '''
+        Take the changes not written yet, as the line of the index and the journal records of each shard changed, to be written by `append()` (see `InfoRecDB.take_pending()`).
+        The index in memory is brought up to date already.
+        '''
+        incoming = self._incoming()
+        groups = []
+        for name, db in self._shards.items():
+            records = db.take_pending()
+            shard_incoming = incoming.get(name, frozenset())
+            if not records and self._covers(name, shard_incoming):
+                continue
+            summary = self.summary(name, shard_incoming)
+            reset = name in self._reset
+            ids = list(db.collection.list()) if reset else self._new_ids.pop(name, [])
+            line = {K_SHARD: name, K_SUMMARY: summary.diff(None if reset else self.index.summaries.get(name)), K_IDS: [str(id) for id in ids]}  # type: Dict[str, object]
+            if reset:
+                line[K_RESET] = True
+                self._reset.discard(name)
+                self._new_ids.pop(name, None)
+            self.index.put(name, summary, ids, reset)
+            groups.append((name, line, records))
+        return groups
+
+    def append(self, groups: List[Tuple[str, dict, List[dict]]]) -> None:
+        '''
+        Write the changes taken by `take_pending()`: the index lines first, then the journal records of each shard.
+        '''
+        self._check_writable()
+        self.index.append(self._dir, [line for _, line, _ in groups])
+        for name, _, records in groups:
+            self._shards[name].append(records)
+
+    def needs_compaction(self) -> bool:
+        return self.index.lines >= REFS_COMPACT_THRESHOLD or any(db.needs_compaction() for db in self._shards.values())
+
+    def write(self):
+        self._check_writable()
+        self.append(self.take_pending())
+        if self.needs_compaction():
+            self.compact()
+
+    def compact(self):
+        '''
+        Write the whole index, then compact the opened shards which have journal records (or changes not written yet). The shards not opened are left as they are.
+        '''
+        self._check_writable()
+        groups = self.take_pending()
+        self.index.dump(self._dir)
+        changed = {name for name, _, records in groups if records}
+        for name, db in self._shards.items():
+            if name in changed or db.journal_records:
+                db.compact()
+
+    def close(self):
+        '''
+        Release the writer locks. The changes not written yet are discarded.
+        '''
+        for db in self._shards.values():
+            db.close()
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
@@ -0,0 +1,275 @@
+# -*- coding:utf-8 -*-
+
+'''
+Binary snapshot of a collection, as an alternative to `db.json`.
+
+The snapshot is columnar, so that it can be memory-mapped and accessed without parsing (nor copying) it:
+- a header with the counts and the sequence number of the journal;
+- the 16-byte ids: first the markers', then the ones only referred to;
+- the indices of the markers sorted by id, to look them up by binary search;
+- for each marker: a type tag, a timestamp (microseconds or days since the epoch), a UTC offset, and the indices of its title and description in the string table;
+- the string table (interned), as offsets into a UTF-8 blob;
+- for each relation (before, after, same): CSR-style offsets per marker into an array of indices into the ids.
+All integers are little-endian, and each section is aligned to 8 bytes.
+'''
+
+import array
+import datetime
+import mmap
+import struct
+import sys
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+from exception import (
+        IllegalStateError,
+        )
+from model import (
+        AbsoluteDateTime,
+        Date,
+        Event,
+        RelTimeMarker,
+        RelTimeSpec,
+        )
+
+
+MAGIC = b'IRSNAP\0\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQQQQQ')  # magic, version, reserved, markers, ids, strings, blob length, befores, afters, sames, journal seq
+
+TAG_EVENT = 0
+TAG_ABSOLUTEDATETIME = 1
+TAG_DATE = 2
+
+NONE = -1  # No string
+NAIVE = -(1 << 31)  # No UTC offset
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_DATE = EPOCH.date()
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _pad(n: int) -> int:
+    return -n % 8
+
+
+def _little_endian(arr: array.array) -> bytes:
+    if sys.byteorder == 'big':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def dump(markers: Iterable[RelTimeMarker], f, journal_seq: int=0) -> None:
+    '''
+    Write the markers as a binary snapshot into the (binary) file `f`.
+    '''
+    markers = list(markers)
+    index = {}  # type: Dict[UUID, int]
+    for i, marker in enumerate(markers):
+        index[marker.id] = i
+    id_list = [marker.id for marker in markers]
+    strings = {}  # type: Dict[str, int]
+    types = bytearray()
+    times = array.array('q')
+    offsets = array.array('i')
+    titles = array.array('i')
+    descs = array.array('i')
+    relations = [(array.array('I', [0]), array.array('I')) for _ in range(3)]
+
+    def intern(s: Optional[str]) -> int:
+        if s is None:
+            return NONE
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    def ref(id: UUID) -> int:
+        if id not in index:
+            index[id] = len(id_list)
+            id_list.append(id)
+        return index[id]
+
+    for marker in markers:
+        offset = NAIVE
+        timespec = None
+        if isinstance(marker, Event):
+            types.append(TAG_EVENT)
+            times.append(0)
+            titles.append(intern(marker.title))
+            descs.append(intern(marker.desc))
+            timespec = marker.timespec
+        elif isinstance(marker, AbsoluteDateTime):
+            types.append(TAG_ABSOLUTEDATETIME)
+            abstime = marker.abstime
+            utcoffset = abstime.utcoffset()
+            if utcoffset is not None:
+                offset = int(utcoffset.total_seconds())
+            times.append((abstime.replace(tzinfo=None) - EPOCH) // MICROSECOND)
+            titles.append(NONE)
+            descs.append(NONE)
+        elif isinstance(marker, Date):
+            types.append(TAG_DATE)
+            date = marker.date.date() if isinstance(marker.date, datetime.datetime) else marker.date
+            times.append((date - EPOCH_DATE).days)
+            titles.append(NONE)
+            descs.append(NONE)
+        else:
+            raise IllegalStateError("Collection contains unknown type {}".format(type(marker)))
+        offsets.append(offset)
+        targets_of_kind = (timespec.befores, timespec.afters, timespec.sames) if timespec else (None, None, None)
+        for (starts, targets), ids in zip(relations, targets_of_kind):
+            for id in ids or []:
+                targets.append(ref(id))
+            starts.append(len(targets))
+
+    blob = bytearray()
+    string_starts = array.array('Q', [0])
+    for s in strings:  # In insertion order, i.e. by index
+        blob.extend(s.encode('utf-8'))
+        string_starts.append(len(blob))
+
+    header = HEADER.pack(MAGIC, VERSION, 0, len(markers), len(id_list), len(strings), len(blob),
+            len(relations[0][1]), len(relations[1][1]), len(relations[2][1]), journal_seq)
+    by_id = array.array('I', sorted(range(len(markers)), key=lambda i: id_list[i].bytes))
+    sections = [
+            b''.join(id.bytes for id in id_list),
+            _little_endian(by_id),
+            bytes(types),
+            _little_endian(times),
+            _little_endian(offsets),
+            _little_endian(titles),
+            _little_endian(descs),
+            _little_endian(string_starts),
+            bytes(blob),
+            ]
+    for starts, targets in relations:
+        sections.append(_little_endian(starts))
+        sections.append(_little_endian(targets))
+    f.write(header)
+    for section in sections:
+        f.write(section)
+        f.write(b'\0' * _pad(len(section)))
+
+
+class BinarySnapshot:
+    '''
+    A binary snapshot, memory-mapped: opening it only reads the header, and each marker is decoded from the columns when asked for.
+    '''
+
+    @classmethod
+    def open(cls, path) -> 'BinarySnapshot':
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf)
+
+    def __init__(self, buf):
+        self._buf = buf
+        view = memoryview(buf)
+        magic, version, _, n, n_ids, n_strings, blob_len, n_before, n_after, n_same, self.journal_seq = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise IllegalStateError('Not a binary snapshot (of version {})'.format(VERSION))
+        self._n = n
+        pos = HEADER.size
+
+        def section(length: int, fmt: Optional[str]=None):
+            nonlocal pos
+            sec = view[pos:pos + length]
+            pos += length + _pad(length)
+            if fmt is None:
+                return sec
+            if sys.byteorder == 'big':  # Not zero-copy then
+                arr = array.array(fmt, sec.tobytes())
+                arr.byteswap()
+                return memoryview(arr)
+            return sec.cast(fmt)
+
+        self._ids = section(16 * n_ids)
+        self._by_id = section(4 * n, 'I')
+        self._types = section(n)
+        self._times = section(8 * n, 'q')
+        self._offsets = section(4 * n, 'i')
+        self._titles = section(4 * n, 'i')
+        self._descs = section(4 * n, 'i')
+        self._string_starts = section(8 * (n_strings + 1), 'Q')
+        self._blob = section(blob_len)
+        self._relations = []  # type: List[Tuple[memoryview, memoryview]]
+        for count in (n_before, n_after, n_same):
+            starts = section(4 * (n + 1), 'I')
+            targets = section(4 * count, 'I')
+            self._relations.append((starts, targets))
+        self._uuids = {}  # type: Dict[int, UUID]
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _uuid(self, i: int) -> UUID:
+        id = self._uuids.get(i)
+        if id is None:
+            id = self._uuids[i] = UUID(bytes=bytes(self._ids[16 * i:16 * i + 16]))
+        return id
+
+    def _string(self, i: int) -> Optional[str]:
+        if i == NONE:
+            return None
+        return str(self._blob[self._string_starts[i]:self._string_starts[i + 1]], 'utf-8')
+
+    def _targets(self, kind: int, i: int) -> Optional[List[UUID]]:
+        starts, targets = self._relations[kind]
+        begin, end = starts[i], starts[i + 1]
+        if begin == end:
+            return None
+        return [self._uuid(j) for j in targets[begin:end]]
+
+    def _index(self, id: UUID) -> Optional[int]:
+        key = id.bytes
+        ids, by_id = self._ids, self._by_id
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = by_id[mid]
+            if bytes(ids[16 * i:16 * i + 16]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n and bytes(ids[16 * by_id[lo]:16 * by_id[lo] + 16]) == key:
+            return by_id[lo]
+        return None
+
+    def marker(self, i: int) -> RelTimeMarker:
+        tag = self._types[i]
+        id = self._uuid(i)
+        if tag == TAG_EVENT:
+            timespec = RelTimeSpec(befores=self._targets(0, i), afters=self._targets(1, i), sames=self._targets(2, i))
+            return Event(id=id, title=self._string(self._titles[i]), desc=self._string(self._descs[i]), timespec=timespec)
+        elif tag == TAG_ABSOLUTEDATETIME:
+            abstime = EPOCH + self._times[i] * MICROSECOND
+            if self._offsets[i] != NAIVE:
+                abstime = abstime.replace(tzinfo=datetime.timezone(datetime.timedelta(seconds=self._offsets[i])))
+            return AbsoluteDateTime(id, abstime)
+        elif tag == TAG_DATE:
+            return Date(id, EPOCH_DATE + datetime.timedelta(days=self._times[i]))
+        raise IllegalStateError("Snapshot with unexpected schema: Unknown type tag {}".format(tag))
+
+    def markers(self) -> Iterator[RelTimeMarker]:
+        for i in range(self._n):
+            yield self.marker(i)
+
+    def __contains__(self, id: UUID) -> bool:
+        return self._index(id) is not None
+
+    def get(self, id: UUID) -> RelTimeMarker:
+        i = self._index(id)
+        if i is None:
+            raise KeyError(id)
+        return self.marker(i)
+
+    def ids(self) -> List[UUID]:
+        return [self._uuid(i) for i in range(self._n)]
+
+    def titles(self) -> Iterator[Tuple[UUID, str]]:
+        types = self._types
+        for i in range(self._n):
+            if types[i] == TAG_EVENT:
+                yield self._uuid(i), self._string(self._titles[i]) or ''
@@ -0,0 +1,388 @@
+# -*- coding:utf-8 -*-
+
+'''
+SQLite-backed storage, for collections too large to be kept in memory.
+The markers and their relations live in indexed tables, so opening the database and looking up an item do not depend on the size of the collection.
+'''
+
+import datetime
+import pathlib
+import sqlite3
+import threading
+
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
+from uuid import UUID
+
+import sede
+
+from exception import (
+        IllegalStateError,
+        )
+from model import (
+        AbsoluteDateTime,
+        Date,
+        Event,
+        RelTimeMarker,
+        RelTimeSpec,
+        )
+from ordering import ConflictReport
+from storage import (
+        MarkerTimeline,
+        Memo,
+        OP_ADD,
+        OP_UPDATE,
+        OrderedMarkers,
+        RELATION_KINDS,
+        T_ABSOLUTEDATETIME,
+        T_DATE,
+        T_EVENT,
+        relations,
+        )
+
+
+SQLITE_DATABASE_FILE = 'db.sqlite3'
+
+T = TypeVar('T')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS markers (
+    id BLOB PRIMARY KEY,
+    type TEXT NOT NULL,
+    title TEXT,
+    desc TEXT,
+    time TEXT
+);
+CREATE TABLE IF NOT EXISTS relations (
+    src BLOB NOT NULL,
+    kind TEXT NOT NULL,
+    dst BLOB NOT NULL,
+    pos INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS relations_src ON relations (src, kind, pos);
+CREATE INDEX IF NOT EXISTS relations_dst ON relations (dst);
+'''
+
+def _marker_row(marker: RelTimeMarker) -> tuple:
+    mid = marker.id.bytes
+    if isinstance(marker, Event):
+        return (mid, T_EVENT, marker.title, marker.desc, None)
+    elif isinstance(marker, AbsoluteDateTime):
+        return (mid, T_ABSOLUTEDATETIME, None, None, marker.abstime.isoformat())
+    elif isinstance(marker, Date):
+        date = marker.date.date() if isinstance(marker.date, datetime.datetime) else marker.date
+        return (mid, T_DATE, None, None, date.isoformat())
+    raise IllegalStateError("Collection contains unknown type {}".format(type(marker)))
+
+
+def _relation_rows(event: Event) -> Iterator[tuple]:
+    for pos, (kind, target) in enumerate(relations(event)):
+        yield (event.id.bytes, kind, target.bytes, pos)
+
+
+class Connections:
+    '''
+    A connection to the database for each thread, as a `sqlite3.Connection` can't be used by several threads at once (e.g. the readers of `App`).
+    The connections of the threads which have ended are closed when another one is opened.
+    '''
+
+    def __init__(self, path):
+        self._path = str(path)
+        self._local = threading.local()
+        self._opened = []  # type: List[Tuple[threading.Thread, sqlite3.Connection]]
+        self._lock = threading.Lock()
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, check_same_thread=False)  # Only to be closed from another thread
+            self._local.conn = conn
+            with self._lock:
+                opened = []
+                for thread, other in self._opened:
+                    if thread.is_alive():
+                        opened.append((thread, other))
+                    else:
+                        other.close()
+                opened.append((threading.current_thread(), conn))
+                self._opened = opened
+        return conn
+
+    def close(self) -> None:
+        with self._lock:
+            for _, conn in self._opened:
+                conn.close()
+            self._opened = []
+            self._local = threading.local()
+
+
+class SqliteCollection:
+    '''
+    A `Collection` stored in a SQLite database, with the same interface.
+    The dangling references are found by an (indexed) anti-join of the relations against the markers.
+    The ordering graph is only built (from the whole database) when ordering information is asked for, and then maintained incrementally like in `Collection`.
+    `version` only counts the changes made through this object.
+    Each thread uses its own connection (see `Connections`).
+    '''
+
+    def __init__(self, connections: Connections):
+        self._connections = connections
+        self._conn.executescript(SCHEMA)
+        self._ordering = None  # type: Optional[OrderedMarkers]
+        self._ordering_lock = threading.Lock()
+        self._memo = Memo()
+        self.version = 0
+        self._observers = []  # type: List[Callable[[str, RelTimeMarker], None]]
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def add_observer(self, observer: Callable[[str, RelTimeMarker], None]) -> None:
+        '''
+        Register a callback, called after each change (see `Collection.add_observer()`).
+        '''
+        self._observers.append(observer)
+
+    def _load(self, row: tuple, relations: Optional[Iterable[tuple]]=None) -> RelTimeMarker:
+        mid, t, title, desc, time = row
+        id = UUID(bytes=mid)
+        if t == T_EVENT:
+            if relations is None:
+                relations = self._conn.execute('SELECT kind, dst FROM relations WHERE src = ? ORDER BY kind, pos', (mid,))
+            rels = {kind: None for kind in RELATION_KINDS}  # type: dict
+            for kind, dst in relations:
+                if rels[kind] is None:
+                    rels[kind] = []
+                rels[kind].append(UUID(bytes=dst))
+            timespec = RelTimeSpec(befores=rels[sede.K_BEFORE], afters=rels[sede.K_AFTER], sames=rels[sede.K_SAME])
+            return Event(id=id, title=title, desc=desc, timespec=timespec)
+        elif t == T_ABSOLUTEDATETIME:
+            return AbsoluteDateTime(id, datetime.datetime.fromisoformat(time))
+        elif t == T_DATE:
+            return Date(id, datetime.date.fromisoformat(time))
+        raise IllegalStateError("DB with unexpected schema: Unknown type {} in collection".format(t))
+
+    def _insert(self, item: RelTimeMarker) -> None:
+        self._conn.execute('INSERT INTO markers VALUES (?, ?, ?, ?, ?)', _marker_row(item))
+        if isinstance(item, Event):
+            self._conn.executemany('INSERT INTO relations VALUES (?, ?, ?, ?)', _relation_rows(item))
+
+    def markers(self) -> Iterator[RelTimeMarker]:
+        '''
+        Generate all the markers, reading the relations in one pass instead of once per event.
+        '''
+        relations = {}  # type: Dict[bytes, List[tuple]]
+        for src, kind, dst in self._conn.execute('SELECT src, kind, dst FROM relations ORDER BY src, kind, pos'):
+            if src not in relations:
+                relations[src] = []
+            relations[src].append((kind, dst))
+        for row in self._conn.execute('SELECT id, type, title, desc, time FROM markers').fetchall():
+            yield self._load(row, relations.get(row[0], []))
+
+    def add_item(self, *item: RelTimeMarker, reject_conflict: bool=False) -> None:
+        if reject_conflict:
+            self.ordering().add(*item, reject_cycle=True)
+        try:
+            with self._conn:
+                for s_item in item:
+                    self._insert(s_item)
+        except sqlite3.IntegrityError:
+            if reject_conflict:
+                self._ordering = None
+            raise IllegalStateError('The item you are trying to add has duplicated id with an existing entry.')
+        if self._ordering is not None and not reject_conflict:
+            self._ordering.add(*item)
+        self.version += 1
+        for s_item in item:
+            for observer in self._observers:
+                observer(OP_ADD, s_item)
+
+    def update_item(self, item_id: Union[UUID, str], new_item: RelTimeMarker, reject_conflict: bool=False) -> None:
+        if not isinstance(item_id, UUID):
+            item_id = UUID(item_id)
+        old_item = self.get_item(item_id)
+        assert isinstance(new_item, type(old_item))
+        if self._ordering is not None or reject_conflict:
+            self.ordering().update(old_item, new_item, reject_cycle=reject_conflict)
+        with self._conn:
+            self._replace(new_item)
+        self.version += 1
+        for observer in self._observers:
+            observer(OP_UPDATE, new_item)
+
+    def _replace(self, item: RelTimeMarker) -> None:
+        row = _marker_row(item)
+        self._conn.execute('DELETE FROM relations WHERE src = ?', (item.id.bytes,))
+        self._conn.execute('UPDATE markers SET type = ?, title = ?, desc = ?, time = ? WHERE id = ?', row[1:] + row[:1])  # In place, keeping the rowid (i.e. the position)
+        if isinstance(item, Event):
+            self._conn.executemany('INSERT INTO relations VALUES (?, ?, ?, ?)', _relation_rows(item))
+
+    def apply(self, operations: Iterable[Tuple[str, RelTimeMarker]], reject_conflict: bool=False) -> None:
+        '''
+        Apply the operations (`OP_ADD` or `OP_UPDATE`, with the item) in order, in one SQLite transaction: if one fails (or makes a conflict, with `reject_conflict`), the transaction is rolled back and the ordering graph restored before raising.
+        The observers are only notified once the transaction is committed.
+        '''
+        ordering = self.ordering() if reject_conflict else self._ordering  # Built before the transaction, which it would read otherwise
+        done = []  # type: List[Tuple[RelTimeMarker, Optional[RelTimeMarker]]]  # The items applied to the ordering graph, with the ones they replaced
+        try:
+            with self._conn:
+                for op, item in operations:
+                    if op == OP_ADD:
+                        self._insert(item)  # First, so that a duplicated id fails before changing the ordering graph
+                        if ordering is not None:
+                            ordering.add(item, reject_cycle=reject_conflict)
+                        done.append((item, None))
+                    elif op == OP_UPDATE:
+                        old_item = self.get_item(item.id)
+                        assert isinstance(item, type(old_item))
+                        self._replace(item)
+                        if ordering is not None:
+                            ordering.update(old_item, item, reject_cycle=reject_conflict)
+                        done.append((item, old_item))
+                    else:
+                        raise ValueError("Unknown operation {}".format(op))
+        except Exception as e:
+            if ordering is not None:
+                for applied, replaced in reversed(done):
+                    if replaced is None:
+                        ordering.discard(applied)
+                    else:
+                        ordering.update(applied, replaced)
+            if isinstance(e, sqlite3.IntegrityError):
+                raise IllegalStateError('The item you are trying to add has duplicated id with an existing entry.')
+            raise
+        self.version += 1
+        for applied, replaced in done:
+            for observer in self._observers:
+                observer(OP_ADD if replaced is None else OP_UPDATE, applied)
+
+    def is_self_contained(self) -> bool:
+        '''
+        Test if the collection is self-contained, which means every event points to a valid event in the collection.
+        '''
+        dangling = self._conn.execute('SELECT 1 FROM relations r WHERE NOT EXISTS (SELECT 1 FROM markers m WHERE m.id = r.dst) LIMIT 1').fetchone()
+        return dangling is None
+
+    def dangling_refs(self) -> Set[UUID]:
+        rows = self._conn.execute('SELECT DISTINCT dst FROM relations r WHERE NOT EXISTS (SELECT 1 FROM markers m WHERE m.id = r.dst)')
+        return {UUID(bytes=dst) for dst, in rows}
+
+    def referrers(self, id: Union[UUID, str]) -> Dict[str, Set[UUID]]:
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        ret = {}  # type: Dict[str, Set[UUID]]
+        for src, kind in self._conn.execute('SELECT src, kind FROM relations WHERE dst = ?', (id.bytes,)):
+            if kind not in ret:
+                ret[kind] = set()
+            ret[kind].add(UUID(bytes=src))
+        return ret
+
+    def get_item(self, id: Union[UUID, str]) -> RelTimeMarker:
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        row = self._conn.execute('SELECT id, type, title, desc, time FROM markers WHERE id = ?', (id.bytes,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return self._load(row)
+
+    def get_event(self, id: Union[UUID, str]) -> Event:
+        item = self.get_item(id)
+        if not isinstance(item, Event):
+            raise RuntimeError("The requested item {} is not an Event, but a {}".format(id, type(item)))
+        return item
+
+    def list(self) -> Iterable[UUID]:
+        return [UUID(bytes=mid) for mid, in self._conn.execute('SELECT id FROM markers ORDER BY rowid')]
+
+    def page(self, start: int=0, limit: Optional[int]=None, where: Optional[Callable[[RelTimeMarker], bool]]=None) -> Tuple[List[RelTimeMarker], Optional[int]]:
+        '''
+        Like `Collection.page()`, with the rowids as positions.
+        '''
+        items = []  # type: List[RelTimeMarker]
+        for row in self._conn.execute('SELECT rowid, id, type, title, desc, time FROM markers WHERE rowid >= ? ORDER BY rowid', (start,)):
+            if limit is not None and len(items) >= limit:
+                return items, row[0]
+            item = self._load(row[1:])
+            if where is None or where(item):
+                items.append(item)
+        return items, None
+
+    def titles(self) -> Iterator[Tuple[str, str]]:
+        for mid, title in self._conn.execute('SELECT id, title FROM markers WHERE type = ?', (T_EVENT,)):
+            yield str(UUID(bytes=mid)), title
+
+    def ordering(self) -> OrderedMarkers:
+        '''
+        The ordering graph, built on the first use; by one of the readers at once, the others waiting for it.
+        '''
+        ordering = self._ordering
+        if ordering is None:
+            with self._ordering_lock:
+                if self._ordering is None:
+                    self._ordering = OrderedMarkers(self.markers())
+                ordering = self._ordering
+        return ordering
+
+    def has_no_conflict(self) -> bool:
+        return self.ordering().is_acyclic()
+
+    def conflict_report(self) -> ConflictReport:
+        return self.memoized('conflict_report', lambda: self.ordering().conflict_report())
+
+    def conflicts(self, limit: Optional[int]=None) -> List[List[str]]:
+        return [[str(node) for node in cycle] for cycle in self.conflict_report().cycles(limit)]
+
+    def memoized(self, key: Hashable, compute: Callable[[], T]) -> T:
+        return self._memo.get(self.version, key, compute)
+
+    def timeline(self) -> MarkerTimeline:
+        return self.memoized('timeline', lambda: MarkerTimeline(self.ordering(), self.list(), self.conflict_report().groups))
+
+
+class SqliteInfoRecDB:
+    '''
+    The database stored as a SQLite file in a directory. Changes are committed as they are made, so `write()` has nothing left to do.
+    '''
+
+    @classmethod
+    def init(cls, base_dir):
+        path = pathlib.Path(base_dir)
+        if path.exists() and (not path.is_dir() or any(path.iterdir())):
+            raise RuntimeError(f'Path `{base_dir}` is not an empty directory or is a file')
+        if not path.exists():
+            path.mkdir()
+        cls.open(base_dir, auto_init=True).close()
+
+    @classmethod
+    def open(cls, base_dir, auto_init=False):
+        path = pathlib.Path(base_dir)
+        if not auto_init and not (path / SQLITE_DATABASE_FILE).exists():
+            raise RuntimeError(f'No SQLite database in `{base_dir}`')
+        if not path.exists():
+            path.mkdir()
+        connections = Connections(path / SQLITE_DATABASE_FILE)
+        return cls(base_dir, SqliteCollection(connections), connections)
+
+    @staticmethod
+    def exists(base_dir) -> bool:
+        return (pathlib.Path(base_dir) / SQLITE_DATABASE_FILE).exists()
+
+    def __init__(self, directory, collection: SqliteCollection, connections: Connections):
+        self._dir = directory
+        self.collection = collection
+        self._connections = connections
+
+    def write(self):
+        self._connections.get().commit()
+
+    def compact(self):
+        self._connections.get().execute('VACUUM')
+
+    def close(self):
+        self._connections.close()
+
+    def import_markers(self, markers: Iterable[RelTimeMarker]) -> None:
+        '''
+        Add markers in bulk (e.g. from an `InfoRecDB`), in one transaction.
+        '''
+        self.collection.add_item(*markers)
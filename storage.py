@@ -11,21 +11,37 @@ This module contains all that is related to storage and backend data structures.
 It may be split in the future.
 '''
 
+import bisect
+import codecs
+import collections
+import contextlib
+import datetime
 import itertools
 import json
 import networkx as nx
+import os
 import pathlib
+import threading
 import uuid
 
-from typing import Dict, Iterable, List, Mapping, Optional, Set, Union
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, TypeVar, Union
 from uuid import UUID
 
 import sede
 
+from concurrency import (
+        FileLock,
+        RWLock,
+        )
 from exception import (
+        ConflictError,
         IllegalStateError,
         )
 from helper import delegate
+from search import (
+        DEFAULT_LIMIT,
+        SearchIndex,
+        )
 from model import (
         AbsoluteDateTime,
         Date,
@@ -33,66 +49,275 @@ from model import (
         RelTimeMarker,
         RelTimeSpecImplicit,
         TimeRelativity,
+        compact_marker,
+        )
+from ordering import (
+        INF,
+        UNKNOWN,
+        Bounds,
+        ConflictReport,
+        DynamicTopologicalOrder,
+        ImplicitChain,
+        ImplicitIndex,
+        Period,
+        Timeline,
+        UnionFind,
+        conflict_groups,
+        from_microseconds,
+        implicit_period,
+        microseconds,
+        )
+from snapshot import (
+        BinarySnapshot,
+        dump as dump_binary,
         )
 
 
 DATABASE_FILE = 'db.json'
+BINARY_DATABASE_FILE = 'db.bin'
+JOURNAL_FILE = 'journal.jsonl'
+LOCK_FILE = 'db.lock'
+SEARCH_INDEX_FILE = 'search.json'
+JOURNAL_COMPACT_THRESHOLD = 10000  # Number of journal records triggering a compaction
+SCAN_CHUNK_SIZE = 1 << 20  # Bytes read at once when streaming a database file
+DEFAULT_FLUSH_SIZE = 100  # Number of changed items triggering a write-behind flush
+DEFAULT_FLUSH_INTERVAL = 1.0  # Seconds between the background write-behind flushes
+DEFAULT_FEED_SIZE = 10000  # Number of changes kept for the clients following them
 
 K_COLLECTION = 'collection'
+K_JOURNAL_SEQ = 'journal_seq'
+K_SEQ = 'seq'
+K_OP = 'op'
+K_END = 'end'  # The sequence number of the last record of a group written at once
+OP_ADD = 'add'
+OP_UPDATE = 'update'
 K_TYPE = 'type'
 K_DATA = 'data'
 T_EVENT = 'event'
 T_ABSOLUTEDATETIME = 'absolute_date_time'
 T_DATE = 'date'
-M_T_DES = {
+M_T_DES = {  # type: Dict[str, Callable[[dict], RelTimeMarker]]
         T_ABSOLUTEDATETIME: sede.deserialize_absolutedatetime,
         T_DATE: sede.deserialize_date,
         T_EVENT: sede.deserialise_event,
         }
-M_T_SER = {
-        AbsoluteDateTime: (sede.serialise_event, T_ABSOLUTEDATETIME),
+_JSON_DECODER = json.JSONDecoder()
+
+M_T_SER = {  # type: Dict[type, Tuple[Callable[..., dict], str]]
+        AbsoluteDateTime: (sede.serialize_absolutedatetime, T_ABSOLUTEDATETIME),
         Date: (sede.serialize_date, T_DATE),
         Event: (sede.serialise_event, T_EVENT),
         }
 
 
+RELATION_KINDS = (sede.K_BEFORE, sede.K_AFTER, sede.K_SAME)
+
+T = TypeVar('T')
+
+
+def relations(event: Event) -> Iterator[Tuple[str, UUID]]:
+    '''
+    Generate the (relation, referred id) of the event.
+    '''
+    timespec = event.timespec
+    for kind, tids in zip(RELATION_KINDS, (timespec.befores, timespec.afters, timespec.sames)):
+        for tid in tids or []:
+            yield kind, tid
+
+
+class Memo:
+    '''
+    Results derived from a collection, each computed once per version of it (see `Collection.version`).
+    Only the results of the latest version are kept.
+    '''
+
+    def __init__(self):
+        self._version = None  # type: Optional[int]
+        self._values = {}  # type: Dict[Hashable, object]
+
+    def get(self, version: int, key: Hashable, compute: Callable[[], T]) -> T:
+        if version != self._version:
+            self._values = {}
+            self._version = version
+        if key in self._values:
+            return self._values[key]  # type: ignore
+        value = compute()
+        self._values[key] = value
+        return value
+
+
 class Collection:
+    '''
+    The markers, indexed by id, with their ordering and the references to markers not in the collection.
+    With `compact_model`, the items are stored in the compact representation (see `compact_marker()`), sharing one object per id.
+    `version` is increased by every change, so that the results derived from the collection can be memoized (see `memoized()`).
+    '''
 
-    def __init__(self, initial_rel_markers: Iterable[RelTimeMarker]=[]):
+    def __init__(self, initial_rel_markers: Iterable[RelTimeMarker]=[], compact_model: bool=False):
         self.collection = {}  # type: Dict[UUID, RelTimeMarker]
-        self._dangling_refs = {}  # type: Dict[UUID, Set[UUID]]
+        self._ids = []  # type: List[UUID]  # The ids in the order the items were added, i.e. by position (see `page()`)
+        self._interned = {} if compact_model else None  # type: Optional[Dict[UUID, UUID]]  # The ids referred to but not in the collection
+        self._referrers = {}  # type: Dict[UUID, Dict[str, Set[UUID]]]  # Referred id -> relation -> ids of the events referring to it
+        self._dangling_refs = set()  # type: Set[UUID]  # The referred ids not in the collection
+        self._sames = UnionFind()  # type: UnionFind[UUID]
+        self._ordering = OrderedMarkers(sames=self._sames)
+        self._observers = []  # type: List[Callable[[str, RelTimeMarker], None]]
+        self._memo = Memo()
+        self.version = 0
         self.add_item(*initial_rel_markers)
+        self.version = 0  # The initial items are not a change
+
+    def add_observer(self, observer: Callable[[str, RelTimeMarker], None]) -> None:
+        '''
+        Register a callback, called with the operation (`OP_ADD` or `OP_UPDATE`) and the item after each change.
+        '''
+        self._observers.append(observer)
+
+    def _notify(self, op: str, item: RelTimeMarker) -> None:
+        for observer in self._observers:
+            observer(op, item)
 
-    def _do_dangling_ref(self, timespec, item_id):
-        for tid in itertools.chain(timespec.befores or [], timespec.sames or [], timespec.afters or []):
-            if tid in self.collection:
+    def _intern(self, id: UUID) -> UUID:
+        assert self._interned is not None
+        item = self.collection.get(id)
+        if item is not None:
+            return item.id
+        return self._interned.setdefault(id, id)
+
+    def _link(self, event: Event) -> None:
+        '''
+        Index the relations of the event by the referred ids.
+        '''
+        for kind, tid in relations(event):
+            by_kind = self._referrers.get(tid)
+            if by_kind is None:
+                by_kind = self._referrers[tid] = {}
+            if kind not in by_kind:
+                by_kind[kind] = set()
+            by_kind[kind].add(event.id)
+            if tid not in self.collection:
+                self._dangling_refs.add(tid)
+
+    def _unlink(self, event: Event) -> None:
+        for kind, tid in relations(event):
+            by_kind = self._referrers.get(tid)
+            if by_kind is None or kind not in by_kind:  # A repeated relation, already removed
                 continue
-            if tid not in self._dangling_refs: self._dangling_refs[tid] = set()
-            self._dangling_refs[tid].add(item_id)
+            by_kind[kind].discard(event.id)
+            if not by_kind[kind]:
+                del by_kind[kind]
+                if not by_kind:
+                    del self._referrers[tid]
+                    self._dangling_refs.discard(tid)
 
-    def add_item(self, *item: RelTimeMarker) -> None:
+    def add_item(self, *item: RelTimeMarker, reject_conflict: bool=False) -> None:
+        '''
+        Add the items to the collection.
+        If `reject_conflict` is set, a `ConflictError` is raised (with none of the items added) when they contradict the existing ordering.
+        '''
+        ids = set()  # type: Set[UUID]
         for s_item in item:
             iid = s_item.id
-            if iid in self.collection:
+            if iid in self.collection or iid in ids:
                 raise IllegalStateError('The item you are trying to add has duplicated id with an existing entry.')
-            self.collection[iid] = s_item
+            ids.add(iid)
+        if self._interned is not None:
+            item = tuple(compact_marker(s_item, self._intern) for s_item in item)
+        self._ordering.add(*item, reject_cycle=reject_conflict)
         for s_item in item:
-            iid = s_item.id
+            self.collection[s_item.id] = s_item
+            self._ids.append(s_item.id)
+            if self._interned is not None:
+                self._interned.pop(s_item.id, None)
+        for s_item in item:
+            self._dangling_refs.discard(s_item.id)
             if isinstance(s_item, Event):
-                if iid in self._dangling_refs:
-                    del self._dangling_refs[iid]
-                self._do_dangling_ref(s_item.timespec, iid)
+                self._link(s_item)
+        self.version += 1
+        for s_item in item:
+            self._notify(OP_ADD, s_item)
 
-    def update_item(self, item_id: Union[UUID, str], new_item: RelTimeMarker) -> None:
+    def update_item(self, item_id: Union[UUID, str], new_item: RelTimeMarker, reject_conflict: bool=False) -> None:
+        '''
+        Replace the item of `item_id` with `new_item`.
+        If `reject_conflict` is set, a `ConflictError` is raised (with the item unchanged) when the new item contradicts the existing ordering.
+        '''
         if not isinstance(item_id, UUID):
             item_id = UUID(item_id)
         old_item = self.get_item(item_id)
         assert isinstance(new_item, type(old_item))
+        if self._interned is not None:
+            new_item = compact_marker(new_item, self._intern)
+        self._ordering.update(old_item, new_item, reject_cycle=reject_conflict)
         self.collection[old_item.id] = new_item
-        for iids in self._dangling_refs.values():
-            iids.discard(item_id)
+        if isinstance(old_item, Event):
+            self._unlink(old_item)
         if isinstance(new_item, Event):
-            self._do_dangling_ref(new_item.timespec, item_id)
+            self._link(new_item)
+        self.version += 1
+        self._notify(OP_UPDATE, new_item)
+
+    def _remove_item(self, id: UUID) -> None:
+        '''
+        Remove an item, only to undo its addition.
+        '''
+        item = self.collection.pop(id)
+        if self._ids[-1] == id:  # Undone in the reverse order, so the last one
+            self._ids.pop()
+        else:
+            self._ids.remove(id)
+        if isinstance(item, Event):
+            self._unlink(item)
+        if id in self._referrers:
+            self._dangling_refs.add(id)
+        self._ordering.discard(item)
+        self.version += 1
+
+    def apply(self, operations: Iterable[Tuple[str, RelTimeMarker]], reject_conflict: bool=False) -> None:
+        '''
+        Apply the operations (`OP_ADD` or `OP_UPDATE`, with the item) in order, atomically: if one fails, the ones before are undone before raising.
+        The observers are only notified once all of them are applied.
+        '''
+        for op, item, _ in self._apply(operations, reject_conflict):
+            self._notify(op, item)
+
+    def _apply(self, operations: Iterable[Tuple[str, RelTimeMarker]], reject_conflict: bool=False) -> List[Tuple[str, RelTimeMarker, Optional[RelTimeMarker]]]:
+        '''
+        Like `apply()`, without notifying the observers: return the operations applied, with the items replaced, which can still be undone by `_undo()` (e.g. when a transaction spans several collections).
+        '''
+        observers, self._observers = self._observers, []
+        done = []  # type: List[Tuple[str, RelTimeMarker, Optional[RelTimeMarker]]]
+        try:
+            for op, item in operations:
+                if op == OP_ADD:
+                    self.add_item(item, reject_conflict=reject_conflict)
+                    done.append((op, self.collection[item.id], None))
+                elif op == OP_UPDATE:
+                    old_item = self.get_item(item.id)
+                    self.update_item(item.id, item, reject_conflict=reject_conflict)
+                    done.append((op, self.collection[item.id], old_item))
+                else:
+                    raise ValueError("Unknown operation {}".format(op))
+        except Exception:
+            self._undo(done)
+            raise
+        finally:
+            self._observers = observers
+        return done
+
+    def _undo(self, done: List[Tuple[str, RelTimeMarker, Optional[RelTimeMarker]]]) -> None:
+        '''
+        Undo the operations returned by `_apply()`, without notifying the observers.
+        '''
+        observers, self._observers = self._observers, []
+        try:
+            for op, applied, replaced in reversed(done):
+                if replaced is None:
+                    self._remove_item(applied.id)
+                else:
+                    self.update_item(applied.id, replaced)
+        finally:
+            self._observers = observers
 
     def is_self_contained(self) -> bool:
         '''
@@ -100,6 +325,17 @@ class Collection:
         '''
         return not bool(self._dangling_refs)
 
+    def dangling_refs(self) -> Set[UUID]:
+        return set(self._dangling_refs)
+
+    def referrers(self, id: Union[UUID, str]) -> Dict[str, Set[UUID]]:
+        '''
+        The ids of the events referring to `id` (which may not be in the collection), by relation (`sede.K_BEFORE`, `sede.K_AFTER` or `sede.K_SAME`).
+        '''
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        return {kind: set(ids) for kind, ids in self._referrers.get(id, {}).items()}
+
     def get_item(self, id: Union[UUID, str]) -> RelTimeMarker:
         if not isinstance(id, UUID):
             id = UUID(id)
@@ -114,16 +350,71 @@ class Collection:
     def list(self) -> Iterable[UUID]:
         return self.collection.keys()
 
+    def page(self, start: int=0, limit: Optional[int]=None, where: Optional[Callable[[RelTimeMarker], bool]]=None) -> Tuple[List[RelTimeMarker], Optional[int]]:
+        '''
+        The items satisfying `where`, from the position `start` on, in the order they were added: at most `limit` of them, with the position to continue from (None after the last item).
+        Items are only appended (and an update keeps the position), so a listing can be continued while the collection changes.
+        '''
+        return _page(self._ids, self.collection.__getitem__, start, limit, where)
+
+    def titles(self) -> Iterator[Tuple[str, str]]:
+        '''
+        Generate the id and title of every event.
+        '''
+        for item in self.collection.values():
+            if isinstance(item, Event):
+                yield str(item.id), item.title
+
     def has_no_conflict(self) -> bool:
-        try:
-            return not bool(self.conflicts())
-        except nx.NetworkXUnfeasible:
-            return False
-        return True
+        return self._ordering.is_acyclic()
+
+    def same_group(self, id: Union[UUID, str]) -> Set[UUID]:
+        '''
+        The ids asserted (transitively) to be at the same time as `id`, including itself.
+        '''
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        return self._sames.group(id)
+
+    def same_groups(self) -> Iterable[Set[UUID]]:
+        return self._sames.groups()
+
+    def ordering(self) -> 'OrderedMarkers':
+        return self._ordering
 
-    def conflicts(self):
-        ordered_events = OrderedMarkers(self)
-        return ordered_events.cycles()
+    def conflict_report(self) -> ConflictReport:
+        return self.memoized('conflict_report', self._ordering.conflict_report)
+
+    def conflicts(self, limit: Optional[int]=None) -> List[List[str]]:
+        '''
+        The cycles in the ordering, as lists of item ids. Use `limit` to bound their number, as there can be exponentially many.
+        '''
+        return [[str(node) for node in cycle] for cycle in self.conflict_report().cycles(limit)]
+
+    def memoized(self, key: Hashable, compute: Callable[[], T]) -> T:
+        '''
+        The result of `compute()`, which must only depend on the collection, computed once per version: `key` identifies it.
+        '''
+        return self._memo.get(self.version, key, compute)
+
+    def timeline(self) -> 'MarkerTimeline':
+        '''
+        The queries on the time order of the items (see `MarkerTimeline`), prepared once per version.
+        '''
+        return self.memoized('timeline', lambda: MarkerTimeline(self._ordering, self.list(), self.conflict_report().groups))
+
+
+def _page(ids: Sequence[UUID], get: Callable[[UUID], RelTimeMarker], start: int, limit: Optional[int], where: Optional[Callable[[RelTimeMarker], bool]]) -> Tuple[List[RelTimeMarker], Optional[int]]:
+    items = []  # type: List[RelTimeMarker]
+    i = start
+    while i < len(ids):
+        if limit is not None and len(items) >= limit:
+            return items, i
+        item = get(ids[i])
+        i += 1
+        if where is None or where(item):
+            items.append(item)
+    return items, None
 
 
 # ForeverPast = RelTimeMarker()
@@ -131,79 +422,722 @@ class Collection:
 
 
 class OrderedMarkers:
-    def __init__(self, collection: Collection):
-        g = nx.DiGraph()
-
-        # 並查集建立
-        def current_root(node):
-            if id_merging[node] == node: return node
-            return current_root(id_merging[node])
-        coll = collection.collection.values()
-        id_merging = {}  # k:v <==> event ID : the event ID to a parent node of its group
-        for marker in coll:
-            id_merging[marker.id] = marker.id
-        for marker in coll:
-            if isinstance(marker, Event):
-                sames = marker.timespec.sames
-                if sames:
-                    merged_id = None
-                    for same in sames:
-                        if id_merging[same] != same:
-                            merged_id = id_merging[same]
-                            break
-                    if merged_id:
-                        for same in sames:
-                            root = current_root(same)
-                            id_merging[same] = merged_id
-                        id_merging[marker.id] = merged_id
-        id_merged = {}
-        for marker in coll:
-            id_merged[marker.id] = current_root(marker.id)
-        # 並查集建立完畢
-
-        implicits = []
-        for marker in coll:
+    '''
+    The ordering graph of markers, where an edge `u -> v` means `u` is before `v`.
+    Markers asserted to be the `same` are merged into one node, keyed by the representative of their group in `sames`.
+    It is maintained incrementally: adding or updating a marker only applies the edges it contributes (for `Event`s) or the edges around its day (for implicit markers).
+    While the graph is acyclic, a topological order is maintained along, so that a contradicting edge is found (and possibly rejected) when it is inserted.
+    '''
+
+    def __init__(self, markers: Iterable[RelTimeMarker]=[], sames: Optional[UnionFind[UUID]]=None):
+        self.g = nx.DiGraph()
+        self.sames = sames if sames is not None else UnionFind()  # type: UnionFind[UUID]
+        self._markers = {}  # type: Dict[UUID, RelTimeMarker]
+        self._edge_refs = {}  # type: Dict[Tuple[UUID, UUID], int]  # The number of assertions of each edge (between group representatives)
+        self._implicits = ImplicitChain()
+        self._order = None  # type: Optional[DynamicTopologicalOrder]  # None if the graph is (or may be) cyclic
+        self._order_stale = True  # If the graph may be acyclic while there is no `_order`; it is computed lazily
+        self._bounds = Bounds(self.g, self._own_period)  # Updated lazily too
+        self._bounds_lock = threading.Lock()
+        self.add(*markers)
+
+    def _rebuild(self) -> None:
+        '''
+        Build the graph from scratch. This is needed when a group of `same` markers is split, which the union-find can't do.
+        '''
+        markers = list(self._markers.values())
+        self.g = nx.DiGraph()
+        self.sames.clear()
+        self._markers = {}
+        self._edge_refs = {}
+        self._implicits = ImplicitChain()
+        self._order = None
+        self._order_stale = True
+        self._bounds = Bounds(self.g, self._own_period)
+        self.add(*markers)
+
+    def node(self, id: UUID) -> UUID:
+        '''
+        The node of the marker `id` in the graph.
+        '''
+        return self.sames.find(id)
+
+    def marker(self, id: UUID) -> Optional[RelTimeMarker]:
+        return self._markers.get(id)
+
+    def _own_period(self, node: UUID) -> Period:
+        '''
+        The period of the implicit markers of the node, if any.
+        '''
+        first, last = UNKNOWN
+        for id in self.sames.group(node):
+            marker = self._markers.get(id)
             if isinstance(marker, RelTimeSpecImplicit):
-                implicits.append(marker)
-        implicit_befores = {}
-        implicit_afters = {}
-        for marker in implicits:
-            befores = []
-            afters = []
-            for m2 in implicits:
-                if marker is not m2:
-                    rel = marker.compare(m2)
-                    if rel == TimeRelativity.BEFORE:
-                        befores.append(m2.id)
-                        g.add_edge(marker.id, m2.id)
-                    elif rel == TimeRelativity.AFTER:
-                        afters.append(m2.id)
-                        g.add_edge(m2.id, marker.id)
-            implicit_befores[marker.id] = befores
-            implicit_afters[marker.id] = afters
-
-
-        for marker in coll:
-            if isinstance(marker, Event):
-                node_id_1 = str(id_merged[marker.id])
-                afters = marker.timespec.afters
-                if afters:
-                    for after in afters:
-                        node_id_2 = str(id_merged[after])
-                        g.add_edge(node_id_2, node_id_1)
-                befores = marker.timespec.befores
-                if befores:
-                    for before in befores:
-                        node_id_2 = str(id_merged[before])
-                        g.add_edge(node_id_1, node_id_2)
+                start, end = implicit_period(marker)
+                first, last = max(first, start), min(last, end)
+        return first, last
 
-        self.g = g
+    def bounds(self) -> Bounds:
+        '''
+        The earliest and latest times of the nodes (see `Bounds`), brought up to date with the changes since the last call.
+        '''
+        with self._bounds_lock:  # Updated by readers, maybe concurrently
+            order = self._topological_order()
+            self._bounds.update(None if order is None else order.key)
+            return self._bounds
+
+    def _topological_order(self) -> Optional[DynamicTopologicalOrder]:
+        if self._order is None and self._order_stale:  # Built by readers, maybe concurrently: it is only published once complete
+            if next(conflict_groups(self.g), None) is None:
+                self._order = DynamicTopologicalOrder(self.g)
+            self._order_stale = False
+        return self._order
+
+    def _find_path(self, u: UUID, v: UUID, order: Optional[DynamicTopologicalOrder]) -> Optional[list]:
+        if order is not None:
+            return order.find_path(u, v)
+        if u in self.g and v in self.g and nx.has_path(self.g, u, v):  # Fallback when the graph already has conflicts
+            return nx.shortest_path(self.g, u, v)
+        return None
+
+    def _find_cycle(self, u: UUID, v: UUID, order: Optional[DynamicTopologicalOrder]) -> Optional[list]:
+        if order is not None:
+            return order.insert(u, v)
+        path = self._find_path(v, u, order)
+        return [u] + path[:-1] if path else None
 
-    def cycles(self):
-        return list(nx.simple_cycles(self.g))
+    def _add_edge(self, u: UUID, v: UUID, reject_cycle: bool=False, count: int=1) -> None:
+        '''
+        Add an edge between two nodes (not necessarily representatives).
+        '''
+        u = self.node(u)
+        v = self.node(v)
+        key = (u, v)
+        if key in self._edge_refs:
+            self._edge_refs[key] += count
+            return
+        order = self._topological_order() if reject_cycle else self._order
+        if order is not None or reject_cycle:
+            cycle = self._find_cycle(u, v, order)
+            if cycle:
+                if reject_cycle:
+                    raise ConflictError(key, cycle)
+                self._order = None
+        self._edge_refs[key] = count
+        self.g.add_edge(u, v)
+        self._bounds.touch(u)
+        self._bounds.touch(v)
+
+    def _remove_edge(self, u: UUID, v: UUID) -> None:
+        key = (self.node(u), self.node(v))
+        self._edge_refs[key] -= 1
+        if not self._edge_refs[key]:
+            del self._edge_refs[key]
+            self.g.remove_edge(*key)
+            self._bounds.touch(key[0])
+            self._bounds.touch(key[1])
+            if self._order is None:
+                self._order_stale = True
+
+    def _add_edges(self, edges: Iterable[Tuple[UUID, UUID]], reject_cycle: bool=False) -> None:
+        '''
+        Add the edges, or none of them if one is rejected.
+        '''
+        added = []
+        try:
+            for u, v in edges:
+                self._add_edge(u, v, reject_cycle)
+                added.append((u, v))
+        except ConflictError:
+            for u, v in added:
+                self._remove_edge(u, v)
+            raise
+
+    def _apply_delta(self, delta: Tuple[Set[Tuple[UUID, UUID]], Set[Tuple[UUID, UUID]]], reject_cycle: bool=False) -> None:
+        removed, added = delta
+        for u, v in removed:
+            self._remove_edge(u, v)
+        try:
+            self._add_edges(added, reject_cycle)
+        except ConflictError:
+            for u, v in removed:
+                self._add_edge(u, v)
+            raise
+
+    def _merge(self, id1: UUID, id2: UUID, reject_cycle: bool=False) -> None:
+        '''
+        Merge the nodes of two markers which are the `same`, moving the edges of the absorbed node to the kept one.
+        '''
+        r1 = self.node(id1)
+        r2 = self.node(id2)
+        if r1 == r2:
+            return
+        if reject_cycle:
+            order = self._topological_order()
+            for u, v in ((r1, r2), (r2, r1)):
+                path = self._find_path(u, v, order)
+                if path:
+                    raise ConflictError((id1, id2), path)
+        kept = self.sames.union(r1, r2)
+        absorbed = r2 if kept == r1 else r1
+        moved = []
+        if absorbed in self.g:
+            for edge in set(self.g.out_edges(absorbed)) | set(self.g.in_edges(absorbed)):
+                moved.append((edge, self._edge_refs.pop(edge)))
+            self.g.remove_node(absorbed)
+            if self._order is not None:
+                self._order.discard(absorbed)
+        self.g.add_node(kept)
+        self._bounds.touch(absorbed)
+        self._bounds.touch(kept)
+        for (u, v), count in moved:
+            self._add_edge(u, v, count=count)
+
+    @staticmethod
+    def _event_edges(event: Event) -> List[Tuple[UUID, UUID]]:
+        edges = []
+        for after in event.timespec.afters or []:
+            edges.append((after, event.id))
+        for before in event.timespec.befores or []:
+            edges.append((event.id, before))
+        return edges
+
+    def _add_marker(self, marker: RelTimeMarker, reject_cycle: bool) -> None:
+        self.g.add_node(self.node(marker.id))
+        if isinstance(marker, Event):
+            for same in marker.timespec.sames or []:
+                self._merge(marker.id, same, reject_cycle)
+            self._add_edges(self._event_edges(marker), reject_cycle)
+        elif isinstance(marker, RelTimeSpecImplicit):
+            try:
+                self._apply_delta(self._implicits.add(marker), reject_cycle)
+            except ConflictError:
+                self._implicits.remove(marker)  # The edges are already restored
+                raise
+        self._markers[marker.id] = marker
+        self._bounds.touch(self.node(marker.id))
+
+    def add(self, *markers: RelTimeMarker, reject_cycle: bool=False) -> None:
+        '''
+        Add the markers to the graph.
+        If `reject_cycle` is set, a `ConflictError` is raised (with none of the markers added) when they contradict the existing ordering.
+        '''
+        if not self._markers and not reject_cycle:  # Bulk build
+            self._bounds.reset()
+            implicits = []
+            for marker in markers:
+                self._markers[marker.id] = marker
+                if isinstance(marker, Event):
+                    for same in marker.timespec.sames or []:
+                        self.sames.union(marker.id, same)
+            for marker in markers:
+                self.g.add_node(self.node(marker.id))
+                if isinstance(marker, Event):
+                    self._add_edges(self._event_edges(marker))
+                elif isinstance(marker, RelTimeSpecImplicit):
+                    implicits.append(marker)
+            self._add_edges(self._implicits.extend(implicits))
+            return
+        added = []  # type: List[RelTimeMarker]
+        deferred = []  # type: List[RelTimeSpecImplicit]  # Implicit markers, added at once at the end when none can be rejected
+        try:
+            for marker in markers:
+                if isinstance(marker, RelTimeSpecImplicit) and not reject_cycle:
+                    deferred.append(marker)
+                    continue
+                self._add_marker(marker, reject_cycle)
+                added.append(marker)
+        except ConflictError:
+            if any(isinstance(marker, Event) and marker.timespec.sames for marker in markers):  # Merged groups can't be undone
+                for marker in added:
+                    del self._markers[marker.id]
+                self._rebuild()
+            else:
+                for marker in reversed(added):
+                    self.remove(marker)
+                for marker in markers:
+                    if marker.id in self.g and not self.g.degree(marker.id) and marker.id not in self._markers:
+                        self.g.remove_node(marker.id)
+                        if self._order is not None:
+                            self._order.discard(marker.id)
+                        self._bounds.touch(marker.id)
+            raise
+        for implicit in deferred:
+            assert isinstance(implicit, RelTimeMarker)
+            self.g.add_node(self.node(implicit.id))
+            self._markers[implicit.id] = implicit
+            self._bounds.touch(self.node(implicit.id))
+        if deferred:
+            self._apply_delta(self._implicits.add(*deferred))
+
+    def remove(self, marker: RelTimeMarker) -> None:
+        '''
+        Remove the edges contributed by the marker. The node is kept, as other markers may still refer to it.
+        The marker must not have `sames`, as groups can't be split (use `update()` instead).
+        '''
+        if isinstance(marker, Event):
+            assert not marker.timespec.sames, "Can't remove a marker merged with others"
+            for u, v in self._event_edges(marker):
+                self._remove_edge(u, v)
+        elif isinstance(marker, RelTimeSpecImplicit):
+            self._apply_delta(self._implicits.remove(marker))
+        del self._markers[marker.id]
+        self._bounds.touch(self.node(marker.id))
+
+    def discard(self, marker: RelTimeMarker) -> None:
+        '''
+        Take the marker out of the graph, e.g. to undo its addition. Its node is only kept if other markers refer to it.
+        '''
+        if isinstance(marker, Event) and marker.timespec.sames:
+            del self._markers[marker.id]
+            self._rebuild()
+            return
+        self.remove(marker)
+        node = self.node(marker.id)
+        if node in self.g and not self.g.degree(node) and len(self.sames.group(marker.id)) == 1:
+            self.g.remove_node(node)
+            if self._order is not None:
+                self._order.discard(node)
+            self._bounds.touch(node)
+
+    def update(self, old_marker: RelTimeMarker, new_marker: RelTimeMarker, reject_cycle: bool=False) -> None:
+        old_sames = set(old_marker.timespec.sames or []) if isinstance(old_marker, Event) else set()
+        new_sames = set(new_marker.timespec.sames or []) if isinstance(new_marker, Event) else set()
+        if old_sames <= new_sames:  # The groups only grow
+            if isinstance(old_marker, Event):
+                for u, v in self._event_edges(old_marker):
+                    self._remove_edge(u, v)
+                del self._markers[old_marker.id]
+            else:
+                self.remove(old_marker)
+            try:
+                self.add(new_marker, reject_cycle=reject_cycle)
+            except ConflictError:
+                self.add(old_marker)
+                raise
+            return
+        was_acyclic = self.is_acyclic()
+        self._markers[new_marker.id] = new_marker
+        self._rebuild()
+        if reject_cycle and was_acyclic and not self.is_acyclic():
+            cycle = next(self.conflict_report().cycles())
+            self._markers[old_marker.id] = old_marker
+            self._rebuild()
+            raise ConflictError((cycle[0], cycle[1 % len(cycle)]), cycle)
+
+    def is_acyclic(self) -> bool:
+        return self._topological_order() is not None
+
+    def is_before(self, id1: UUID, id2: UUID) -> bool:
+        '''
+        Test if the marker `id1` is (transitively) before the marker `id2`.
+        '''
+        n1 = self.node(id1)
+        n2 = self.node(id2)
+        return n1 != n2 and n1 in self.g and n2 in self.g and nx.has_path(self.g, n1, n2)
+
+    def conflict_report(self) -> ConflictReport:
+        if self.is_acyclic():
+            return ConflictReport(self.g, [])
+        return ConflictReport(self.g)
+
+    def cycles(self, limit: Optional[int]=None) -> List[List[str]]:
+        return [[str(node) for node in cycle] for cycle in self.conflict_report().cycles(limit)]
+
+
+class MarkerTimeline:
+    '''
+    The `Timeline` of the ordering of the items of a collection, by their ids.
+    The items at the same time (`same`, or in a conflict) share a position. The ties are broken by the order the items were added in (then by id, for the ids referred to but not in the collection).
+    '''
+
+    def __init__(self, ordering: OrderedMarkers, ids: Iterable[UUID], groups: Optional[List[Set[Hashable]]]=None):
+        self._ordering = ordering
+        self._members = {}  # type: Dict[Hashable, List[UUID]]  # The ids in the collection, by node, in the order they were added
+        rank = {}  # type: Dict[Hashable, int]
+        for id in ids:
+            node = ordering.node(id)
+            rank.setdefault(node, len(rank))
+            self._members.setdefault(node, []).append(id)
+        self._timeline = Timeline(ordering.g, lambda node: (rank.get(node, len(rank)), str(node)), groups)
+        self._implicits = None  # type: Optional[ImplicitIndex]
+        self._periods = None  # type: Optional[List[Tuple[float, float, UUID]]]  # The bounds of the items, sorted
+
+    def _node(self, id: Union[UUID, str]) -> UUID:
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        node = self._ordering.node(id)
+        if node not in self._members:
+            raise KeyError(id)
+        return node
+
+    def _ids(self, nodes: Iterable[Hashable]) -> List[UUID]:
+        return [id for node in nodes for id in self._members.get(node, ())]
+
+    def ids(self) -> List[UUID]:
+        '''
+        The ids of the items in time order (a linearization of the ordering).
+        '''
+        return self._ids(self._timeline.nodes())
+
+    def compare(self, id1: Union[UUID, str], id2: Union[UUID, str]) -> TimeRelativity:
+        '''
+        The relativity of the item `id1` to the item `id2`, as in `RelTimeMarker.compare()`.
+        Two implicit markers are compared directly (e.g. a `Date` is `GENERALIZED` to the times of its day); other items by the ordering, where the `same` items are `SAME`, and the unordered (or conflicting) ones `PARALLEL`.
+        '''
+        if not isinstance(id1, UUID):
+            id1 = UUID(id1)
+        if not isinstance(id2, UUID):
+            id2 = UUID(id2)
+        n1 = self._node(id1)
+        n2 = self._node(id2)
+        m1 = self._ordering.marker(id1)
+        m2 = self._ordering.marker(id2)
+        if isinstance(m1, RelTimeSpecImplicit) and isinstance(m2, RelTimeSpecImplicit):
+            relativity = m1.compare(m2)
+            if relativity is not NotImplemented:
+                return relativity
+        return self._timeline.compare(n1, n2)
+
+    def is_before(self, id1: Union[UUID, str], id2: Union[UUID, str]) -> bool:
+        return self._timeline.is_before(self._node(id1), self._node(id2))
+
+    def between(self, after: Union[UUID, str, None]=None, before: Union[UUID, str, None]=None) -> List[UUID]:
+        '''
+        The ids of the items after the item `after` and before the item `before` (either may be omitted), in time order.
+        '''
+        return self._ids(self._timeline.between(
+                None if after is None else self._node(after),
+                None if before is None else self._node(before)))
+
+    def implicits(self) -> ImplicitIndex:
+        '''
+        The implicit markers of the collection, packed for comparing them at once (see `ImplicitIndex`), on the first call.
+        '''
+        if self._implicits is None:
+            markers = (self._ordering.marker(id) for ids in self._members.values() for id in ids)
+            self._implicits = ImplicitIndex(marker for marker in markers if isinstance(marker, (AbsoluteDateTime, Date)))
+        return self._implicits
+
+    def _bounded(self) -> List[Tuple[float, float, UUID]]:
+        if self._periods is None:
+            bounds = self._ordering.bounds()
+            self._periods = sorted(bounds.period(node) + (id,) for node, ids in self._members.items() for id in ids)
+        return self._periods
+
+    def bounds(self, id: Union[UUID, str]) -> Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]:
+        '''
+        The earliest and latest times of the item (as naive UTC times; None if unknown), inferred from the times of the implicit markers before and after it.
+        '''
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        first, last = self._ordering.bounds().period(self._node(id))
+        return (None if first == -INF else from_microseconds(int(first)),
+                None if last == INF else from_microseconds(int(last)))
+
+    def during(self, start: Optional[datetime.datetime]=None, end: Optional[datetime.datetime]=None, possibly: bool=False) -> List[UUID]:
+        '''
+        The ids of the items within the period from `start` to `end` (either may be omitted) according to their bounds, by their earliest times: the ones certainly in it, or with `possibly`, the ones which may be in it.
+        '''
+        periods = self._bounded()
+        first = -INF if start is None else microseconds(start)
+        last = INF if end is None else microseconds(end)
+        if possibly:
+            return [id for _, upper, id in periods[:bisect.bisect_right(periods, (last, INF))] if upper >= first]
+        return [id for _, upper, id in periods[bisect.bisect_left(periods, (first, -INF)):bisect.bisect_right(periods, (last, INF))] if upper <= last]
+
+    def relative_to(self, id: Union[UUID, str], relativity: TimeRelativity) -> List[UUID]:
+        '''
+        The ids of the implicit markers with `relativity` to the implicit marker `id` (e.g. the times of a `Date` are `SPECIALIZED`), in time order.
+        '''
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        anchor = self._ordering.marker(id)
+        if not isinstance(anchor, RelTimeSpecImplicit):
+            raise KeyError(id)
+        return self.implicits().select(anchor, relativity)
+
+
+def _stamp(path: pathlib.Path) -> list:
+    '''
+    Identify the version of a file, e.g. of the snapshot the search index was written with.
+    '''
+    stat = path.stat()
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+
+def _fsync_dir(directory) -> None:
+    if hasattr(os, 'O_DIRECTORY'):  # Not available (nor needed) on Windows
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _entry(marker: RelTimeMarker, compact_ids: bool=False) -> dict:
+    t = type(marker)
+    assert t in M_T_SER, "Collection contains unknown type {}".format(t)
+    return {
+            K_TYPE: M_T_SER[t][1],
+            K_DATA: M_T_SER[t][0](marker, compact_ids),
+            }
+
+
+def _typed_data(entry: dict) -> Tuple[str, dict]:
+    t = entry[K_TYPE]
+    assert t in M_T_DES, "DB with unexpected schema: Unknown type {} in collection".format(t)
+    return t, entry[K_DATA]
+
+
+def _marker(entry: dict) -> RelTimeMarker:
+    t, data = _typed_data(entry)
+    return M_T_DES[t](data)
+
+
+def _markers(entries: Iterable[dict]) -> List[RelTimeMarker]:
+    return sede.deserialize_batch((_typed_data(entry) for entry in entries), M_T_DES)
+
+
+def _index_get(index: Dict[str, Tuple[str, int, int]], id: UUID) -> Optional[Tuple[str, int, int]]:
+    '''
+    Look up an id in an index of the entries of a database file, whose ids may be written in either encoding.
+    '''
+    return index.get(str(id)) or index.get(sede.encode_id(id, compact=True))
+
+
+class _JsonStream:
+    '''
+    Read JSON values one after another from a (UTF-8) binary file, in chunks, keeping track of their byte offsets.
+    '''
+
+    def __init__(self, f):
+        self._f = f
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self.offset = 0  # The byte offset of the current position
+
+    def _fill(self) -> bool:
+        data = self._f.read(SCAN_CHUNK_SIZE)
+        self._buf = self._buf[self._pos:] + self._decoder.decode(data, final=not data)
+        self._pos = 0
+        self._eof = not data
+        return bool(data)
+
+    def peek(self) -> str:
+        '''
+        The next non-whitespace character (skipping it), or an empty string at the end.
+        '''
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\n\r':
+                self._pos += 1
+                self.offset += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError('Expecting {!r} at byte {}'.format(char, self.offset))
+        self._pos += 1
+        self.offset += 1
+
+    def value(self) -> Tuple[object, int, int]:
+        '''
+        Read the next value, and return it with its byte offset and length.
+        '''
+        self.peek()
+        while True:
+            try:
+                obj, end = _JSON_DECODER.raw_decode(self._buf, self._pos)
+                if end == len(self._buf) and not self._eof:  # A number may continue in the next chunk
+                    raise ValueError('Value at the end of the buffer')
+                break
+            except ValueError:
+                if not self._fill():
+                    raise
+        text = self._buf[self._pos:end]
+        offset = self.offset
+        length = len(text) if text.isascii() else len(text.encode('utf-8'))
+        self._pos = end
+        self.offset += length
+        return obj, offset, length
+
+
+def scan_db(path, meta: Optional[Dict[str, object]]=None) -> Iterator[Tuple[dict, int, int]]:
+    '''
+    Stream the entries of the collection in a database file, with their byte offset and length, without loading the whole file.
+    The other top-level fields are put into `meta`.
+    '''
+    with open(path, 'rb') as f:
+        stream = _JsonStream(f)
+        stream.expect('{')
+        while stream.peek() != '}':
+            key = stream.value()[0]
+            stream.expect(':')
+            if key == K_COLLECTION:
+                stream.expect('[')
+                while stream.peek() != ']':
+                    entry, offset, length = stream.value()
+                    assert isinstance(entry, dict)
+                    yield entry, offset, length
+                    if stream.peek() == ',':
+                        stream.expect(',')
+                stream.expect(']')
+            else:
+                value = stream.value()[0]
+                if meta is not None:
+                    assert isinstance(key, str)
+                    meta[key] = value
+            if stream.peek() == ',':
+                stream.expect(',')
+        stream.expect('}')
+
+
+class JsonSnapshot:
+    '''
+    A snapshot in a database file (`db.json`), indexed (id -> type, byte offset, length) by streaming it, so that markers can be read one by one.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        meta = {}  # type: Dict[str, object]
+        self._index = {}  # type: Dict[str, Tuple[str, int, int]]
+        for entry, offset, length in scan_db(path, meta):
+            self._index[entry[K_DATA][sede.K_ID]] = (entry[K_TYPE], offset, length)
+        journal_seq = meta.get(K_JOURNAL_SEQ, 0)
+        assert isinstance(journal_seq, int)
+        self.journal_seq = journal_seq
+
+    def __contains__(self, id: UUID) -> bool:
+        return _index_get(self._index, id) is not None
+
+    def get(self, id: UUID) -> RelTimeMarker:
+        location = _index_get(self._index, id)
+        if location is None:
+            raise KeyError(id)
+        t, offset, length = location
+        with open(self._path, 'rb') as f:
+            f.seek(offset)
+            return _marker(json.loads(f.read(length)))
+
+    def ids(self) -> List[UUID]:
+        return [sede.decode_id(id) for id in self._index]
+
+    def titles(self) -> Iterator[Tuple[UUID, str]]:
+        '''
+        Stream the file for the titles of the events, without deserializing anything else.
+        '''
+        for entry, _, _ in scan_db(self._path):
+            if entry[K_TYPE] == T_EVENT:
+                data = entry[K_DATA]
+                yield sede.decode_id(data[sede.K_ID]), data[sede.K_TITLE]
+
+
+Snapshot = Union[JsonSnapshot, BinarySnapshot]
+
+
+@delegate('_materialized', 'add_item', 'update_item', 'apply', 'is_self_contained', 'dangling_refs', 'referrers', 'has_no_conflict', 'conflict_report', 'conflicts', 'memoized', 'ordering', 'same_group', 'same_groups', 'timeline')
+class LazyCollection:
+    '''
+    A `Collection` read lazily from a snapshot (`JsonSnapshot` or `BinarySnapshot`), which only indexes (or maps) the file when opening.
+    A marker is deserialized when it is first asked for, so `page()` only reads the markers up to the end of the page, and `titles()` reads the titles without deserializing anything else.
+    Anything needing the whole collection (changes, self-containment, ordering and conflicts) loads it fully first, then delegates to a `Collection`.
+    '''
+
+    def __init__(self, snapshot: Snapshot, journaled: Optional[Dict[UUID, RelTimeMarker]]=None, compact_model: bool=False):
+        self._snapshot = snapshot  # type: Optional[Snapshot]
+        self._compact_model = compact_model
+        self._journaled = journaled or {}  # type: Dict[UUID, RelTimeMarker]  # Markers changed after the snapshot
+        self._cache = {}  # type: Dict[UUID, RelTimeMarker]
+        self._observers = []  # type: List[Callable[[str, RelTimeMarker], None]]
+        self._full = None  # type: Optional[Collection]
+
+    @property
+    def _materialized(self) -> Collection:
+        if self._full is None:
+            self._full = Collection((self.get_item(id) for id in self.list()), compact_model=self._compact_model)
+            for observer in self._observers:
+                self._full.add_observer(observer)
+            self._cache = {}
+            self._snapshot = None  # Not needed any more (and releases the mapping of a binary snapshot)
+        return self._full
+
+    @property
+    def collection(self) -> Dict[UUID, RelTimeMarker]:
+        return self._materialized.collection
+
+    @property
+    def version(self) -> int:
+        return self._full.version if self._full is not None else 0
+
+    def add_observer(self, observer: Callable[[str, RelTimeMarker], None]) -> None:
+        if self._full is not None:
+            self._full.add_observer(observer)
+        else:
+            self._observers.append(observer)
+
+    def get_item(self, id: Union[UUID, str]) -> RelTimeMarker:
+        if self._full is not None:
+            return self._full.get_item(id)
+        assert self._snapshot is not None
+        if not isinstance(id, UUID):
+            id = UUID(id)
+        if id in self._journaled:
+            return self._journaled[id]
+        if id not in self._cache:
+            self._cache[id] = self._snapshot.get(id)
+        return self._cache[id]
+
+    def get_event(self, id: Union[UUID, str]) -> Event:
+        item = self.get_item(id)
+        if not isinstance(item, Event):
+            raise RuntimeError("The requested item {} is not an Event, but a {}".format(id, type(item)))
+        return item
+
+    def list(self) -> Iterable[UUID]:
+        if self._full is not None:
+            return self._full.list()
+        assert self._snapshot is not None
+        ids = self._snapshot.ids()
+        snapshot = self._snapshot
+        ids.extend(id for id in self._journaled if id not in snapshot)
+        return ids
+
+    def page(self, start: int=0, limit: Optional[int]=None, where: Optional[Callable[[RelTimeMarker], bool]]=None) -> Tuple[List[RelTimeMarker], Optional[int]]:
+        '''
+        Like `Collection.page()`, in the order of `list()` (which is the order of the collection once loaded).
+        '''
+        if self._full is not None:
+            return self._full.page(start, limit, where)
+        return _page(list(self.list()), self.get_item, start, limit, where)
+
+    def titles(self) -> Iterator[Tuple[str, str]]:
+        if self._full is not None:
+            yield from self._full.titles()
+            return
+        assert self._snapshot is not None
+        for id, title in self._snapshot.titles():
+            if id not in self._journaled:
+                yield str(id), title
+        for marker in self._journaled.values():
+            if isinstance(marker, Event):
+                yield str(marker.id), marker.title
 
 
 class InfoRecDB:
+    '''
+    The database stored in a directory, as a snapshot of the collection (`db.json`, or `db.bin` in the binary format), and optionally a journal (`journal.jsonl`) of the changes made after the snapshot.
+    With `journal` enabled, `write()` appends the changes since the last write to the journal (O(1) per change, and replayed all or none), and the snapshot is only rewritten by `compact()`, which happens automatically once the journal is long enough.
+    Otherwise, `write()` rewrites the whole snapshot.
+    The journal (if any) is always replayed when opening.
+
+    A directory has a single writer process: `open()` takes an exclusive lock on `db.lock`, held until `close()` (or the process exits), and fails if another process holds it.
+    Other processes can still open it with `read_only`, to read the state committed so far (they don't see the later changes, nor repair the journal).
+    To serve from several processes, either use one process with many threads (see `App`), or the SQLite storage, which locks by itself.
+    Within a process, the collection is not thread-safe: share it through `App`.
+    '''
 
     @staticmethod
     def not_exists_or_empty_dir(dir_path):
@@ -214,20 +1148,119 @@ class InfoRecDB:
         return not bool(subs)
 
     @staticmethod
-    def read_db(directory):
-        path = pathlib.Path(directory) / DATABASE_FILE
-        with open(path, 'r') as f:
-            dic = json.load(f)
-            coll = []
-            for entry in dic[K_COLLECTION]:
-                t = entry[K_TYPE]
-                assert t in M_T_DES, "DB with unexpected schema: Unknown type {} in collection".format(t)
-                marker = M_T_DES[t](entry[K_DATA])
-                coll.append(marker)
-            return Collection(coll)
+    def _replay_journal(directory, seq: int, repair: bool=True) -> Iterator[Tuple[int, str, RelTimeMarker]]:
+        '''
+        Generate the (sequence number, operation, marker) of the journal records after `seq`.
+        The records written at once form a group, which is replayed entirely or not at all: an incomplete group or a torn record at the end of the journal (from a crash while appending, or being appended by the writer) is discarded, and truncated with `repair`.
+        '''
+        journal_path = pathlib.Path(directory) / JOURNAL_FILE
+        if not journal_path.exists():
+            return
+        with open(journal_path, 'rb+' if repair else 'rb') as f:
+            offset = 0  # The end of the last complete group
+            position = 0
+            group = []  # type: List[dict]
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Incomplete record')
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                position += len(line)
+                group.append(record)
+                if record.get(K_END, record[K_SEQ]) > record[K_SEQ]:  # The group goes on
+                    continue
+                offset = position
+                for record in group:
+                    if record[K_SEQ] > seq:  # Not in the snapshot yet
+                        yield record[K_SEQ], record[K_OP], _marker(record)
+                group = []
+            if repair and offset < os.fstat(f.fileno()).st_size:
+                f.truncate(offset)
+
+    @staticmethod
+    def _check_replay(op: str, marker: RelTimeMarker, exists: bool) -> None:
+        if op == OP_ADD:
+            if exists:
+                raise IllegalStateError('Journal adds an item {} which already exists'.format(marker.id))
+        elif not exists:
+            raise IllegalStateError('Journal updates an item {} which does not exist'.format(marker.id))
+
+    @staticmethod
+    def _snapshot_path(directory) -> pathlib.Path:
+        '''
+        The snapshot file in `directory`: the binary one or the JSON one, whichever exists, or the latest one if both do (after an interrupted `compact()`).
+        '''
+        path = pathlib.Path(directory)
+        json_path = path / DATABASE_FILE
+        binary_path = path / BINARY_DATABASE_FILE
+        if not binary_path.exists():
+            return json_path
+        if json_path.exists() and json_path.stat().st_mtime_ns > binary_path.stat().st_mtime_ns:
+            return json_path
+        return binary_path
 
     @classmethod
-    def init(cls, base_dir):
+    def _read(cls, directory, compact_model: bool=False, repair: bool=True) -> Tuple[Collection, int, int]:
+        '''
+        Read the snapshot and replay the journal, returning the collection, the sequence number of the last change, and the number of journal records replayed.
+        '''
+        path = cls._snapshot_path(directory)
+        markers = {}  # type: Dict[UUID, RelTimeMarker]
+        if path.name == BINARY_DATABASE_FILE:
+            snapshot = BinarySnapshot.open(path)
+            seq = snapshot.journal_seq
+            for marker in snapshot.markers():
+                markers[marker.id] = marker
+        else:
+            with open(path, 'r') as f:
+                dic = json.load(f)
+            seq = dic.get(K_JOURNAL_SEQ, 0)
+            for marker in _markers(dic[K_COLLECTION]):
+                markers[marker.id] = marker
+        replayed = 0
+        for seq, op, marker in cls._replay_journal(directory, seq, repair):
+            cls._check_replay(op, marker, marker.id in markers)
+            markers[marker.id] = marker
+            replayed += 1
+        return Collection(markers.values(), compact_model=compact_model), seq, replayed
+
+    @classmethod
+    def _read_lazy(cls, directory, compact_model: bool=False, repair: bool=True) -> Tuple['LazyCollection', int, int]:
+        '''
+        Like `_read()`, but only index (or map) the snapshot, and keep the markers from the journal aside.
+        '''
+        path = cls._snapshot_path(directory)
+        snapshot = BinarySnapshot.open(path) if path.name == BINARY_DATABASE_FILE else JsonSnapshot(path)  # type: Snapshot
+        seq = snapshot.journal_seq
+        replayed = 0
+        journaled = {}  # type: Dict[UUID, RelTimeMarker]
+        for seq, op, marker in cls._replay_journal(directory, seq, repair):
+            cls._check_replay(op, marker, marker.id in journaled or marker.id in snapshot)
+            journaled[marker.id] = marker
+            replayed += 1
+        return LazyCollection(snapshot, journaled, compact_model), seq, replayed
+
+    @classmethod
+    def _open_search_index(cls, directory, collection, repair: bool=True) -> SearchIndex:
+        '''
+        Load the search index written along the snapshot, and replay the journal into it; or build it from the collection, if it is missing or out of date.
+        '''
+        loaded = SearchIndex.load(pathlib.Path(directory) / SEARCH_INDEX_FILE, _stamp(cls._snapshot_path(directory)))
+        if loaded is None:
+            return SearchIndex.of(collection.collection.values())
+        index, seq = loaded
+        for _, op, marker in cls._replay_journal(directory, seq, repair):
+            index.record(op, marker)
+        return index
+
+    @classmethod
+    def read_db(cls, directory):
+        return cls._read(directory)[0]
+
+    @classmethod
+    def init(cls, base_dir, binary=False):
         if not cls.not_exists_or_empty_dir(base_dir):
             raise RuntimeError(f'Path `{base_dir}` is not an empty directory or is a file')
 
@@ -235,44 +1268,375 @@ class InfoRecDB:
         if not path.exists():
             path.mkdir()
         collection = Collection()
-        db = cls(base_dir, collection)
+        db = cls(base_dir, collection, binary=binary)
         db.write()
 
     @classmethod
-    def open(cls, base_dir, auto_init=False):
-        if auto_init:
+    def open(cls, base_dir, auto_init=False, journal=False, lazy=False, compact_ids=False, binary=None, compact_model=False, read_only=False, search=False):
+        '''
+        Open the database in `base_dir`.
+        With `lazy`, the collection is only indexed, and markers are read when needed (see `LazyCollection`).
+        With `compact_ids`, ids are written in their compact (base64) encoding; both encodings are always read.
+        `binary` chooses the format of the snapshot written from now on (see `snapshot`); by default, the format of the existing one is kept.
+        With `compact_model`, the markers are kept in memory in their compact representation (see `Collection`).
+        Unless `read_only`, the writer lock (`db.lock`) is taken, so that a directory is opened for writing by one process at a time: a second one (e.g. a server and the CLI `add`, or the Flask reloader) fails with `IllegalStateError`.
+        With `read_only`, the writer lock is not taken, and the database can't be written.
+        With `search`, the events are indexed for full-text search (see `search_index`); the index is written along the snapshot, so that it's only rebuilt if it's out of date.
+        '''
+        if auto_init and not read_only:
             if cls.not_exists_or_empty_dir(base_dir):
-                cls.init(base_dir)
-        collection = cls.read_db(base_dir)
-        return cls(base_dir, collection)
+                cls.init(base_dir, binary=bool(binary))
+        lock = None
+        if not read_only:  # One writer process per directory
+            lock = FileLock(pathlib.Path(base_dir) / LOCK_FILE)
+            lock.acquire()
+        try:
+            if binary is None:
+                binary = cls._snapshot_path(base_dir).name == BINARY_DATABASE_FILE
+            collection, seq, replayed = cls._read_lazy(base_dir, compact_model, not read_only) if lazy else cls._read(base_dir, compact_model, not read_only)  # type: Tuple[Union[Collection, LazyCollection], int, int]
+            search_index = cls._open_search_index(base_dir, collection, not read_only) if search else None
+        except BaseException:
+            if lock is not None:
+                lock.release()
+            raise
+        db = cls(base_dir, collection, journal=journal, seq=seq, compact_ids=compact_ids, binary=binary, read_only=read_only)
+        db._journal_records = replayed
+        db._lock = lock
+        if search_index is not None:
+            db.search_index = search_index
+            collection.add_observer(search_index.record)
+        return db
 
-    def __init__(self, directory, collection):
+    def __init__(self, directory, collection, journal=False, seq=0, compact_ids=False, binary=False, read_only=False):
         self._dir = directory
         self.collection = collection
+        self.read_only = read_only
+        self._lock = None  # type: Optional[FileLock]  # The writer lock, if taken by `open()`
+        self._journal = journal
+        self._compact_ids = compact_ids
+        self._binary = binary
+        self._seq = seq  # The sequence number of the last change (in the journal or the snapshot)
+        self._pending = []  # type: List[dict]  # The journal records not written yet
+        self._journal_records = 0
+        self.compact_threshold = JOURNAL_COMPACT_THRESHOLD  # type: Optional[int]  # The journal records triggering a compaction in `write()`, or None to never compact there
+        self.search_index = None  # type: Optional[SearchIndex]
+        if journal:
+            collection.add_observer(self._record)
+
+    def _record(self, op: str, marker: RelTimeMarker) -> None:
+        self._seq += 1
+        record = _entry(marker, self._compact_ids)
+        record[K_SEQ] = self._seq
+        record[K_OP] = op
+        self._pending.append(record)
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise IllegalStateError('Database `{}` is opened read-only'.format(self._dir))
+
+    @property
+    def journal(self) -> bool:
+        return self._journal
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def journal_records(self) -> int:
+        '''
+        The number of records in the journal, i.e. of the changes written since the snapshot.
+        '''
+        return self._journal_records
+
+    def take_pending(self) -> List[dict]:
+        '''
+        Take the journal records not written yet, as a group, to be written by `append()` (in the order they are taken).
+        This only needs the collection not to change, while `append()` does the I/O: see `App.flush()`.
+        '''
+        records, self._pending = self._pending, []
+        if len(records) > 1:
+            end = records[-1][K_SEQ]
+            for record in records:
+                record[K_END] = end
+        return records
+
+    def append(self, records: List[dict]) -> None:
+        '''
+        Append the records to the journal, durably.
+        '''
+        self._check_writable()
+        if not records:
+            return
+        path = pathlib.Path(self._dir) / JOURNAL_FILE
+        with open(path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_records += len(records)
+
+    def needs_compaction(self) -> bool:
+        return self.compact_threshold is not None and self._journal_records >= self.compact_threshold
 
     def write(self):
-        path = pathlib.Path(self._dir) / DATABASE_FILE
-        dic = {}
-        coll = []
-        for marker in self.collection.collection.values():
-            t = type(marker)
-            assert t in M_T_SER, "Collection contains unknown type {}".format(t)
-            entry = {
-                    K_TYPE: M_T_SER[t][1],
-                    K_DATA: M_T_SER[t][0](marker),
-                    }
-            coll.append(entry)
-        dic[K_COLLECTION] = coll
-        with open(path, 'w') as f:
-            json.dump(dic, f)
+        self._check_writable()
+        if not self._journal:
+            self.compact()
+            return
+        self.append(self.take_pending())
+        if self.needs_compaction():
+            self.compact()
+
+    def compact(self):
+        '''
+        Write the whole collection as the new snapshot (atomically, through a temporary file), and truncate the journal.
+        The snapshot in the other format, if any, is removed afterwards.
+        The search index (if any) is written after the snapshot, tagged with it.
+        '''
+        self._check_writable()
+        directory = pathlib.Path(self._dir)
+        path = directory / (BINARY_DATABASE_FILE if self._binary else DATABASE_FILE)
+        tmp_path = path.with_name(path.name + '.tmp')
+        markers = self.collection.collection.values()
+        if self._binary:
+            with open(tmp_path, 'wb') as f:
+                dump_binary(markers, f, self._seq)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            dic = {}  # type: Dict[str, object]
+            coll = []
+            for marker in markers:
+                coll.append(_entry(marker, self._compact_ids))
+            dic[K_COLLECTION] = coll
+            dic[K_JOURNAL_SEQ] = self._seq
+            with open(tmp_path, 'w') as f:
+                json.dump(dic, f)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self._dir)
+        if self.search_index is not None:
+            self.search_index.dump(directory / SEARCH_INDEX_FILE, _stamp(path), self._seq)
+        self._pending = []
+        other_path = directory / (DATABASE_FILE if self._binary else BINARY_DATABASE_FILE)
+        if other_path.exists():
+            other_path.unlink()
+        journal_path = directory / JOURNAL_FILE
+        if journal_path.exists():
+            journal_path.unlink()
+        self._journal_records = 0
+
+    def close(self):
+        '''
+        Release the writer lock. The changes not written yet are discarded.
+        '''
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
+
+
+class ChangeFeed:
+    '''
+    The latest changes of a collection (as an observer of it), numbered in sequence, in a ring buffer of `size` changes, for clients to follow them (e.g. to keep a replica).
+    A change is a journal record: the item (with its relations), its operation (`K_OP`) and its sequence number (`K_SEQ`).
+    The clients resume from a cursor, which is only valid for this feed (e.g. not after a restart).
+    '''
+
+    def __init__(self, size: int=DEFAULT_FEED_SIZE):
+        self.id = uuid.uuid4().hex[:8]
+        self.seq = 0  # The sequence number of the last change
+        self._changes = collections.deque(maxlen=size)  # type: collections.deque
+        self._cond = threading.Condition()
+        self._subscribers = []  # type: List[Callable[[int], None]]
+
+    def record(self, op: str, item: RelTimeMarker) -> None:
+        change = _entry(item)
+        with self._cond:
+            self.seq += 1
+            change[K_SEQ] = self.seq
+            change[K_OP] = op
+            self._changes.append(change)
+            self._cond.notify_all()
+        for subscriber in self._subscribers:
+            subscriber(self.seq)
+
+    def subscribe(self, callback: Callable[[int], None]) -> None:
+        '''
+        Register a callback, called with the sequence number after each change (in the thread making it; e.g. to wake an event loop).
+        '''
+        self._subscribers.append(callback)
+
+    def cursor(self, seq: int) -> str:
+        return '{}-{}'.format(self.id, seq)
+
+    def parse_cursor(self, cursor: Optional[str]) -> Optional[int]:
+        '''
+        The sequence number of the cursor, or None if it isn't one of this feed.
+        '''
+        if not cursor:
+            return None
+        id, _, seq = cursor.partition('-')
+        if id != self.id or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        return int(seq)
+
+    def since(self, seq: int) -> Optional[List[dict]]:
+        '''
+        The changes after `seq`, or None if they are not all kept any more.
+        '''
+        with self._cond:
+            oldest = self._changes[0][K_SEQ] if self._changes else self.seq + 1
+            if seq < oldest - 1:
+                return None
+            return list(itertools.islice(self._changes, seq - oldest + 1, None))
+
+    def wait(self, seq: int, timeout: Optional[float]) -> bool:
+        '''
+        Wait for a change after `seq`, at most `timeout` seconds. Return if there is one.
+        '''
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seq > seq, timeout)
 
 
 class App:
-    def __init__(self, db_dir, auto_init=True):
-        self.db = InfoRecDB.open(db_dir, auto_init)
+    '''
+    The database opened for an application, which may be shared by threads.
+    Reads should be made within `reading()`, and changes within `transaction()`: they hold a readers-writer lock, so that reads run concurrently, but not with a change.
+    (Reads aren't blocked by the commits: `flush()` and `compact()` only hold the lock for reading, and exclude each other; and the journal is written after releasing it.)
+    With `write_behind`, the changes are committed by groups, in a background thread: every `flush_interval` seconds, or as soon as `flush_size` items are changed; `close()` flushes the remaining ones.
+    With `read_only`, the database is opened without taking the writer lock of `InfoRecDB`, so with a writer process running (and without seeing its later changes).
+    With `feed_size`, the changes are kept in a `ChangeFeed` (`feed`), followed with `changes()`.
+    With `search`, the events are indexed for `search()` (in memory only with SQLite or shards).
+    The database may also be sharded (see `ShardedInfoRecDB`), in which case the changes are always journaled.
+    '''
+
+    def __init__(self, db_dir, auto_init=True, journal=False, lazy=False, binary=None, write_behind=False, flush_size=DEFAULT_FLUSH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, read_only=False, feed_size: Optional[int]=None, search=False):
+        from sqlite_storage import SqliteInfoRecDB  # It depends on this module
+        from sharded_storage import ShardedInfoRecDB  # Same
+        self.search_index = None  # type: Optional[SearchIndex]
+        if SqliteInfoRecDB.exists(db_dir) or ShardedInfoRecDB.exists(db_dir):
+            self.db = SqliteInfoRecDB.open(db_dir) if SqliteInfoRecDB.exists(db_dir) else ShardedInfoRecDB.open(db_dir, read_only=read_only)
+            if search:
+                self.search_index = SearchIndex.of(self.db.collection.markers())
+                self.db.collection.add_observer(self.search_index.record)
+        else:
+            self.db = InfoRecDB.open(db_dir, auto_init, journal=journal, lazy=lazy, binary=binary, read_only=read_only, search=search)
+            self.search_index = self.db.search_index
+        self.read_only = read_only
+        self.lock = RWLock()
+        self._flush_lock = threading.Lock()
+        self._dirty = set()  # type: Set[UUID]  # The items changed since the last flush
+        self._flush_size = flush_size
+        self._stop = None  # type: Optional[threading.Event]
+        self._wake = threading.Event()
+        self.feed = None  # type: Optional[ChangeFeed]
+        if feed_size:
+            self.feed = ChangeFeed(feed_size)
+            self.db.collection.add_observer(self.feed.record)
+        self._journaled = not isinstance(self.db, SqliteInfoRecDB) and self.db.journal
+        if write_behind and not isinstance(self.db, SqliteInfoRecDB) and not read_only:  # SQLite commits each change already
+            self.db.collection.add_observer(self._changed)
+            self._stop = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,), name='inforec-flusher', daemon=True)
+            self._flusher.start()
+
+    def _changed(self, op: str, item: RelTimeMarker) -> None:
+        self._dirty.add(item.id)
+        if len(self._dirty) >= self._flush_size:
+            self._wake.set()  # Flushed by the flusher thread, without blocking the change
+
+    def _flush_periodically(self, interval: float) -> None:
+        assert self._stop is not None
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            if self._dirty:
+                self.flush()
+
+    @contextlib.contextmanager
+    def reading(self) -> Iterator:
+        '''
+        Hold the lock for reading the collection, which is given.
+        The results should be built within, as the collection may change afterwards.
+        '''
+        with self.lock.read():
+            yield self.collection()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator:
+        '''
+        Hold the lock for changing the collection, which is given.
+        '''
+        with self.lock.write():
+            yield self.collection()
 
     def collection(self):
         return self.db.collection
 
+    def search(self, query: str, limit: Optional[int]=DEFAULT_LIMIT) -> List[Tuple[UUID, float]]:
+        '''
+        The ids of the events matching the query, with their scores (see `SearchIndex.search()`).
+        '''
+        if self.search_index is None:
+            raise IllegalStateError('The events are not indexed (see `search`)')
+        with self.lock.read():
+            return self.search_index.search(query, limit)
+
+    def changes(self, cursor: Optional[str], timeout: float=0) -> dict:
+        '''
+        The changes after `cursor` (the `next` of the previous call), waiting for one at most `timeout` seconds (long polling).
+        If they are not all kept any more (or `cursor` isn't valid, e.g. None at first), the whole collection (`items`) is given instead, with `resync`.
+        '''
+        feed = self.feed
+        if feed is None:
+            raise IllegalStateError('The changes are not recorded (see `feed_size`)')
+        seq = feed.parse_cursor(cursor)
+        if seq is not None:
+            if timeout:
+                feed.wait(seq, timeout)
+            changes = feed.since(seq)
+            if changes is not None:
+                return {'changes': changes, 'next': feed.cursor(changes[-1][K_SEQ] if changes else seq)}
+        with self.reading() as collection:
+            items, _ = collection.page()
+            return {'resync': True, 'items': [_entry(item) for item in items], 'next': feed.cursor(feed.seq)}
+
     def flush(self):
-        self.db.write()
+        '''
+        Commit the changes.
+        With a journal, the records are only taken under the lock, and appended after releasing it, so that the changes are not blocked by the I/O (unless flushing from a change).
+        '''
+        with contextlib.ExitStack() as reading:
+            reading.enter_context(self.lock.read())
+            with self._flush_lock:
+                self._dirty.clear()
+                if not self._journaled:
+                    self.db.write()
+                    return
+                if self.db.needs_compaction():  # After the previous flush
+                    self.db.compact()
+                    return
+                records = self.db.take_pending()
+                reading.close()  # Releasing the lock, but not `_flush_lock`, so that the records are appended in order
+                self.db.append(records)
+
+    def compact(self):
+        with self.lock.read(), self._flush_lock:
+            self.db.compact()
+            self._dirty.clear()
+
+    def close(self):
+        '''
+        Flush the changes (unless read-only), and close the database.
+        '''
+        if self._stop is not None:
+            self._stop.set()
+            self._wake.set()
+            self._flusher.join()
+            self._stop = None
+        if not self.read_only:
+            self.flush()
+        self.db.close()
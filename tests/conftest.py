@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+
+'''
+Shared fixtures. The modules of the package are at the root of the repository, so it is put on the path.
+'''
+
+import datetime
+import os
+import random
+import sys
+import uuid
+
+import pytest
+
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import AbsoluteDateTime, Date, EventBuilder, RelTimeMarker  # noqa: E402
+from storage import _entry  # noqa: E402
+
+
+def random_id(rng: random.Random) -> uuid.UUID:
+    return uuid.UUID(int=rng.getrandbits(128))
+
+
+def random_markers(rng: random.Random, n_events: int, n_anchors: int=0, n_dangling: int=0, same_rate: float=0.1) -> List[RelTimeMarker]:
+    '''
+    Dates and times within a few days, then events ordered randomly against them, each other, and `n_dangling` ids not in the collection.
+    '''
+    anchors = []  # type: List[RelTimeMarker]
+    for _ in range(n_anchors):
+        day = datetime.date(2021, 3, 1) + datetime.timedelta(days=rng.randrange(10))
+        if rng.random() < 0.5:
+            anchors.append(Date(random_id(rng), day))
+        else:
+            anchors.append(AbsoluteDateTime(random_id(rng), datetime.datetime.combine(day, datetime.time(rng.randrange(24)))))
+    ids = [random_id(rng) for _ in range(n_events)]
+    pool = ids + [anchor.id for anchor in anchors] + [random_id(rng) for _ in range(n_dangling)]
+    events = []  # type: List[RelTimeMarker]
+    for id in ids:
+        builder = EventBuilder('event {}'.format(len(events))).id(id)
+        for _ in range(rng.randrange(3)):
+            other = rng.choice(pool)
+            if other == id:
+                continue
+            if rng.random() < same_rate:
+                builder.same(other)
+            elif rng.random() < 0.5:
+                builder.before(other)
+            else:
+                builder.after(other)
+        events.append(builder.build())
+    return anchors + events
+
+
+def special_markers(rng: random.Random) -> List[RelTimeMarker]:
+    '''
+    Markers exercising the corners of the formats: time zones, non-ASCII and empty strings, missing descriptions, repeated relations.
+    '''
+    tz = datetime.timezone(datetime.timedelta(hours=-5, minutes=-30))
+    moment = AbsoluteDateTime(random_id(rng), datetime.datetime(2021, 5, 8, 23, 31, 49, 123456, tzinfo=tz))
+    naive = AbsoluteDateTime(random_id(rng), datetime.datetime(1969, 12, 31, 23, 59))
+    day = Date(random_id(rng), datetime.date(1900, 2, 28))
+    event = EventBuilder('Réunion 会议').desc('').after(moment.id).after(moment.id).before(day.id).build()
+    bare = EventBuilder('').build()
+    return [moment, naive, day, event, bare]
+
+
+def entries(markers) -> list:
+    '''
+    The markers as comparable (JSON) entries, as they don't compare themselves.
+    '''
+    return [_entry(marker) for marker in markers]
+
+
+@pytest.fixture
+def rng():
+    return random.Random(0)
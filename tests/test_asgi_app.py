@@ -0,0 +1,159 @@
+# -*- coding:utf-8 -*-
+
+import asyncio
+import datetime
+import json
+import urllib.parse
+import uuid
+
+from model import Date, EventBuilder
+
+from asgi_app import AsgiApp
+
+
+class Client:
+    '''
+    Calls the ASGI application directly, as a server would.
+    '''
+
+    def __init__(self, app: AsgiApp):
+        self.app = app
+
+    async def request(self, method: str, path: str, query=None, body=None, headers=None):
+        sent = []
+        payload = json.dumps(body).encode() if body is not None else b''
+        scope = {
+                'type': 'http',
+                'method': method,
+                'path': path,
+                'query_string': urllib.parse.urlencode(query or {}).encode(),
+                'headers': [(b'content-type', b'application/json')] + [(name.encode(), value.encode()) for name, value in (headers or {}).items()],
+                }
+
+        async def receive():
+            return {'type': 'http.request', 'body': payload, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        start, content = sent
+        response_headers = dict(start['headers'])
+        data = json.loads(content['body']) if content['body'] else None
+        return start['status'], data, response_headers.get(b'etag', b'').decode() or None
+
+
+def serve(tmp_path, scenario) -> None:
+    '''
+    Run `scenario(client)` against an application started in one event loop (as the feed notifies it).
+    '''
+    async def main():
+        app = AsgiApp(tmp_path / 'db', threads=4, processes=1)
+        await app.startup()
+        try:
+            await scenario(Client(app))
+        finally:
+            await app.shutdown()
+    asyncio.run(main())
+
+
+def test_events(tmp_path):
+    async def scenario(client):
+        status, a, _ = await client.request('POST', '/api/event', body={'title': 'a'})
+        assert status == 200
+        status, b, _ = await client.request('POST', '/api/event', body={'title': 'b', 'after': a})
+        assert status == 200
+        status, event, tag = await client.request('GET', '/api/event/{}'.format(b))
+        assert status == 200 and event['title'] == 'b'
+        assert (await client.request('GET', '/api/event/{}'.format(b), headers={'if-none-match': '"{}"'.format(tag)}))[0] == 304
+        status, referrers, _ = await client.request('GET', '/api/event/{}/referrers'.format(a))
+        assert status == 200 and referrers == {'after': [b]}
+        status, error, _ = await client.request('POST', '/api/event/{}'.format(a), body={'title': 'a', 'after': b})
+        assert status == 409 and set(error['cycle']) == {a, b}
+        status, ids, _ = await client.request('POST', '/api/transaction', body={'operations': [{'title': 'c', 'before': a}, {'op': 'update', 'id': b, 'title': 'b, renamed', 'after': a}]})
+        assert status == 200 and len(ids) == 2
+        status, timeline, _ = await client.request('GET', '/api/timeline')
+        assert status == 200 and timeline == [ids[0], a, b]
+        status, listing, _ = await client.request('GET', '/api/event', query={'title': 'renamed', 'fields': 'id'})
+        assert status == 200 and listing == {'events': [{'id': b}], 'next': None}
+    serve(tmp_path, scenario)
+
+
+def test_errors(tmp_path):
+    '''
+    Unknown and invalid ids, and invalid arguments, are answered with 404 and 400.
+    '''
+    async def scenario(client):
+        date = Date(uuid.uuid4(), datetime.date(2021, 3, 1))
+        with client.app.iapp.transaction() as collection:
+            collection.add_item(date)
+        unknown = str(uuid.uuid4())
+        assert (await client.request('GET', '/api/event/{}'.format(unknown)))[0] == 404
+        assert (await client.request('GET', '/api/event/{}'.format(date.id)))[0] == 404
+        assert (await client.request('GET', '/api/event/not-an-id'))[0] == 400
+        assert (await client.request('GET', '/api/event/not-an-id/referrers'))[0] == 400
+        assert (await client.request('GET', '/api/timeline', query={'after': unknown}))[0] == 404
+        assert (await client.request('POST', '/api/event', body={'desc': 'no title'}))[0] == 400
+        assert (await client.request('POST', '/api/event/{}'.format(unknown), body={'title': 'nothing'}))[0] == 400
+        assert (await client.request('GET', '/api/collection', query={'max_cycles': -1}))[0] == 400
+        assert (await client.request('GET', '/api/nothing'))[0] == 404
+        assert (await client.request('PUT', '/api/event'))[0] == 405
+    serve(tmp_path, scenario)
+
+
+def test_collection_status(tmp_path):
+    '''
+    The conflicts (added without being rejected) are found in the process pool, once per version.
+    '''
+    async def scenario(client):
+        status, body, tag = await client.request('GET', '/api/collection')
+        assert status == 200 and body['has_no_conflict']
+        a = EventBuilder('a').build()
+        b = EventBuilder('b').after(a).build()
+        a.timespec.after(b)
+        with client.app.iapp.transaction() as collection:
+            collection.add_item(a, b)
+        status, body, new_tag = await client.request('GET', '/api/collection', query={'max_cycles': 1})
+        assert status == 200 and new_tag != tag
+        assert not body['has_no_conflict'] and [sorted(cycle) for cycle in body['conflicts']] == [sorted([str(a.id), str(b.id)])]
+        assert (await client.request('GET', '/api/collection', query={'max_cycles': 1}, headers={'if-none-match': new_tag}))[0] == 304
+    serve(tmp_path, scenario)
+
+
+def test_changes_wait_for_one(tmp_path):
+    async def scenario(client):
+        status, first, _ = await client.request('GET', '/api/changes')
+        assert status == 200 and first['resync']
+        since = str(first['next'])
+        waiting = asyncio.ensure_future(client.request('GET', '/api/changes', query={'since': since, 'timeout': 10}))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        _, id, _ = await client.request('POST', '/api/event', body={'title': 'a'})
+        status, changes, _ = await asyncio.wait_for(waiting, 5)
+        assert status == 200 and [change['data']['id'] for change in changes['changes']] == [id]
+    serve(tmp_path, scenario)
+
+
+def test_lifespan_and_websocket(tmp_path):
+    async def main():
+        app = AsgiApp(tmp_path / 'db', threads=2, processes=1)
+        messages = asyncio.Queue()  # type: asyncio.Queue
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        for message in ({'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}):
+            messages.put_nowait(message)
+        lifespan = asyncio.ensure_future(app({'type': 'lifespan'}, messages.get, send))
+        await asyncio.wait_for(lifespan, 10)
+        assert [message['type'] for message in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        assert app.iapp is None
+
+        async def connect():
+            return {'type': 'websocket.connect'}
+
+        sent.clear()
+        await app({'type': 'websocket', 'path': '/api/changes'}, connect, send)
+        assert sent == [{'type': 'websocket.close', 'code': 1003}]
+    asyncio.run(main())
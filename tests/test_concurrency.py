@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from concurrency import FileLock, RWLock
+from exception import IllegalStateError
+
+TIMEOUT = 5.0
+
+
+def in_thread(target) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_readers_run_together():
+    lock = RWLock()
+    both = threading.Barrier(2, timeout=TIMEOUT)
+
+    def read():
+        with lock.read():
+            both.wait()
+
+    thread = in_thread(read)
+    read()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+
+
+def test_writer_excludes_and_goes_first():
+    '''
+    A writer waits for the readers in, and the readers coming after it wait for it.
+    '''
+    lock = RWLock()
+    events = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def first_reader():
+        with lock.read():
+            reading.set()
+            release.wait(TIMEOUT)
+            events.append('read')
+
+    def writer():
+        with lock.write():
+            events.append('write')
+
+    def late_reader():
+        with lock.read():
+            events.append('late read')
+
+    threads = [in_thread(first_reader)]
+    reading.wait(TIMEOUT)
+    threads.append(in_thread(writer))
+    while not lock._waiting_writers:
+        time.sleep(0.001)
+    threads.append(in_thread(late_reader))
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert events == ['read', 'write', 'late read']
+
+
+def test_writer_takes_the_lock_again():
+    lock = RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+        assert lock._writer == threading.get_ident()
+    assert lock._writer is None
+
+
+def test_file_lock(tmp_path):
+    first, second = FileLock(tmp_path / 'lock'), FileLock(tmp_path / 'lock')
+    first.acquire()
+    with pytest.raises(IllegalStateError):
+        second.acquire()
+    first.release()
+    second.acquire()
+    assert second.locked and not first.locked
+    second.release()
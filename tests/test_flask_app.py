@@ -0,0 +1,104 @@
+# -*- coding:utf-8 -*-
+
+'''
+The Flask WebAPI, serving a database in a temporary directory for the whole module (as `flask_app` opens it when imported).
+'''
+
+import atexit
+import uuid
+
+import pytest
+
+import webapi
+
+from model import EventBuilder
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    webapi.DB_DIRECTORY = str(tmp_path_factory.mktemp('flask') / 'data')
+    import flask_app
+    yield flask_app
+    atexit.unregister(flask_app.iapp.close)
+    flask_app.iapp.close()
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+def test_collection_status_bounds_the_cycles(server, client):
+    a, b, c = (EventBuilder(title).build() for title in 'abc')
+    a.timespec.after(b)
+    b.timespec.after(c)
+    c.timespec.after(a)
+    a.timespec.before(b)  # Another cycle, a -> b -> a
+    with server.iapp.transaction() as collection:
+        collection.add_item(a, b, c)
+    status = client.get('/api/collection').get_json()
+    assert not status['has_no_conflict']
+    assert sorted(status['conflict_groups'][0]) == sorted(str(event.id) for event in (a, b, c))
+    assert len(status['conflicts']) == 2
+    assert len(client.get('/api/collection?max_cycles=1').get_json()['conflicts']) == 1
+    assert client.get('/api/collection?max_cycles=0').get_json()['conflicts'] == []
+    assert client.get('/api/collection?max_cycles=-1').status_code == 400
+    assert client.get('/api/collection?max_cycles=many').status_code == 400
+
+
+def test_transaction(server, client):
+    ids = client.post('/api/transaction', json={'operations': [{'title': 'first'}, {'title': 'second'}]}).get_json()
+    assert len(ids) == 2
+    first, second = ids
+    operations = [
+            {'op': 'update', 'id': second, 'title': 'second', 'after': [first]},
+            {'op': 'add', 'title': 'third', 'after': [second]},
+            ]
+    response = client.post('/api/transaction', json={'operations': operations + [{'op': 'update', 'id': first, 'title': 'first', 'after': [second]}]})
+    assert response.status_code == 409
+    response = client.post('/api/transaction', json={'operations': operations + [{'op': 'update', 'id': str(uuid.uuid4()), 'title': 'unknown'}]})
+    assert response.status_code == 400
+    assert client.post('/api/transaction', json={'operations': [{'op': 'delete', 'id': first}]}).status_code == 400
+    assert client.get('/api/event/{}/referrers'.format(first)).get_json() == {}
+    third = client.post('/api/transaction', json={'operations': operations}).get_json()[1]
+    assert client.get('/api/event/{}/referrers'.format(second)).get_json() == {'after': [third]}
+
+
+def test_event_listing(client):
+    ids = [client.post('/api/event', json={'title': 'listed {}'.format(i)}).get_json() for i in range(5)]
+    titles = []
+    cursor = 0
+    while cursor is not None:
+        page = client.get('/api/event', query_string={'title': 'listed', 'limit': 2, 'fields': 'title', 'cursor': cursor}).get_json()
+        titles.extend(event['title'] for event in page['events'])
+        cursor = page['next']
+    assert titles == ['listed {}'.format(i) for i in range(5)]
+    assert set(ids) <= set(client.get('/api/event').get_json())
+    assert client.get('/api/event', query_string={'ids': ','.join(ids[:2]), 'fields': 'id'}).get_json() == {'events': [{'id': id} for id in ids[:2]], 'missing': []}
+    assert client.get('/api/event?limit=0').status_code == 400
+    assert client.get('/api/event?fields=nothing').status_code == 400
+
+
+def test_etags(client):
+    first = client.get('/api/collection')
+    tag = first.headers['ETag']
+    assert tag.startswith('"{}-'.format(webapi.INSTANCE))
+    again = client.get('/api/collection', headers={'If-None-Match': tag})
+    assert again.status_code == 304 and again.headers['ETag'] == tag and not again.data
+    assert client.get('/api/collection?max_cycles=3', headers={'If-None-Match': tag}).status_code == 304  # The version is the same
+    id = client.post('/api/event', json={'title': 'changing'}).get_json()
+    changed = client.get('/api/collection', headers={'If-None-Match': tag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != tag
+    event = client.get('/api/event/{}'.format(id))
+    assert event.get_json()['title'] == 'changing'
+    assert client.get('/api/event/{}'.format(id), headers={'If-None-Match': event.headers['ETag']}).status_code == 304
+
+
+def test_changes(client):
+    first = client.get('/api/changes').get_json()
+    assert first['resync']
+    id = client.post('/api/event', json={'title': 'followed'}).get_json()
+    changes = client.get('/api/changes', query_string={'since': first['next'], 'timeout': 1}).get_json()
+    assert [change['data']['id'] for change in changes['changes']] == [id]
+    assert client.get('/api/changes', query_string={'since': changes['next']}).get_json()['changes'] == []
+    assert client.get('/api/changes?timeout=-1').status_code == 400
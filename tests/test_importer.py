@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import json
+import sys
+
+import pytest
+
+import importer
+import inforec
+
+from exception import IllegalStateError
+from model import AbsoluteDateTime, Date, Event
+from storage import App
+
+
+def write_jsonl(path, rows) -> None:
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(row if isinstance(row, str) else json.dumps(row))
+            f.write('\n')
+
+
+def test_import_jsonl_and_csv(tmp_path):
+    '''
+    Rows may refer to markers later in the input, or in another file; the references are only checked at the end.
+    '''
+    ids = ['00000000-0000-0000-0000-00000000000{}'.format(i) for i in range(6)]
+    write_jsonl(tmp_path / 'first.jsonl', [
+            {'id': ids[0], 'title': 'first', 'before': [ids[1]], 'after': ids[2]},
+            {'id': ids[1], 'title': 'second', 'desc': None},
+            {'id': ids[2], 'datetime': '2021-05-08T23:31:49'},
+            {'id': ids[3], 'date': '8 May 2021'},
+            '',
+            ])
+    with open(tmp_path / 'second.csv', 'w') as f:
+        f.write('type,id,title,date,time,before\n')
+        f.write('event,{},third,,,"{},{}"\n'.format(ids[4], ids[0], ids[5]))
+        f.write('absolute_date_time,{},,2021-05-09,12:00,\n'.format(ids[5]))
+    app = App(tmp_path / 'db', journal=True)
+    seen = []
+    assert importer.import_file(app, tmp_path / 'first.jsonl', chunk_size=3, progress=lambda count, elapsed: seen.append(count)) == (4, set())
+    assert seen == [3, 4]
+    assert importer.import_file(app, tmp_path / 'second.csv') == (2, set())
+    app.close()
+    app = App(tmp_path / 'db', read_only=True)
+    collection = app.collection()
+    assert [type(collection.get_item(id)) for id in ids] == [Event, Event, AbsoluteDateTime, Date, Event, AbsoluteDateTime]
+    assert collection.get_item(ids[3]).date == datetime.date(2021, 5, 8)
+    assert collection.get_item(ids[5]).abstime == datetime.datetime(2021, 5, 9, 12)
+    assert [str(id) for id in collection.get_event(ids[4]).timespec.befores] == [ids[0], ids[5]]
+    assert collection.referrers(ids[2]) == {'after': {collection.get_item(ids[0]).id}}
+
+
+def test_import_reports_the_row_of_a_duplicate(tmp_path):
+    write_jsonl(tmp_path / 'rows.jsonl', [{'id': '00000000-0000-0000-0000-00000000000{}'.format(i % 3), 'title': str(i)} for i in range(5)])
+    app = App(tmp_path / 'db', journal=True)
+    with pytest.raises(IllegalStateError, match=r'Rows 3-4 not imported \(2 rows before them are imported already\), because of row 4'):
+        importer.import_file(app, tmp_path / 'rows.jsonl', chunk_size=2)
+    app.close()
+    assert len(list(App(tmp_path / 'db', read_only=True).collection().list())) == 2
+
+
+@pytest.mark.parametrize('line, message', [
+        ('{"id": 5, "title": "a number"}', 'row 2'),
+        ('{"title": "a number", "before": 5}', 'row 2'),
+        ('{"title": "a number", "after": [5]}', 'row 2'),
+        ('{"id": "not an id", "date": "2021-05-08"}', 'row 2'),
+        ('{"type": "date"}', 'row 2'),
+        ('{"type": "date", "datetime": "2021-05-08T12:00"}', 'row 2'),
+        ('[1, 2]', 'Line 2'),
+        ('{"title": ', 'line 2'),
+        ])
+def test_invalid_rows(tmp_path, line, message):
+    write_jsonl(tmp_path / 'rows.jsonl', [{'title': 'valid'}, line])
+    app = App(tmp_path / 'db', journal=True)
+    with pytest.raises(ValueError, match=message):
+        importer.import_file(app, tmp_path / 'rows.jsonl')
+    app.close()
+
+
+def test_cli_reports_import_errors(tmp_path, monkeypatch, capsys):
+    write_jsonl(tmp_path / 'rows.jsonl', [{'title': 'valid'}, {'id': None, 'title': 'null id'}, {'id': 5, 'title': 'a number'}])
+    monkeypatch.setattr(sys, 'argv', ['inforec.py', '-d', str(tmp_path / 'db'), 'import', str(tmp_path / 'rows.jsonl')])
+    with pytest.raises(SystemExit) as exit:
+        inforec.main()
+    assert exit.value.code == 2
+    assert 'Invalid row 3' in capsys.readouterr().err
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+
+import pytest
+
+from conftest import entries, random_markers, special_markers
+from exception import IllegalStateError
+from model import EMPTY_TIMESPEC, EventBuilder, compact_marker
+from storage import Collection
+
+
+def test_markers_have_slots(rng):
+    for marker in special_markers(rng):
+        assert not hasattr(marker, '__dict__')
+        with pytest.raises(AttributeError):
+            marker.other = None
+        if hasattr(marker, 'timespec'):
+            assert not hasattr(marker.timespec, '__dict__')
+
+
+def test_compact_marker(rng):
+    ids = {}  # type: dict
+    event = EventBuilder('event').before(random_markers(rng, 1)[0]).build()
+    compact = compact_marker(event, lambda id: ids.setdefault(id, id))
+    assert entries([compact]) == entries([event])
+    assert isinstance(compact.timespec.befores, tuple)
+    assert compact.timespec.befores[0] is ids[event.timespec.befores[0]]
+    bare = compact_marker(EventBuilder('bare').build(), lambda id: id)
+    assert bare.timespec is EMPTY_TIMESPEC
+    with pytest.raises(IllegalStateError):
+        bare.timespec.after(event)
+
+
+def test_compact_collection(rng):
+    '''
+    A compact collection answers like a plain one, with one object per id, also for the ids referred to but not in it.
+    '''
+    markers = random_markers(rng, 30, 6, n_dangling=3) + special_markers(rng)
+    plain = Collection(markers)
+    compact = Collection(markers, compact_model=True)
+    assert entries(compact.get_item(id) for id in compact.list()) == entries(plain.get_item(id) for id in plain.list())
+    assert compact.dangling_refs() == plain.dangling_refs()
+    assert set(compact.ordering().g.edges()) == set(plain.ordering().g.edges())
+    objects = {id: id for id in compact.list()}
+    for id in compact.list():
+        item = compact.get_item(id)
+        assert item.id is objects[id]
+        for referred in getattr(item, 'timespec', EMPTY_TIMESPEC).befores or ():
+            assert referred is objects.setdefault(referred, referred)
+    event = next(marker for marker in markers if hasattr(marker, 'title'))
+    compact.update_item(event.id, EventBuilder('updated').id(event.id).build())
+    assert compact.get_event(event.id).timespec is EMPTY_TIMESPEC
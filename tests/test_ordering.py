@@ -0,0 +1,323 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import random
+import uuid
+
+import networkx as nx
+import pytest
+
+import ordering
+
+from conftest import entries, random_id, random_markers
+from exception import ConflictError
+from model import AbsoluteDateTime, Date, EventBuilder, TimeRelativity
+from ordering import INF, Bounds, ConflictReport, DynamicTopologicalOrder, ImplicitChain, ImplicitIndex, Timeline, UnionFind, conflict_groups, implicit_ordering_edges
+from storage import Collection
+
+
+def mixed_offset_markers(rng: random.Random, n: int) -> list:
+    '''
+    Dates and times around the midnights of a few days, naive or with offsets which move them to the day before or after in UTC.
+    '''
+    markers = []  # type: list
+    for _ in range(n):
+        day = datetime.date(2021, 3, 1) + datetime.timedelta(days=rng.randrange(3))
+        if rng.random() < 0.3:
+            markers.append(Date(random_id(rng), day))
+            continue
+        time = datetime.datetime.combine(day, datetime.time(rng.choice([0, 1, 12, 22, 23]), rng.choice([0, 30])))
+        if rng.random() < 0.8:
+            time = time.replace(tzinfo=datetime.timezone(datetime.timedelta(minutes=30 * rng.randrange(-24, 29))))
+        markers.append(AbsoluteDateTime(random_id(rng), time))
+    return markers
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_implicit_chain_matches_compare(seed):
+    '''
+    What the chain orders (transitively) is what `compare()` finds BEFORE, pair by pair, whatever the time zones; and adding or removing markers one by one gives the edges of building the chain at once.
+    '''
+    rng = random.Random(seed)
+    markers = mixed_offset_markers(rng, 30)
+    closure = nx.transitive_closure_dag(nx.DiGraph(implicit_ordering_edges(markers)))
+    for a in markers:
+        for b in markers:
+            assert closure.has_edge(a.id, b.id) == (a is not b and a.compare(b) == TimeRelativity.BEFORE), (a, b)
+    chain = ImplicitChain()
+    edges = set()  # type: set
+    for marker in markers:
+        removed, added = chain.add(marker)
+        edges = (edges - removed) | added
+    for marker in markers[:10]:
+        removed, added = chain.remove(marker)
+        edges = (edges - removed) | added
+    assert edges == set(implicit_ordering_edges(markers[10:]))
+
+
+def test_implicit_order_across_midnight_in_utc():
+    a = AbsoluteDateTime(uuid.uuid4(), datetime.datetime(2021, 3, 2, 0, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=5))))
+    b = AbsoluteDateTime(uuid.uuid4(), datetime.datetime(2021, 3, 1, 23, tzinfo=datetime.timezone.utc))
+    day = Date(uuid.uuid4(), datetime.date(2021, 3, 1))
+    assert a.compare(b) == TimeRelativity.BEFORE
+    assert day.compare(a) == TimeRelativity.GENERALIZED  # 19:30 in UTC
+    assert set(implicit_ordering_edges([a, b, day])) == {(a.id, b.id)}
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_incremental_ordering_matches_a_rebuild(seed):
+    '''
+    The ordering graph maintained while adding and updating the items is the one built from all of them at once.
+    '''
+    rng = random.Random(seed)
+    markers = random_markers(rng, 20, 6, n_dangling=2)
+    collection = Collection()
+    for i in range(0, len(markers), 5):
+        collection.add_item(*markers[i:i + 5])
+    items = {marker.id: marker for marker in markers}
+    events = [marker.id for marker in markers if hasattr(marker, 'title')]
+    for _ in range(20):
+        id = rng.choice(events)
+        builder = EventBuilder('updated').id(id)
+        for other in rng.sample(list(items), rng.randrange(3)):
+            if other != id:
+                (builder.before if rng.random() < 0.5 else builder.after)(other)
+        items[id] = builder.build()
+        collection.update_item(id, items[id])
+    fresh = Collection(list(items.values()))
+    assert set(collection.ordering().g.edges()) == set(fresh.ordering().g.edges())
+    assert collection.has_no_conflict() == fresh.has_no_conflict()
+
+
+def random_dag(rng: random.Random, n: int, m: int) -> nx.DiGraph:
+    g = nx.DiGraph()
+    g.add_nodes_from(range(n))
+    for _ in range(m):
+        u, v = rng.sample(range(n), 2)
+        g.add_edge(min(u, v), max(u, v))
+    return g
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_dynamic_order_matches_topological_sort(seed):
+    rng = random.Random(seed)
+    g = nx.DiGraph()
+    order = DynamicTopologicalOrder(g)
+    for _ in range(150):
+        u, v = rng.randrange(40), rng.randrange(40)
+        cycle = order.insert(u, v)
+        if cycle is None:
+            assert u == v or not (v in g and u in g and nx.has_path(g, v, u))
+            g.add_edge(u, v)
+            assert all(order.key(a) < order.key(b) for a, b in g.edges())
+            assert nx.is_directed_acyclic_graph(g)
+        else:
+            assert u == v or nx.has_path(g, v, u)
+            assert cycle[0] == u
+            for a, b in zip(cycle[1:], cycle[2:]):
+                assert g.has_edge(a, b)
+            if len(cycle) > 1:
+                assert cycle[1] == v and g.has_edge(cycle[-1], u)
+
+
+def test_dynamic_order_from_existing_dag(rng):
+    g = random_dag(rng, 30, 60)
+    order = DynamicTopologicalOrder(g)
+    assert all(order.key(u) < order.key(v) for u, v in g.edges())
+    for u, v in g.edges():
+        assert order.find_path(u, v) is not None
+        assert order.find_path(v, u) is None
+
+
+@pytest.mark.parametrize('seed', range(15))
+def test_incremental_ordering_rejects_exactly_the_conflicts(seed):
+    '''
+    Adding and updating with `reject_conflict` keeps the collection acyclic, and only rejects the changes which would make a cycle; the graph maintained incrementally is the one built from scratch.
+    '''
+    rng = random.Random(seed)
+    markers = random_markers(rng, 12, 4, same_rate=0.05)
+    collection = Collection()
+    kept = {}
+    for marker in markers:
+        try:
+            collection.add_item(marker, reject_conflict=True)
+            kept[marker.id] = marker
+        except ConflictError:
+            assert not Collection(list(kept.values()) + [marker]).has_no_conflict()
+        assert collection.has_no_conflict()
+    events = [marker for marker in kept.values() if hasattr(marker, 'title')]
+    pool = list(kept)
+    for _ in range(30):
+        event = rng.choice(events)
+        builder = EventBuilder('updated').id(event.id)
+        for _ in range(rng.randrange(3)):
+            other = rng.choice(pool)
+            if other != event.id:
+                (builder.before if rng.random() < 0.5 else builder.after)(other)
+        new = builder.build()
+        try:
+            collection.update_item(event.id, new, reject_conflict=True)
+            kept[event.id] = new
+            events[events.index(event)] = new
+        except ConflictError:
+            assert not Collection([new if id == event.id else marker for id, marker in kept.items()]).has_no_conflict()
+        assert collection.has_no_conflict()
+    fresh = Collection(list(kept.values()))
+    assert set(collection.ordering().g.edges()) == set(fresh.ordering().g.edges())
+    assert sorted(map(str, collection.list())) == sorted(map(str, fresh.list()))
+    assert entries(collection.get_item(id) for id in kept) == entries(kept.values())
+
+
+def test_conflict_through_dates():
+    early = Date(uuid.uuid4(), datetime.date(2021, 1, 1))
+    late = Date(uuid.uuid4(), datetime.date(2021, 1, 2))
+    collection = Collection([early, late])
+    event = EventBuilder('before the early date, after the late one').before(early.id).after(late.id).build()
+    with pytest.raises(ConflictError):
+        collection.add_item(event, reject_conflict=True)
+    assert collection.has_no_conflict()
+    collection.add_item(event)
+    assert not collection.has_no_conflict()
+    assert any(event.id in group for group in collection.conflict_report().groups)
+
+
+def random_graph(rng: random.Random, n: int, m: int) -> nx.DiGraph:
+    g = nx.DiGraph()
+    g.add_nodes_from(range(n))
+    for _ in range(m):
+        g.add_edge(rng.randrange(n), rng.randrange(n))
+    return g
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_conflict_report_groups_and_cycles(seed):
+    rng = random.Random(seed)
+    g = random_graph(rng, 25, 40)
+    report = ConflictReport(g)
+    expected = [c for c in nx.strongly_connected_components(g) if len(c) > 1 or g.has_edge(*(2 * list(c)))]
+    assert sorted(map(sorted, report.groups)) == sorted(map(sorted, expected))
+    assert bool(report) == (not nx.is_directed_acyclic_graph(g))
+    cycles = list(report.cycles(limit=5, per_group=2))
+    assert len(cycles) <= 5
+    for cycle in cycles:
+        assert any(set(cycle) <= group for group in report.groups)
+        for a, b in zip(cycle, cycle[1:] + cycle[:1]):
+            assert g.has_edge(a, b)
+    assert list(report.cycles(0)) == []
+
+
+def test_union_find():
+    sames = UnionFind()  # type: UnionFind[int]
+    sames.union(1, 2)
+    sames.union(3, 4)
+    sames.union(2, 4)
+    assert sames.find(1) == sames.find(3)
+    assert sames.group(4) == {1, 2, 3, 4}
+    assert sames.find(5) == 5
+
+
+def test_same_groups_are_one_node():
+    a, b, c = (EventBuilder(title).build() for title in 'abc')
+    d = EventBuilder('d').after(a).before(c).build()
+    collection = Collection([a, b, c, d])
+    collection.update_item(b.id, EventBuilder('b').id(b.id).same(a).build())
+    assert collection.same_group(a.id) == {a.id, b.id}
+    assert collection.has_no_conflict()
+    with pytest.raises(ConflictError):  # a is before d, which is before c
+        collection.update_item(c.id, EventBuilder('c').id(c.id).same(b.id).build(), reject_conflict=True)
+    assert collection.same_group(c.id) == {c.id}
+    collection.update_item(c.id, EventBuilder('c').id(c.id).same(b.id).build())
+    assert collection.same_group(a.id) == {a.id, b.id, c.id}
+    assert collection.ordering().node(a.id) == collection.ordering().node(c.id)
+    assert not collection.has_no_conflict()
+
+
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_timeline_matches_reachability(seed):
+    rng = random.Random(seed)
+    g = random_graph(rng, 30, 45)
+    timeline = Timeline(g)
+    groups = list(conflict_groups(g))
+    same_group = {node: i for i, group in enumerate(groups) for node in group}
+    nodes = timeline.nodes()
+    assert sorted(nodes) == sorted(g)
+    for u in g:
+        for v in g:
+            ordered = u != v and nx.has_path(g, u, v) and not (u in same_group and same_group.get(v) == same_group[u])
+            assert timeline.is_before(u, v) == ordered, (u, v)
+            if ordered:
+                assert timeline.position(u) < timeline.position(v)
+                assert timeline.compare(u, v) == TimeRelativity.BEFORE
+    u, v = rng.sample(list(g), 2)
+    expected = [node for node in nodes if timeline.is_before(u, node) and timeline.is_before(node, v)]
+    assert timeline.between(u, v) == expected
+    assert timeline.between(after=u) == [node for node in nodes if timeline.is_before(u, node)]
+
+
+@pytest.mark.parametrize('vectorized', [False, True])
+@pytest.mark.parametrize('seed', range(5))
+def test_implicit_index_matches_compare(seed, vectorized):
+    if vectorized:
+        pytest.importorskip('numpy')
+    rng = random.Random(seed)
+    markers = mixed_offset_markers(rng, 40)
+    index = ImplicitIndex(markers, vectorized=vectorized)
+    assert index.vectorized == vectorized and len(index) == len(markers)
+    items = {marker.id: marker for marker in markers}
+    ids = index.ids()
+    assert sorted(ids) == sorted(items)
+    for a, b in zip(ids, ids[1:]):
+        assert items[a].compare(items[b]) != TimeRelativity.AFTER
+    for anchor in rng.sample(markers, 10) + mixed_offset_markers(rng, 5):
+        assert index.compare(anchor) == [items[id].compare(anchor) for id in ids]
+        for relativity in TimeRelativity:
+            assert index.select(anchor, relativity) == [id for id in ids if items[id].compare(anchor) == relativity]
+    after, before = rng.sample(markers, 2)
+    assert index.between(after, before) == [id for id in ids if items[id].compare(after) == TimeRelativity.AFTER and items[id].compare(before) == TimeRelativity.BEFORE]
+    assert index.between(before=before) == index.select(before, TimeRelativity.BEFORE)
+    assert index.between() == ids
+
+
+def test_implicit_index_without_numpy(monkeypatch):
+    monkeypatch.setattr(ordering, 'np', None)
+    markers = mixed_offset_markers(random.Random(0), 10)
+    assert not ImplicitIndex(markers).vectorized
+    with pytest.raises(ValueError):
+        ImplicitIndex(markers, vectorized=True)
+
+
+
+
+def brute_force_bounds(g: nx.DiGraph, own: dict) -> tuple:
+    lower = {node: max([own.get(a, (-INF, INF))[0] for a in nx.ancestors(g, node) | {node}]) for node in g}
+    upper = {node: min([own.get(d, (-INF, INF))[1] for d in nx.descendants(g, node) | {node}]) for node in g}
+    return lower, upper
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_bounds_sweep_and_incremental_update(seed):
+    rng = random.Random(seed)
+    g = random_dag(rng, 25, 30)
+    own = {}
+    for node in rng.sample(list(g), 6):
+        start = rng.randrange(100)
+        own[node] = (start, start + rng.randrange(10))
+    bounds = Bounds(g, lambda node: own.get(node, (-INF, INF)))
+    bounds.update()
+    assert (bounds.lower, bounds.upper) == brute_force_bounds(g, own)
+    order = DynamicTopologicalOrder(g)
+    for _ in range(15):
+        u, v = rng.sample(list(g), 2)
+        if order.insert(u, v) is None:
+            g.add_edge(u, v)
+            bounds.touch(u)
+            bounds.touch(v)
+        node = rng.choice(list(g))
+        start = rng.randrange(100)
+        own[node] = (start, start + 5)
+        bounds.touch(node)
+        bounds.update(order.key)
+        expected_lower, expected_upper = brute_force_bounds(g, own)
+        assert all(bounds.period(node) == (expected_lower[node], expected_upper[node]) for node in g)
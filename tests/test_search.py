@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+
+import uuid
+
+import pytest
+
+from model import EventBuilder
+from search import SearchIndex, tokenize
+from storage import OP_UPDATE, InfoRecDB
+
+
+@pytest.fixture
+def events():
+    return [
+            EventBuilder('Moon landing').desc('Apollo 11 lands on the Moon').build(),
+            EventBuilder('Apollo 13').desc('An oxygen tank fails; the landing is aborted').build(),
+            EventBuilder('Sputnik').desc('The first satellite').build(),
+            EventBuilder('東京オリンピック').desc('Olympic Games in Tokyo').build(),
+            ]
+
+
+def test_tokenize():
+    assert tokenize('Hello, World_2021!') == ['hello', 'world', '2021']
+    assert tokenize('東京 Olympics') == ['東', '京', 'olympics']
+    assert tokenize(None) == []
+
+
+def test_search_ranks_and_requires_all_terms(events):
+    index = SearchIndex.of(events)
+    assert len(index) == 4
+    moon, apollo13 = events[0].id, events[1].id
+    assert [id for id, _ in index.search('landing')] == [moon, apollo13]  # In the title first
+    assert [id for id, _ in index.search('apollo landing')] == [moon, apollo13]
+    assert [id for id, _ in index.search('apollo oxygen')] == [apollo13]
+    assert index.search('apollo nothing') == []
+    assert index.search('') == []
+    assert [id for id, _ in index.search('APOLLO', limit=1)] == [apollo13]  # In the title
+
+
+def test_search_prefixes_and_cjk(events):
+    index = SearchIndex.of(events)
+    assert {id for id, _ in index.search('sat*')} == {events[2].id}
+    assert {id for id, _ in index.search('land*')} == {events[0].id, events[1].id}
+    assert [id for id, _ in index.search('東京')] == [events[3].id]
+    assert index.search('sat') == []
+
+
+def test_record_updates(events):
+    index = SearchIndex.of(events)
+    renamed = EventBuilder('Vostok 1').id(events[2].id).build()
+    index.record(OP_UPDATE, renamed)
+    assert index.search('sputnik') == []
+    assert [id for id, _ in index.search('vostok')] == [renamed.id]
+    index.remove(events[0].id)
+    assert [id for id, _ in index.search('landing')] == [events[1].id]
+    assert len(index) == 3
+
+
+def test_dump_and_load(tmp_path, events):
+    index = SearchIndex.of(events)
+    index.remove(events[2].id)
+    path = tmp_path / 'search.json'
+    index.dump(path, 'stamp', 7)
+    loaded = SearchIndex.load(path, 'stamp')
+    assert loaded is not None
+    loaded_index, seq = loaded
+    assert seq == 7
+    for query in ('landing', 'apollo', 'land*', '東京', 'sputnik'):
+        assert loaded_index.search(query) == index.search(query)
+    assert SearchIndex.load(path, 'another stamp') is None
+    assert SearchIndex.load(tmp_path / 'missing.json', 'stamp') is None
+    loaded_index.put(uuid.uuid4(), 'Landing again', None)
+    assert len(loaded_index.search('landing')) == 3
+
+
+def test_database_index_follows_the_journal(tmp_path, events):
+    '''
+    The index written with the snapshot is brought up to date with the journal when opening.
+    '''
+    InfoRecDB.init(tmp_path / 'db')
+    db = InfoRecDB.open(tmp_path / 'db', journal=True, search=True)
+    db.collection.add_item(*events)
+    db.compact()
+    db.collection.add_item(EventBuilder('Voyager').desc('Launched after the landing').build())
+    db.write()
+    db.close()
+    db = InfoRecDB.open(tmp_path / 'db', journal=True, search=True, read_only=True)
+    assert db.search_index is not None
+    assert len(db.search_index.search('landing')) == 3
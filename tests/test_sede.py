@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import uuid
+
+import pytest
+
+import sede
+
+from conftest import entries, random_markers, special_markers
+from model import AbsoluteDateTime, Date
+from storage import M_T_DES, M_T_SER
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_sede_round_trip(rng, compact):
+    for marker in random_markers(rng, 10, 5) + special_markers(rng):
+        if isinstance(marker, AbsoluteDateTime):
+            back = sede.deserialize_absolutedatetime(sede.serialize_absolutedatetime(marker, compact))
+        elif isinstance(marker, Date):
+            back = sede.deserialize_date(sede.serialize_date(marker, compact))
+        else:
+            back = sede.deserialise_event(sede.serialise_event(marker, compact))
+        assert entries([back]) == entries([marker])
+
+
+def test_batch_shares_the_ids(rng):
+    markers = random_markers(rng, 20, 5)
+    batch = [(M_T_SER[type(marker)][1], M_T_SER[type(marker)][0](marker, True)) for marker in markers]
+    back = sede.deserialize_batch(batch, M_T_DES)
+    assert entries(back) == entries(markers)
+    shared = {marker.id: marker.id for marker in back}
+    referred = [id for marker in back if hasattr(marker, 'timespec') for id in (marker.timespec.befores or []) + (marker.timespec.afters or [])]
+    assert referred and all(shared.setdefault(id, id) is id for id in referred)
+
+
+def test_ids_and_legacy_times():
+    id = uuid.uuid4()
+    assert sede.decode_id(sede.encode_id(id, compact=True)) == id
+    assert len(sede.encode_id(id, compact=True)) == 22
+    assert sede.decode_id(str(id)) == id
+    assert sede.parse_datetime('2021-05-08T23:31:49[UTC]') == datetime.datetime(2021, 5, 8, 23, 31, 49)
+    assert sede.parse_date('2021-05-08[UTC]') == datetime.date(2021, 5, 8)
@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import pathlib
+import random
+import uuid
+
+import pytest
+
+from conftest import entries, random_markers
+from exception import ConflictError, IllegalStateError
+from model import Date, EventBuilder
+from sharded_storage import BY_NAMESPACE, BY_PREFIX, ReferenceIndex, ShardedInfoRecDB
+from storage import OP_UPDATE, Collection
+
+
+def prefixed(prefix: str) -> uuid.UUID:
+    '''
+    A new id starting with `prefix`, i.e. in the shard `prefix` when sharding by the first hex digit.
+    '''
+    return uuid.UUID(prefix + uuid.uuid4().hex[len(prefix):])
+
+
+def summaries(index: ReferenceIndex) -> dict:
+    return {name: (s.seq, s.acyclic, s.external, s.ports, s.nodes, s.edges, s.lower, s.upper) for name, s in index.summaries.items()}
+
+
+@pytest.mark.parametrize('scheme', [BY_PREFIX, BY_NAMESPACE])
+@pytest.mark.parametrize('seed', range(25))
+def test_matches_a_single_collection(tmp_path, scheme, seed):
+    '''
+    Added by chunks, written and reopened in between, the shards answer like one collection of the same markers; in particular about conflicts across shards.
+    '''
+    rng = random.Random(seed)
+    directory = tmp_path / 'db'
+    ShardedInfoRecDB.init(directory, scheme, 1)
+    db = ShardedInfoRecDB.open(directory)
+    markers = random_markers(rng, rng.randrange(2, 25), rng.randrange(8), n_dangling=2)
+    for chunk in (markers[i::3] for i in range(3)):
+        if scheme == BY_NAMESPACE:
+            for marker in chunk:
+                db.collection.add_item(marker, namespace=rng.choice(['a', 'b', 'c']))
+        else:
+            db.collection.add_item(*chunk)
+        db.write()
+        if rng.random() < 0.5:
+            db.close()
+            db = ShardedInfoRecDB.open(directory)
+    whole = Collection(markers)
+    assert db.collection.has_no_conflict() == whole.has_no_conflict()
+    assert db.collection.dangling_refs() == whole.dangling_refs()
+    db.close()
+    db = ShardedInfoRecDB.open(directory, read_only=True)
+    assert db.collection.has_no_conflict() == whole.has_no_conflict()
+    assert db.collection.is_self_contained() == whole.is_self_contained()
+    for marker in rng.sample(markers, 3):
+        assert db.collection.referrers(marker.id) == whole.referrers(marker.id)
+        assert entries([db.collection.get_item(marker.id)]) == entries([marker])
+    assert sorted(db.collection.list()) == sorted(whole.list())
+    db.close()
+
+
+@pytest.fixture
+def db(tmp_path):
+    ShardedInfoRecDB.init(tmp_path / 'db', BY_PREFIX, 1)
+    db = ShardedInfoRecDB.open(tmp_path / 'db')
+    yield db
+    db.close()
+
+
+def test_rejects_cycles_across_shards(db):
+    a, b, c = prefixed('a'), prefixed('b'), prefixed('c')
+    early, late = Date(prefixed('d'), datetime.date(2020, 1, 1)), Date(prefixed('e'), datetime.date(2021, 1, 1))
+    db.collection.add_item(EventBuilder('a').id(a).build(), EventBuilder('b').id(b).after(a).build(), early, late)
+    db.write()
+    db.collection.add_item(EventBuilder('c').id(c).after(b).build())
+    with pytest.raises(ConflictError):
+        db.collection.update_item(a, EventBuilder('a').id(a).after(c).build(), reject_conflict=True)
+    assert db.collection.get_item(a).timespec.afters is None
+    with pytest.raises(ConflictError):  # Through the dates, in other shards: a after 2021, and c (after a) before 2020
+        db.collection.apply([(OP_UPDATE, EventBuilder('a').id(a).after(late.id).build()), (OP_UPDATE, EventBuilder('c').id(c).after(b).before(early.id).build())], reject_conflict=True)
+    assert db.collection.get_item(c).timespec.befores is None
+    assert db.collection.has_no_conflict()
+    db.collection.update_item(a, EventBuilder('a').id(a).after(early.id).build(), reject_conflict=True)
+    db.collection.update_item(c, EventBuilder('c').id(c).after(b).before(late.id).build(), reject_conflict=True)
+    assert db.collection.has_no_conflict()
+
+
+def test_routing(db):
+    a = prefixed('a')
+    db.collection.add_item(EventBuilder('a').id(a).build())
+    with pytest.raises(IllegalStateError):
+        db.collection.add_item(EventBuilder('a again').id(a).build())
+    b = prefixed('b')
+    with pytest.raises(KeyError):
+        db.collection.update_item(b, EventBuilder('b').id(b).build())
+    assert db.shard_of(a) == 'a'
+
+
+def test_changes_only_write_their_shards(db, tmp_path):
+    '''
+    A change referring to another shard doesn't rewrite that shard; and the index read back is the one kept in memory.
+    '''
+    a = prefixed('a')
+    db.collection.add_item(EventBuilder('a').id(a).build(), EventBuilder('b').id(prefixed('b')).build())
+    db.write()
+    db.close()
+    shards = pathlib.Path(tmp_path / 'db' / 'shards')
+    before = {path: path.stat().st_mtime_ns for path in shards.rglob('*') if path.is_file()}
+    db = ShardedInfoRecDB.open(tmp_path / 'db')
+    db.collection.add_item(EventBuilder('f').id(prefixed('f')).after(a).build())
+    assert db.collection.has_no_conflict()
+    db.write()
+    after = {path: path.stat().st_mtime_ns for path in shards.rglob('*') if path.is_file()}
+    changed = [path.relative_to(shards).parts[0] for path in after if before.get(path) != after[path]]
+    assert set(changed) == {'f'}
+    assert summaries(ReferenceIndex.read(tmp_path / 'db')) == summaries(db.index)
+    db.compact()
+    assert summaries(ReferenceIndex.read(tmp_path / 'db')) == summaries(db.index)
+    db.close()
+
+
+def test_recovers_from_a_torn_write(db, tmp_path):
+    '''
+    If the index line of a change is written but not the records of its shard (a crash in between), the shard is summarized again when opening.
+    '''
+    kept, lost = prefixed('b'), prefixed('b')
+    db.collection.add_item(EventBuilder('kept').id(kept).build())
+    db.write()
+    db.collection.add_item(EventBuilder('lost').id(lost).build())
+    groups = db.take_pending()
+    db.index.append(tmp_path / 'db', [line for _, line, _ in groups])
+    db.close()
+    db = ShardedInfoRecDB.open(tmp_path / 'db')
+    with pytest.raises(KeyError):
+        db.collection.get_item(lost)
+    db.write()
+    db.close()
+    db = ShardedInfoRecDB.open(tmp_path / 'db', read_only=True)
+    assert list(db.collection.list()) == [kept]
+    db.close()
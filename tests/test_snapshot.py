@@ -0,0 +1,63 @@
+# -*- coding:utf-8 -*-
+
+import io
+import random
+
+import pytest
+
+import snapshot
+
+from conftest import entries, random_id, random_markers, special_markers
+from exception import IllegalStateError
+from model import EventBuilder
+from storage import BINARY_DATABASE_FILE, DATABASE_FILE, InfoRecDB
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_binary_snapshot_round_trip(seed):
+    rng = random.Random(seed)
+    markers = random_markers(rng, 30, 8, n_dangling=3) + special_markers(rng)
+    f = io.BytesIO()
+    snapshot.dump(markers, f, journal_seq=42)
+    snap = snapshot.BinarySnapshot(f.getvalue())
+    assert snap.journal_seq == 42
+    assert snap.ids() == [marker.id for marker in markers]
+    assert entries(snap.markers()) == entries(markers)
+    for marker in rng.sample(markers, 5):
+        assert entries([snap.get(marker.id)]) == entries([marker])
+    with pytest.raises(KeyError):
+        snap.get(random_id(rng))
+
+
+def test_binary_snapshot_rejects_other_files():
+    with pytest.raises(IllegalStateError):
+        snapshot.BinarySnapshot(b'{"collection": []}' + bytes(snapshot.HEADER.size))
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_binary_database(tmp_path, rng, journal):
+    '''
+    A binary snapshot is read like a JSON one, lazily (mapped) or not; and the format can be switched when compacting.
+    '''
+    directory = tmp_path / 'db'
+    markers = random_markers(rng, 20, 5, n_dangling=2) + special_markers(rng)
+    InfoRecDB.init(directory, binary=True)
+    db = InfoRecDB.open(directory, journal=journal)
+    db.collection.add_item(*markers[:15])
+    db.write()
+    db.collection.add_item(*markers[15:])
+    updated = EventBuilder('updated').id(markers[-1].id).build()
+    db.collection.update_item(updated.id, updated)
+    db.write()
+    db.close()
+    expected = entries(markers[:-1] + [updated])
+    for lazy in (False, True):
+        db = InfoRecDB.open(directory, lazy=lazy, read_only=True)
+        assert entries(db.collection.get_item(id) for id in db.collection.list()) == expected
+        db.close()
+    db = InfoRecDB.open(directory, journal=journal, binary=False)
+    db.compact()
+    db.close()
+    assert (directory / DATABASE_FILE).exists() and not (directory / BINARY_DATABASE_FILE).exists()
+    db = InfoRecDB.open(directory, read_only=True)
+    assert entries(db.collection.get_item(id) for id in db.collection.list()) == expected
@@ -0,0 +1,374 @@
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import datetime
+import json
+import time
+import uuid
+
+import pytest
+
+from conftest import entries, random_markers, special_markers
+from exception import ConflictError, IllegalStateError
+from model import AbsoluteDateTime, Date, EventBuilder
+from sqlite_storage import SqliteInfoRecDB
+from storage import JOURNAL_FILE, K_DATA, K_OP, OP_ADD, OP_UPDATE, App, Collection, InfoRecDB, relations
+
+
+def contents(db) -> list:
+    return entries(db.collection.get_item(id) for id in db.collection.list())
+
+
+def test_journal_round_trip(tmp_path, rng):
+    '''
+    The changes are appended to the journal, replayed when opening (up to the last complete group), and folded into the snapshot by `compact()`.
+    '''
+    directory = tmp_path / 'db'
+    markers = random_markers(rng, 20, 5, n_dangling=2) + special_markers(rng)
+    InfoRecDB.init(directory)
+    db = InfoRecDB.open(directory, journal=True)
+    db.collection.add_item(*markers[:15])
+    db.write()
+    for marker in markers[15:]:
+        db.collection.add_item(marker)
+    updated = EventBuilder('updated').id(markers[-1].id).build()
+    db.collection.update_item(updated.id, updated)
+    db.write()
+    assert db.journal_records == len(markers) + 1
+    db.close()
+    expected = entries(markers[:-1] + [updated])
+    with open(directory / JOURNAL_FILE, 'a') as f:  # A group torn by a crash
+        f.write(json.dumps({'seq': 100, 'end': 101}) + '\n{"seq": 10')
+    db = InfoRecDB.open(directory, journal=True)
+    assert contents(db) == expected
+    assert db.journal_records == len(markers) + 1
+    db.compact()
+    assert not (directory / JOURNAL_FILE).exists()
+    db.close()
+    db = InfoRecDB.open(directory, read_only=True)
+    assert contents(db) == expected
+
+
+def test_sqlite_matches_a_collection(tmp_path, rng):
+    markers = random_markers(rng, 25, 6, n_dangling=3) + special_markers(rng)
+    SqliteInfoRecDB.init(tmp_path / 'db')
+    db = SqliteInfoRecDB.open(tmp_path / 'db')
+    db.collection.add_item(*markers[:20])
+    for marker in markers[20:]:
+        db.collection.add_item(marker)
+    updated = EventBuilder('updated').id(markers[-2].id).after(markers[0].id).build()
+    db.collection.update_item(updated.id, updated)
+    db.close()
+    whole = Collection(markers[:-2] + [updated, markers[-1]])
+    db = SqliteInfoRecDB.open(tmp_path / 'db')
+    assert list(db.collection.list()) == list(whole.list())
+    assert contents(db) == entries(whole.get_item(id) for id in whole.list())
+    assert db.collection.dangling_refs() == whole.dangling_refs()
+    assert db.collection.has_no_conflict() == whole.has_no_conflict()
+    assert set(db.collection.ordering().g.edges()) == set(whole.ordering().g.edges())
+    with pytest.raises(IllegalStateError):
+        db.collection.add_item(EventBuilder('again').id(markers[0].id).build())
+    db.close()
+
+
+def test_sqlite_is_read_from_threads(tmp_path):
+    '''
+    Each thread reads through its own connection, and the ordering is built once for all of them.
+    '''
+    SqliteInfoRecDB.init(tmp_path / 'db')
+    db = SqliteInfoRecDB.open(tmp_path / 'db')
+    events = [EventBuilder('event {}'.format(i)).build() for i in range(50)]
+    db.collection.add_item(*events)
+
+    def read(i: int):
+        assert db.collection.get_event(events[i].id).title == 'event {}'.format(i)
+        return db.collection.ordering()
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        orderings = list(executor.map(read, range(len(events))))
+    assert all(ordering is orderings[0] for ordering in orderings)
+    db.close()
+
+
+def test_lazy_open(tmp_path, rng):
+    '''
+    A lazy collection reads the markers of the snapshot and the journal one by one, and only loads them all for what needs the whole collection.
+    '''
+    directory = tmp_path / 'db'
+    markers = random_markers(rng, 20, 5) + special_markers(rng)
+    InfoRecDB.init(directory)
+    db = InfoRecDB.open(directory, journal=True)
+    db.collection.add_item(*markers[:15])
+    db.compact()
+    db.collection.add_item(*markers[15:])
+    updated = EventBuilder('updated').id(markers[-1].id).build()
+    db.collection.update_item(updated.id, updated)
+    db.write()
+    db.close()
+    expected = InfoRecDB.open(directory, read_only=True).collection
+    db = InfoRecDB.open(directory, lazy=True, journal=True)
+    assert list(db.collection.list()) == list(expected.list())
+    assert contents(db) == entries(expected.get_item(id) for id in expected.list())
+    assert sorted(db.collection.titles()) == sorted(expected.titles())
+    assert db.collection._full is None
+    assert db.collection.has_no_conflict() == expected.has_no_conflict()
+    assert db.collection._full is not None
+    db.collection.add_item(EventBuilder('more').build())
+    db.write()
+    db.close()
+    assert len(list(InfoRecDB.open(directory, lazy=True, read_only=True).collection.list())) == len(markers) + 1
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def collection(request, tmp_path):
+    '''
+    A collection of two events, `a` then `b`, in memory or in SQLite.
+    '''
+    if request.param == 'memory':
+        collection = Collection()
+    else:
+        SqliteInfoRecDB.init(tmp_path / 'sqlite')
+        db = SqliteInfoRecDB.open(tmp_path / 'sqlite')
+        request.addfinalizer(db.close)
+        collection = db.collection
+    a = EventBuilder('a').build()
+    b = EventBuilder('b').after(a).build()
+    collection.add_item(a, b)
+    collection.a, collection.b = a.id, b.id  # For the tests
+    return collection
+
+
+def test_referrers_follow_the_changes(collection, rng):
+    markers = random_markers(rng, 25, 5, n_dangling=3, same_rate=0.2)
+    collection.add_item(*markers)
+    items = {marker.id: marker for marker in markers}
+    events = [marker.id for marker in markers if hasattr(marker, 'title')]
+    for id in rng.sample(events, 8):
+        builder = EventBuilder('updated').id(id)
+        for other in rng.sample(list(items), 2):
+            (builder.same if rng.random() < 0.3 else builder.before)(other)
+        items[id] = builder.build()
+        collection.update_item(id, items[id])
+    events = [items[id] for id in events] + [collection.get_item(collection.b)]
+    for id in set(items) | collection.dangling_refs() | {collection.a}:
+        expected = {}  # type: dict
+        for event in events:
+            for kind, tid in relations(event):
+                if tid == id:
+                    expected.setdefault(kind, set()).add(event.id)
+        assert collection.referrers(id) == expected
+    assert collection.dangling_refs() == {tid for event in events for _, tid in relations(event)} - set(collection.list())
+
+
+def state(collection) -> list:
+    return entries(collection.get_item(id) for id in collection.list())
+
+
+def test_apply_notifies_after_all_operations(collection):
+    seen = []
+    collection.add_observer(lambda op, item: seen.append((op, item.id, len(list(collection.list())))))
+    c = EventBuilder('c').after(collection.b).build()
+    collection.apply([(OP_ADD, c), (OP_UPDATE, EventBuilder('a, again').id(collection.a).build())], reject_conflict=True)
+    assert seen == [(OP_ADD, c.id, 3), (OP_UPDATE, collection.a, 3)]
+    assert collection.get_event(collection.a).title == 'a, again'
+    assert collection.referrers(collection.b) == {'after': {c.id}}
+
+
+@pytest.mark.parametrize('failure', ['conflict', 'duplicate', 'unknown', 'operation'])
+def test_apply_is_all_or_nothing(collection, failure):
+    before = state(collection)
+    seen = []
+    collection.add_observer(lambda op, item: seen.append(item.id))
+    c = EventBuilder('c').after(collection.b).build()
+    last = {
+            'conflict': (OP_UPDATE, EventBuilder('a').id(collection.a).after(c).build()),
+            'duplicate': (OP_ADD, EventBuilder('b twice').id(collection.b).build()),
+            'unknown': (OP_UPDATE, EventBuilder('nothing').id(uuid.uuid4()).build()),
+            'operation': ('delete', c),
+            }[failure]
+    expected = {'conflict': ConflictError, 'duplicate': IllegalStateError, 'unknown': KeyError, 'operation': ValueError}[failure]
+    with pytest.raises(expected):
+        collection.apply([(OP_ADD, c), (OP_UPDATE, EventBuilder('b, renamed').id(collection.b).after(collection.a).build()), last], reject_conflict=True)
+    assert state(collection) == before
+    assert seen == []
+    assert collection.has_no_conflict()
+    assert collection.referrers(collection.a) == {'after': {collection.b}}
+    assert set(collection.ordering().g.edges()) == set(Collection([collection.get_item(id) for id in collection.list()]).ordering().g.edges())
+    collection.apply([(OP_ADD, c)], reject_conflict=True)
+    assert collection.ordering().is_before(collection.a, c.id)
+
+
+def test_single_writer(tmp_path):
+    InfoRecDB.init(tmp_path / 'db')
+    db = InfoRecDB.open(tmp_path / 'db')
+    try:
+        with pytest.raises(IllegalStateError):
+            InfoRecDB.open(tmp_path / 'db')
+        reader = InfoRecDB.open(tmp_path / 'db', read_only=True)
+        with pytest.raises(IllegalStateError):
+            reader.write()
+    finally:
+        db.close()
+    InfoRecDB.open(tmp_path / 'db').close()
+
+
+def stored(directory) -> int:
+    '''
+    The number of items written, as seen by a reader.
+    '''
+    db = InfoRecDB.open(directory, read_only=True)
+    return len(list(db.collection.list()))
+
+
+def eventually(condition) -> bool:
+    deadline = time.monotonic() + 5
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_write_behind(tmp_path, journal):
+    '''
+    The changes are flushed in the background once `flush_size` items are changed, or every `flush_interval`; and by `close()`.
+    '''
+    directory = tmp_path / 'db'
+    app = App(directory, journal=journal, write_behind=True, flush_size=3, flush_interval=60)
+    with app.transaction() as collection:
+        collection.add_item(EventBuilder('a').build(), EventBuilder('b').build())
+    time.sleep(0.1)
+    assert stored(directory) == 0
+    with app.transaction() as collection:
+        collection.add_item(EventBuilder('c').build())
+    assert eventually(lambda: stored(directory) == 3)
+    with app.transaction() as collection:
+        collection.add_item(EventBuilder('d').build())
+    app.close()
+    assert stored(directory) == 4
+    app = App(directory, journal=journal, write_behind=True, flush_interval=0.05)
+    with app.transaction() as collection:
+        collection.add_item(EventBuilder('e').build())
+    assert eventually(lambda: stored(directory) == 5)
+    app.close()
+
+
+def test_readers_during_changes(tmp_path):
+    '''
+    Readers see the collection between whole transactions, while they are applied and flushed.
+    '''
+    app = App(tmp_path / 'db', journal=True, write_behind=True, flush_size=5)
+    pairs = 50
+
+    def write():
+        for i in range(pairs):
+            with app.transaction() as collection:
+                collection.add_item(EventBuilder('first {}'.format(i)).build(), EventBuilder('second {}'.format(i)).build())
+
+    def read(_):
+        counts = []
+        for _ in range(pairs):
+            with app.reading() as collection:
+                counts.append(len(list(collection.list())))
+        return counts
+
+    with concurrent.futures.ThreadPoolExecutor(5) as executor:
+        writer = executor.submit(write)
+        counts = [count for result in executor.map(read, range(4)) for count in result]
+        writer.result()
+    assert all(count % 2 == 0 for count in counts)
+    app.close()
+    assert stored(tmp_path / 'db') == 2 * pairs
+
+
+def test_memoized_per_version(collection):
+    computed = []
+
+    def compute():
+        computed.append(collection.version)
+        return len(computed)
+
+    assert collection.memoized('key', compute) == collection.memoized('key', compute) == 1
+    version = collection.version
+    collection.add_item(EventBuilder('c').build())
+    assert collection.version > version
+    assert collection.memoized('key', compute) == 2
+    assert collection.memoized('other', compute) == 3
+    assert computed == [version, collection.version, collection.version]
+
+
+def test_changes(tmp_path):
+    '''
+    The changes are followed from the cursors; the whole collection is given again if they are not all kept, or for an invalid cursor.
+    '''
+    app = App(tmp_path / 'db', feed_size=3)
+    a, b = EventBuilder('a').build(), EventBuilder('b').build()
+    with app.transaction() as collection:
+        collection.add_item(a)
+    first = app.changes(None)
+    assert first['resync'] and [item[K_DATA]['id'] for item in first['items']] == [str(a.id)]
+    with app.transaction() as collection:
+        collection.add_item(b)
+        collection.update_item(a.id, EventBuilder('a, again').id(a.id).build())
+    changes = app.changes(first['next'])
+    assert [(change[K_OP], change[K_DATA]['title']) for change in changes['changes']] == [(OP_ADD, 'b'), (OP_UPDATE, 'a, again')]
+    assert app.changes(changes['next']) == {'changes': [], 'next': changes['next']}
+    with app.transaction() as collection:
+        collection.add_item(*(EventBuilder('more {}'.format(i)).build() for i in range(3)))
+    assert [change[K_DATA]['title'] for change in app.changes(changes['next'])['changes']] == ['more {}'.format(i) for i in range(3)]
+    resync = app.changes(first['next'])  # 5 changes since, but only 3 kept
+    assert resync['resync'] and len(resync['items']) == 5 and resync['next'] == app.changes(changes['next'])['next']
+    for cursor in ('nothing', '{}-1'.format(uuid.uuid4().hex[:8]), app.feed.cursor(100)):
+        assert app.changes(cursor)['resync']
+    app.close()
+
+
+def test_changes_wait_for_one(tmp_path):
+    app = App(tmp_path / 'db', feed_size=10)
+    cursor = app.changes(None)['next']
+    start = time.monotonic()
+    assert app.changes(cursor, timeout=0.1)['changes'] == []
+    assert time.monotonic() - start >= 0.1
+    event = EventBuilder('a').build()
+
+    def add():
+        time.sleep(0.1)
+        with app.transaction() as collection:
+            collection.add_item(event)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        executor.submit(add)
+        start = time.monotonic()
+        changes = app.changes(cursor, timeout=10)
+        assert time.monotonic() - start < 5
+    assert [change[K_DATA]['id'] for change in changes['changes']] == [str(event.id)]
+    app.close()
+
+
+def test_timeline_during(collection):
+    '''
+    The bounds of the items are inferred from the dates and times ordered before and after them, in UTC.
+    '''
+    d1 = Date(uuid.uuid4(), datetime.date(2021, 3, 1))
+    d3 = Date(uuid.uuid4(), datetime.date(2021, 3, 3))
+    t2 = AbsoluteDateTime(uuid.uuid4(), datetime.datetime(2021, 3, 2, 12, tzinfo=datetime.timezone(datetime.timedelta(hours=2))))
+    e1 = EventBuilder('e1').after(d1.id).before(t2.id).build()
+    e2 = EventBuilder('e2').after(t2.id).build()
+    e4 = EventBuilder('e4').after(d1.id).before(d3.id).build()
+    collection.add_item(d1, d3, t2, e1, e2, e4)
+    timeline = collection.timeline()
+    assert timeline.bounds(e1.id) == (datetime.datetime(2021, 3, 1), datetime.datetime(2021, 3, 2, 10))
+    assert timeline.bounds(str(e2.id)) == (datetime.datetime(2021, 3, 2, 10), None)
+    assert timeline.bounds(e4.id) == (datetime.datetime(2021, 3, 1), datetime.datetime(2021, 3, 3, 23, 59, 59, 999999))
+    assert timeline.bounds(collection.a) == (None, None)
+    with pytest.raises(KeyError):
+        timeline.bounds(uuid.uuid4())
+    start, end = datetime.datetime(2021, 3, 1), datetime.datetime(2021, 3, 2, 12)
+    assert set(timeline.during(start, end)) == {d1.id, t2.id, e1.id}
+    possibly = timeline.during(start, end, possibly=True)
+    assert set(possibly) == {d1.id, t2.id, e1.id, e2.id, e4.id, collection.a, collection.b}
+    earliest = [timeline.bounds(id)[0] or datetime.datetime.min for id in possibly]
+    assert earliest == sorted(earliest)
+    assert set(timeline.during(datetime.datetime(2021, 3, 2))) == {t2.id, e2.id, d3.id}
+    assert set(timeline.during(end=datetime.datetime(2021, 3, 2, 11, tzinfo=datetime.timezone(datetime.timedelta(hours=1))))) == {d1.id, t2.id, e1.id}
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import datetime
+
+import pytest
+
+from timeparse import S_FAILED, S_FALLBACK, S_FAST, S_MEMO, S_RELATIVE, TimeParser
+
+
+@pytest.mark.parametrize('s, expected', [
+        ('2021-05-08', datetime.datetime(2021, 5, 8)),
+        (' 2021-05-08T23:31:49 ', datetime.datetime(2021, 5, 8, 23, 31, 49)),
+        ('2021-05-08T23:31:49+02:00', datetime.datetime(2021, 5, 8, 23, 31, 49, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))),
+        ('20210508', datetime.datetime(2021, 5, 8)),
+        ('2021/05/08', datetime.datetime(2021, 5, 8)),
+        ])
+def test_strict_formats(s, expected):
+    parser = TimeParser()
+    assert parser.parse(s) == expected
+    assert parser.stats()[S_FAST] == 1
+
+
+def test_time_only_is_today():
+    assert TimeParser().parse('12:30') == datetime.datetime.combine(datetime.date.today(), datetime.time(12, 30))
+
+
+def test_fallback_is_memoized():
+    parser = TimeParser(memo_size=1)
+    assert parser.parse('May 8, 2021') == datetime.datetime(2021, 5, 8)
+    assert parser.parse('May 8, 2021') == datetime.datetime(2021, 5, 8)
+    assert parser.parse('June 1, 2021') == datetime.datetime(2021, 6, 1)
+    assert parser.parse('May 8, 2021') == datetime.datetime(2021, 5, 8)  # Evicted by the previous one
+    stats = parser.stats()
+    assert (stats[S_FALLBACK], stats[S_MEMO]) == (3, 1)
+    assert stats['hit_rate'] == 0.25
+    parser.reset_stats()
+    assert parser.stats()['hit_rate'] == 0.0
+
+
+def test_relative_and_failed():
+    parser = TimeParser()
+    yesterday = parser.parse('yesterday')
+    assert yesterday is not None and yesterday.date() == datetime.date.today() - datetime.timedelta(days=1)
+    assert parser.parse('not a time at all') is None
+    stats = parser.stats()
+    assert (stats[S_RELATIVE], stats[S_FAILED]) == (1, 1)
+
+
+def test_shared_by_threads():
+    '''
+    Threads parsing at once, through a memo smaller than their inputs (so evicting all the time), lose no parse nor count.
+    '''
+    parser = TimeParser(memo_size=4)
+    inputs = ['May {}, 2021'.format(day) for day in range(1, 13)] * 10
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        parsed = list(executor.map(parser.parse, inputs))
+    assert parsed == [datetime.datetime(2021, 5, day) for day in range(1, 13)] * 10
+    stats = parser.stats()
+    assert stats[S_MEMO] + stats[S_FALLBACK] == len(inputs)
@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+
+'''
+The parts of the WebAPI shared by the Flask and the ASGI applications, on the different storages.
+'''
+
+import uuid
+
+import pytest
+
+import webapi
+
+from model import EventBuilder
+from sqlite_storage import SqliteInfoRecDB
+from storage import Collection, InfoRecDB
+
+
+@pytest.fixture(params=['memory', 'lazy', 'sqlite'])
+def db(request, tmp_path):
+    '''
+    A database of 30 events: `event i` after `event i-1`, and referring to a missing id every 3; then 5 dates.
+    '''
+    events = []  # type: list
+    for i in range(30):
+        builder = EventBuilder('event {}'.format(i)).desc('desc')
+        if events:
+            builder.after(events[-1])
+        if i % 3 == 0:
+            builder.before(uuid.uuid4())
+        events.append(builder.build())
+    if request.param == 'sqlite':
+        SqliteInfoRecDB.init(tmp_path / 'db')
+        db = SqliteInfoRecDB.open(tmp_path / 'db')
+    else:
+        InfoRecDB.init(tmp_path / 'db')
+        db = InfoRecDB.open(tmp_path / 'db')
+    db.collection.add_item(*events)
+    db.write()
+    if request.param == 'lazy':
+        db.close()
+        db = InfoRecDB.open(tmp_path / 'db', lazy=True)
+    request.addfinalizer(db.close)
+    db.events = events  # For the tests
+    return db
+
+
+def loaded(db) -> bool:
+    '''
+    If the collection was loaded fully, or its ordering built, which a plain listing shouldn't need.
+    '''
+    collection = db.collection
+    return getattr(collection, '_full', None) is not None or getattr(collection, '_ordering', None) is not None
+
+
+def pages(collection, args: dict) -> list:
+    events = []
+    cursor = 0
+    while cursor is not None:
+        page = webapi.Listing(dict(args, cursor=str(cursor))).result(collection)
+        assert len(page['events']) <= int(args.get('limit', webapi.DEFAULT_PAGE_SIZE))
+        events.extend(page['events'])
+        cursor = page['next']
+    return events
+
+
+def test_pages(db):
+    events = pages(db.collection, {'limit': '7', 'fields': 'id,title'})
+    assert events == [{'id': str(event.id), 'title': event.title} for event in db.events]
+    assert pages(db.collection, {'limit': '2', 'title': 'EVENT 1'}) == [webapi.project_event(event, webapi.EVENT_FIELDS) for event in db.events if event.title.startswith('event 1')]
+    assert isinstance(db.collection, Collection) or not loaded(db)
+    assert [event['id'] for event in pages(db.collection, {'dangling': '1'})] == [str(event.id) for event in db.events[::3]]
+    assert pages(db.collection, {'conflict': 'true'}) == []
+
+
+def test_page_continues_after_changes(db):
+    page = webapi.Listing({'limit': '20', 'fields': 'id'}).result(db.collection)
+    more = EventBuilder('more').build()
+    db.collection.add_item(more)
+    updated = EventBuilder('updated').id(db.events[25].id).build()
+    db.collection.update_item(updated.id, updated)
+    rest = webapi.Listing({'cursor': str(page['next']), 'fields': 'id,title'}).result(db.collection)
+    assert rest['next'] is None
+    assert [event['title'] for event in rest['events']] == [event.title for event in db.events[20:25]] + ['updated'] + [event.title for event in db.events[26:]] + ['more']
+
+
+def test_batch_get(db):
+    missing = str(uuid.uuid4())
+    result = webapi.Listing({'ids': '{},{}'.format(db.events[3].id, missing), 'fields': 'title'}).result(db.collection)
+    assert result == {'events': [{'title': 'event 3'}], 'missing': [missing]}
+
+
+@pytest.mark.parametrize('args', [{'limit': '0'}, {'limit': '1001'}, {'cursor': '-1'}, {'fields': 'id,nothing'}, {'ids': 'not an id'}])
+def test_invalid_listing(args):
+    with pytest.raises(ValueError):
+        webapi.Listing(args)
+
@@ -0,0 +1,129 @@
+# -*- coding:utf-8 -*-
+
+'''
+Parsing of the dates and times given as strings (e.g. to `AbsoluteBuilder`).
+`dateparser` is slow (mostly because of language detection), so strict formats are tried first, and it is only the fallback, with pinned languages and settings.
+'''
+
+import collections
+import datetime
+import threading
+
+import dateparser
+
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+
+
+DEFAULT_FORMATS = ('%Y%m%d', '%Y/%m/%d', '%Y%m%dT%H%M%S')  # Tried after the ISO formats
+DEFAULT_LANGUAGES = ('en',)
+DEFAULT_MEMO_SIZE = 4096
+
+S_MEMO = 'memo'  # Found in the memo
+S_FAST = 'fast'  # Parsed by a strict format
+S_FALLBACK = 'fallback'  # Parsed by `dateparser` as an absolute time
+S_RELATIVE = 'relative'  # Parsed by `dateparser` as a relative time (e.g. "yesterday")
+S_FAILED = 'failed'
+STATS = (S_MEMO, S_FAST, S_FALLBACK, S_RELATIVE, S_FAILED)
+
+RELATIVE_PARSER = 'relative-time'
+
+
+class TimeParser:
+    '''
+    Parse dates and times, trying in order:
+    1. the memo of the recent inputs parsed by `dateparser`;
+    2. the ISO formats (as `fromisoformat()`), then `formats` (as `strptime()`);
+    3. `dateparser` for absolute times, with `languages` (so without detection) and `settings`;
+    4. `dateparser` for relative times, which are not memoized.
+    A missing date is the current one, as with `dateparser`; the memo is keyed by the current date too.
+    A parser may be shared by threads (as `DEFAULT_PARSER` is by the handlers of a server): the memo and the stats are changed under a lock, which isn't held while parsing.
+    '''
+
+    def __init__(self, formats: Iterable[str]=DEFAULT_FORMATS, languages: Optional[Iterable[str]]=DEFAULT_LANGUAGES, settings: Optional[Mapping[str, object]]=None, memo_size: int=DEFAULT_MEMO_SIZE):
+        self.formats = list(formats)
+        self.languages = list(languages) if languages is not None else None  # None to let `dateparser` detect them
+        settings = dict(settings or {})
+        parsers = settings.get('PARSERS', dateparser.conf.settings.PARSERS)
+        assert isinstance(parsers, list)
+        self._absolute_settings = dict(settings, PARSERS=[p for p in parsers if p != RELATIVE_PARSER])
+        self._relative_settings = dict(settings, PARSERS=[RELATIVE_PARSER]) if RELATIVE_PARSER in parsers else None
+        self._memo = collections.OrderedDict()  # type: collections.OrderedDict[Tuple[str, datetime.date], datetime.datetime]
+        self._memo_size = memo_size
+        self._stats = dict.fromkeys(STATS, 0)
+        self._lock = threading.Lock()  # For `_memo` and `_stats`
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _strict(self, s: str, today: datetime.date) -> Optional[datetime.datetime]:
+        try:
+            return datetime.datetime.fromisoformat(s)
+        except ValueError:
+            pass
+        if ':' in s:  # Not e.g. a year, which newer `fromisoformat()` would take for a time
+            try:
+                return datetime.datetime.combine(today, datetime.time.fromisoformat(s))
+            except ValueError:
+                pass
+        for fmt in self.formats:
+            try:
+                return datetime.datetime.strptime(s, fmt)
+            except ValueError:
+                continue
+        return None
+
+    def _dateparser(self, s: str, settings: Dict[str, object]) -> Optional[datetime.datetime]:
+        return dateparser.parse(s, languages=self.languages, settings=settings)
+
+    def parse(self, s: str) -> Optional[datetime.datetime]:
+        '''
+        Parse `s`, or return None if it can't be.
+        '''
+        s = s.strip()
+        today = datetime.date.today()
+        key = (s, today)
+        with self._lock:
+            dt = self._memo.get(key)
+            if dt is not None:
+                self._memo.move_to_end(key)
+                self._stats[S_MEMO] += 1
+                return dt
+        dt = self._strict(s, today)
+        if dt is not None:
+            self._count(S_FAST)
+            return dt
+        dt = self._dateparser(s, self._absolute_settings)
+        if dt is not None:
+            with self._lock:
+                self._stats[S_FALLBACK] += 1
+                self._memo[key] = dt
+                self._memo.move_to_end(key)  # If parsed by another thread meanwhile
+                if len(self._memo) > self._memo_size:
+                    self._memo.popitem(last=False)
+            return dt
+        if self._relative_settings is not None:
+            dt = self._dateparser(s, self._relative_settings)
+        self._count(S_RELATIVE if dt is not None else S_FAILED)
+        return dt
+
+    def stats(self) -> Dict[str, float]:
+        '''
+        The number of inputs resolved by each way (see `STATS`), and the `hit_rate` of the memo and the strict formats (i.e. without calling `dateparser`).
+        '''
+        with self._lock:
+            stats = dict(self._stats)  # type: Dict[str, float]
+        total = sum(stats.values())
+        stats['hit_rate'] = (stats[S_MEMO] + stats[S_FAST]) / total if total else 0.0
+        return stats
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = dict.fromkeys(STATS, 0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memo.clear()
+
+
+DEFAULT_PARSER = TimeParser()
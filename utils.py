@@ -17,11 +17,18 @@ from storage import Collection
 
 def tabularize_events(collection: Collection):
     event_table = []
-    for eid in collection.list():
-        event = collection.get_event(eid)
-        event_table.append([str(eid), event.title])
+    for eid, title in collection.titles():
+        event_table.append([eid, title])
     return event_table
 
 
+def iter_events(collection: Collection):
+    '''
+    Like `tabularize_events`, but streaming the rows.
+    '''
+    for eid, title in collection.titles():
+        yield [eid, title]
+
+
 def comma_separated_list(lst_s):
     return [item.strip() for item in lst_s.split(',')]
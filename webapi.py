@@ -0,0 +1,236 @@
+# -*- coding:utf-8 -*-
+
+'''
+The parts of the WebAPI independent of the web framework, shared by `flask_app` and `asgi_app`.
+The request arguments are given as mappings from names to (string) values.
+'''
+
+import datetime
+import uuid
+
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple
+
+import model
+import sede
+import utils
+
+from search import DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT
+from timeparse import DEFAULT_PARSER
+
+from storage import OP_ADD, OP_UPDATE, relations
+
+
+DB_DIRECTORY = 'data'
+API_BASE_URL = '/api'
+MAX_CONFLICT_CYCLES = 100
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EVENT_FIELDS = (sede.K_ID, sede.K_TITLE, sede.K_DESC, sede.K_TIMESPEC)
+LISTING_ARGS = ('cursor', 'limit', 'fields', 'title', 'dangling', 'conflict')
+MAX_POLL_TIMEOUT = 30.0  # Seconds a request for changes may wait for one
+INSTANCE = uuid.uuid4().hex[:8]  # Distinguishes the collection versions (restarting from 0) of different runs in the ETags
+
+
+def _id_list(value):
+    return utils.comma_separated_list(value) if isinstance(value, str) else value
+
+
+def build_event(args: Mapping, id) -> model.Event:
+    '''
+    Build the event from the arguments of the event requests: `title`, and optionally `desc`, and `before`, `after` and `same`, as lists or comma-separated strings of ids.
+    '''
+    builder = model.EventBuilder(args['title']).desc(args.get('desc')).id(id)
+    for before in _id_list(args.get('before') or []):
+        builder.before(before)
+    for after in _id_list(args.get('after') or []):
+        builder.after(after)
+    for same in _id_list(args.get('same') or []):
+        builder.same(same)
+    return builder.build()
+
+
+def build_transaction_operation(operation: Mapping) -> Tuple[str, model.Event]:
+    '''
+    Build the event of an operation of a transaction, which is like the arguments of the event requests, with `op` (`add` or `update`) and `id` (optional to add).
+    '''
+    op = operation.get('op', OP_ADD)
+    if op not in (OP_ADD, OP_UPDATE):
+        raise ValueError("Unknown operation {}".format(op))
+    id = operation.get('id')
+    if id is None:
+        if op == OP_UPDATE:
+            raise ValueError('The id of the event to update is missing')
+        id = str(uuid.uuid4())
+    return op, build_event(operation, id)
+
+
+def flag(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def parse_fields(value: str) -> Set[str]:
+    fields = utils.comma_separated_list(value)
+    unknown = set(fields) - set(EVENT_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields {}".format(', '.join(sorted(unknown))))
+    return set(fields)
+
+
+def project_event(event: model.Event, fields) -> dict:
+    '''
+    Serialise only the `fields` (of `EVENT_FIELDS`) of the event.
+    '''
+    ret = {}  # type: Dict[str, object]
+    if sede.K_ID in fields:
+        ret[sede.K_ID] = str(event.id)
+    if sede.K_TITLE in fields:
+        ret[sede.K_TITLE] = event.title
+    if sede.K_DESC in fields and event.desc:
+        ret[sede.K_DESC] = event.desc
+    if sede.K_TIMESPEC in fields and event.timespec:
+        ret[sede.K_TIMESPEC] = sede.serialise_reltimespec(event.timespec)
+    return ret
+
+
+def event_filter(collection, title: Optional[str]=None, dangling: bool=False, conflict: bool=False) -> Callable[[model.RelTimeMarker], bool]:
+    '''
+    The predicate selecting the events whose title contains `title` (ignoring the case), and with `dangling`, referring to ids not in the collection, and with `conflict`, in a conflict group.
+    '''
+    title = title.lower() if title else None
+    dangling_refs = collection.dangling_refs() if dangling else None
+    conflicting = None  # type: Optional[set]
+    ordering = None  # type: Any
+    if conflict:  # Only then the ordering is needed, which builds the graph of the whole collection
+        conflicting = set()
+        for group in collection.conflict_report().groups:
+            conflicting.update(group)
+        ordering = collection.ordering()
+
+    def where(item: model.RelTimeMarker) -> bool:
+        if not isinstance(item, model.Event):
+            return False
+        if title is not None and title not in (item.title or '').lower():
+            return False
+        if dangling_refs is not None and not any(tid in dangling_refs for _, tid in relations(item)):
+            return False
+        if conflicting is not None and ordering.node(item.id) not in conflicting:
+            return False
+        return True
+    return where
+
+
+class Listing:
+    '''
+    The arguments of the event listing (see `flask_app.EventList`), parsed (raising `ValueError` if invalid).
+    '''
+
+    def __init__(self, args: Mapping[str, str]):
+        self.args = args
+        self.fields = parse_fields(args['fields']) if 'fields' in args else set(EVENT_FIELDS)
+        self.ids = None  # type: Optional[List[uuid.UUID]]
+        if 'ids' in args:
+            self.ids = [uuid.UUID(id) for id in utils.comma_separated_list(args['ids'])]
+        self.cursor = int(args.get('cursor', 0))
+        self.limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        if self.cursor < 0 or not 0 < self.limit <= MAX_PAGE_SIZE:
+            raise ValueError('The cursor must be positive, and the limit between 1 and {}'.format(MAX_PAGE_SIZE))
+
+    def result(self, collection):
+        '''
+        The events (or ids) listed, to be serialised as JSON.
+        '''
+        if self.ids is not None:
+            return batch_get(collection, self.ids, self.fields)
+        if not any(arg in self.args for arg in LISTING_ARGS):
+            return collection.memoized('ids', lambda: [str(item) for item in collection.list()])
+        where = event_filter(collection, self.args.get('title'), flag(self.args.get('dangling', '')), flag(self.args.get('conflict', '')))
+        page, next_cursor = collection.page(self.cursor, self.limit, where)
+        return {
+                'events': [project_event(event, self.fields) for event in page],
+                'next': next_cursor,
+                }
+
+
+def poll_timeout(args: Mapping[str, str]) -> float:
+    '''
+    The `timeout` of a request for changes (see `App.changes()`), bounded by `MAX_POLL_TIMEOUT`.
+    '''
+    timeout = float(args.get('timeout', 0))
+    if not 0 <= timeout:
+        raise ValueError('The timeout must be positive')
+    return min(timeout, MAX_POLL_TIMEOUT)
+
+
+def parse_max_cycles(args: Mapping[str, str]) -> int:
+    '''
+    The `max_cycles` of a request for the status of the collection: the number of conflict cycles to give at most.
+    '''
+    max_cycles = int(args.get('max_cycles', MAX_CONFLICT_CYCLES))
+    if max_cycles < 0:
+        raise ValueError('max_cycles must not be negative')
+    return max_cycles
+
+
+def batch_get(collection, ids: List[uuid.UUID], fields) -> dict:
+    events = []
+    missing = []
+    for id in ids:
+        try:
+            events.append(project_event(collection.get_event(id), fields))
+        except (KeyError, RuntimeError):
+            missing.append(str(id))
+    return {'events': events, 'missing': missing}
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime.datetime]:
+    if value is None:
+        return None
+    t = DEFAULT_PARSER.parse(value)
+    if t is None:
+        raise ValueError("Invalid time {}".format(value))
+    return t
+
+
+def timeline_ids(collection, args: Mapping[str, str]) -> List[str]:
+    '''
+    The ids of the items in time order, only the ones after the item `after` and before the item `before` if given (raising `KeyError` for an unknown id).
+    With `from` or `to` (times), the ids of the items within this period according to their inferred bounds instead (see `MarkerTimeline.during()`), and with `possibly`, the ones which may be in it.
+    '''
+    timeline = collection.timeline()
+    if 'from' in args or 'to' in args:
+        ids = timeline.during(parse_time(args.get('from')), parse_time(args.get('to')), flag(args.get('possibly', '')))
+    else:
+        ids = timeline.between(args.get('after'), args.get('before'))
+    return [str(id) for id in ids]
+
+
+def search_results(index, collection, args: Mapping[str, str]) -> List[dict]:
+    '''
+    The events matching the query `q` in the search index (see `SearchIndex.search()`), best first, as `{"id", "title", "score"}`: at most `limit` of them.
+    '''
+    if index is None:
+        raise ValueError('The events are not indexed for search')
+    if not args.get('q'):
+        raise ValueError('The query `q` is required')
+    limit = int(args.get('limit', DEFAULT_SEARCH_LIMIT))
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError('The limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    return [{'id': str(id), 'title': collection.get_event(id).title, 'score': score} for id, score in index.search(args['q'], limit)]
+
+
+def conflict_status(report, max_cycles: int) -> dict:
+    return {
+            'has_no_conflict': not report,
+            'conflict_groups': [[str(node) for node in group] for group in report.groups],
+            'conflicts': [[str(node) for node in cycle] for cycle in report.cycles(max_cycles)],
+            }
+
+
+def collection_status(collection, max_cycles: int) -> dict:
+    status = {'is_self_contained': collection.is_self_contained()}
+    status.update(conflict_status(collection.conflict_report(), max_cycles))
+    return status
+
+
+def etag(collection) -> str:
+    return '{}-{}'.format(INSTANCE, collection.version)